@@ -0,0 +1,205 @@
+# Benchmark of the full directive path: lambda_handler -> RequestFactory ->
+# handler -> DeviceCloud -> Bottle stand-in (test/bottle_test_server.py).
+#
+# Usage:
+#   python -m benchmark.bench_directives                 # run and compare with baseline
+#   python -m benchmark.bench_directives --save          # run and overwrite the baseline
+#   python -m benchmark.bench_directives -n 500 -s Discover -s ReportState
+#   python -m benchmark.bench_directives --server threaded --seed 7 \
+#       --faults '{"reportstate": {"latency": ["lognormal", 0.02, 0.5], "error_rate": 0.01}}'
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from threading import Thread
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def configure(port):
+    os.environ['cloud_host'] = 'localhost'
+    os.environ['cloud_port'] = str(port)
+    os.environ['cloud_schema'] = 'http'
+    os.environ.setdefault('token_store', 'memory')
+
+
+def start_server(port, server='wsgiref', **kwargs):
+    from test import bottle_test_server as ms
+
+    # seed and faults: see test/bottle_test_server.py.
+    ms.configure(**kwargs)
+    server = Thread(target=ms.run_server, kwargs={'port': port, 'server': server, 'quiet': True})
+    server.daemon = True
+    server.start()
+    time.sleep(.2)
+
+
+def scenarios():
+    from lib import alexa_message as message
+    from lib.cache import discovery_cache, state_cache
+
+    def uncached():
+        discovery_cache.clear()
+        state_cache.clear()
+
+    # name: (request builder, hook run before each call)
+    return {
+        'Discover': (lambda: message.AlexaDiscoveryRequest(token='0202').get(), uncached),
+        'Discover.cached': (lambda: message.AlexaDiscoveryRequest(token='0202').get(), None),
+        'TurnOn': (lambda: message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOn').get(), None),
+        'TurnOff': (lambda: message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOff').get(), None),
+        'ReportState': (lambda: message.AlexaStateRequest(endpointId='spa_test_2', token='0202').get(), uncached),
+        'ReportState.cached': (lambda: message.AlexaStateRequest(endpointId='spa_test_2', token='0202').get(), None),
+        'AcceptGrant.error': (lambda: message.AlexaAuthorizationRequest(
+            grant_code='invalid_code', grantee_token='0101').get(), None),
+    }
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_scenario(handler, build, hook, iterations, warmup):
+    for _ in range(warmup):
+        if hook:
+            hook()
+        handler(build(), None)
+
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        request = build()
+        if hook:
+            hook()
+        begin = time.perf_counter()
+        handler(request, None)
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - started
+
+    # Separate pass, tracemalloc slows everything down.
+    samples = max(1, iterations // 10)
+    peaks = []
+    blocks = []
+    tracemalloc.start()
+    for _ in range(samples):
+        request = build()
+        if hook:
+            hook()
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        handler(request, None)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        after = tracemalloc.take_snapshot()
+        blocks.append(sum(stat.count_diff for stat in after.compare_to(before, 'filename')
+                          if stat.count_diff > 0))
+    tracemalloc.stop()
+
+    return {
+        'iterations': iterations,
+        'throughput': iterations / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'peak_alloc_bytes': int(statistics.median(peaks)),
+        'retained_blocks': int(statistics.median(blocks)),
+    }
+
+
+def compare(results, baseline, tolerance):
+    # Latencies may grow and throughput may drop by at most tolerance.
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'peak_alloc_bytes'):
+            if base[key] and result[key] > base[key] * (1 + tolerance):
+                regressions.append(f'{name} {key}: {result[key]:.2f} > {base[key]:.2f}')
+        if base['throughput'] and result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(
+                f"{name} throughput: {result['throughput']:.1f} < {base['throughput']:.1f}")
+    return regressions
+
+
+def report(results, baseline):
+    header = f"{'scenario':<20}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak B':>10}{'vs p50':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, result in results.items():
+        base = baseline.get(name)
+        delta = f"{(result['p50_ms'] / base['p50_ms'] - 1) * 100:+.0f}%" if base and base['p50_ms'] else ''
+        print(f"{name:<20}{result['throughput']:>10.1f}{result['p50_ms']:>10.2f}"
+              f"{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+              f"{result['peak_alloc_bytes']:>10}{delta:>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('-w', '--warmup', type=int, default=20)
+    parser.add_argument('-s', '--scenario', action='append',
+                        help='scenario to run, may be repeated (default: all)')
+    parser.add_argument('-p', '--port', type=int, default=3434)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true', help='overwrite the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    # The baseline is taken on Bottle's single threaded server; the threaded
+    # one serves slow (--faults) requests side by side, at a thread per request.
+    parser.add_argument('--server', default='wsgiref', help='stand-in server: wsgiref, threaded, ...')
+    parser.add_argument('--seed', help='seed of the simulated cloud faults')
+    parser.add_argument('--faults', help='JSON faults per stand-in route, see test/bottle_test_server.py '
+                                         '(results are not comparable with a fault-free baseline)')
+    args = parser.parse_args(argv)
+
+    configure(args.port)
+    start_server(args.port, server=args.server, seed=args.seed, faults=args.faults)
+    logging.disable(logging.CRITICAL)
+
+    from lib import lwa
+    from source.lambda_function import lambda_handler
+
+    # The stand-in also plays Login With Amazon, as in the tests.
+    lwa.lwa_token_url = f'http://localhost:{args.port}/auth/o2/token'
+
+    available = scenarios()
+    names = args.scenario or list(available)
+    results = {}
+    for name in names:
+        build, hook = available[name]
+        results[name] = run_scenario(lambda_handler, build, hook, args.iterations, args.warmup)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results, baseline)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as fp:
+            json.dump(baseline, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}', file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
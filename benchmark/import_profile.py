@@ -0,0 +1,122 @@
+# Import-time (cold start) profile of the Lambda entry point, using
+# python -X importtime in a fresh interpreter.
+#
+# Usage:
+#   python -m benchmark.import_profile                  # report, compare with baseline
+#   python -m benchmark.import_profile --directive      # also import what the first directives load
+#   python -m benchmark.import_profile --save           # overwrite the baseline
+#   python -m benchmark.import_profile --budget-ms 100  # fail above an absolute budget
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(__file__), 'import_baseline.json')
+
+ENTRY = 'import source.lambda_function'
+
+# Runs one directive per built-in handler, so the lazily imported modules
+# show up in the profile too. No cloud is needed, the calls just fail.
+FIRST_DIRECTIVES = '''
+import logging
+logging.disable(logging.CRITICAL)
+from lib import alexa_message as message
+from source.lambda_function import lambda_handler
+for request in (message.AlexaDiscoveryRequest(token='0').get(),
+                message.AlexaStateRequest(endpointId='0', token='0').get(),
+                message.AlexaToggleRequest('0', '0', 'TurnOn').get()):
+    try:
+        lambda_handler(request, None)
+    except Exception:
+        pass
+'''
+
+
+def profile(code):
+    env = dict(os.environ, cloud_schema='http', cloud_host='127.0.0.1', cloud_port='9',
+               cloud_timeout='0.01')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=ROOT, env=env, capture_output=True, text=True)
+    modules = {}
+    order = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        name = name.rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        modules[name] = {'self_us': int(self_us), 'cumulative_us': int(cumulative_us),
+                         'depth': depth}
+        order.append(name)
+    # Top level imports (depth 0) add up to the total import time.
+    total = sum(modules[name]['cumulative_us'] for name in order if modules[name]['depth'] == 0)
+    return {'total_us': total, 'modules': modules}
+
+
+def best_of(code, repeat):
+    runs = [profile(code) for _ in range(repeat)]
+    return min(runs, key=lambda run: run['total_us'])
+
+
+def report(name, run, top):
+    modules = run['modules']
+    print(f"{name}: {run['total_us'] / 1000:.1f} ms, {len(modules)} modules")
+    ranked = sorted(modules.items(), key=lambda item: item[1]['self_us'], reverse=True)
+    print(f"  {'module':<40}{'self ms':>10}{'cumul ms':>10}")
+    for module, stats in ranked[:top]:
+        print(f"  {module:<40}{stats['self_us'] / 1000:>10.2f}{stats['cumulative_us'] / 1000:>10.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--directive', action='store_true',
+                        help='also profile the imports made by the first directives')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('-t', '--top', type=int, default=15)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--budget-ms', type=float, default=None)
+    args = parser.parse_args(argv)
+
+    results = {'startup': best_of(ENTRY, args.repeat)}
+    if args.directive:
+        results['first_directive'] = best_of(ENTRY + '\n' + FIRST_DIRECTIVES, args.repeat)
+    for name, run in results.items():
+        report(name, run, args.top)
+
+    summary = {name: {'total_us': run['total_us'], 'modules': len(run['modules'])}
+               for name, run in results.items()}
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+
+    if args.save:
+        baseline.update(summary)
+        with open(args.baseline, 'w') as fp:
+            json.dump(baseline, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+        return 0
+
+    failures = []
+    for name, current in summary.items():
+        base = baseline.get(name)
+        if base and current['total_us'] > base['total_us'] * (1 + args.tolerance):
+            failures.append(f"{name}: {current['total_us'] / 1000:.1f} ms > "
+                            f"baseline {base['total_us'] / 1000:.1f} ms")
+        if base and current['modules'] > base['modules']:
+            print(f"{name}: {current['modules'] - base['modules']} more modules than baseline")
+    if args.budget_ms is not None and summary['startup']['total_us'] > args.budget_ms * 1000:
+        failures.append(f"startup over budget: {summary['startup']['total_us'] / 1000:.1f} ms")
+    for failure in failures:
+        print(f'REGRESSION {failure}', file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
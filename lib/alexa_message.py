@@ -1,15 +1,69 @@
+import io
+import json
+import time
 import uuid
-import random
-import datetime
 import logging
-from datetime import datetime, timezone
+
+from lib import metrics
+from lib.models import ENDPOINT_HEALTH, Capability, DiscoveryEndpoint, Endpoint, Header, Property, utc_timestamp
+from lib.payload_log import LazyPayload
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Same output as json.dumps with default arguments.
+_encoder = json.JSONEncoder()
+
 
 def get_utc_timestamp(seconds=None):
-    return datetime.now(timezone.utc).isoformat()
+    return utc_timestamp(seconds)
+
+
+def as_dict(item):
+    # Models (lib.models) or plain dicts set by callers.
+    return item if isinstance(item, dict) else item.as_dict()
+
+
+def property_dicts(properties, now):
+    # The message time is formatted once for all the properties without one.
+    stamp = utc_timestamp(now)
+    return [prop if isinstance(prop, dict) else prop.as_dict(now, stamp) for prop in properties]
+
+
+class FrozenDict(dict):
+    # Read-only dict for blocks shared between responses. Still a dict, so
+    # json.dumps and the Lambda runtime serialize it as usual.
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('FrozenDict is immutable')
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+    __ior__ = _readonly
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(value):
+    # Recursively turn dicts into FrozenDicts and lists into tuples.
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+DEFAULT_ADDITIONAL_ATTRIBUTES = freeze({
+    'manufacturer': 'Applied Computer Controls',
+    'model': 'ACCSSPA-MODEL-NAME',
+})
+DEFAULT_DISPLAY_CATEGORIES = ('THERMOSTAT', 'LIGHT')
 
 
 class AlexaResponse:
@@ -18,39 +72,36 @@ class AlexaResponse:
 
         self.context_properties = []
         self.payload_endpoints = []
+        # timeOfSample of properties added without one.
+        self.created = time.time()
 
-        # Set up the response structure.
+        # Set up the response structure. Header and endpoint stay models
+        # until get() or write() renders them.
         self.context = {}
         self.event = {
-            'header': {
-                'namespace': kwargs.get('namespace', 'Alexa'),
-                'name': kwargs.get('name', 'Response'),
-                'messageId': kwargs.get('messageId', str(uuid.uuid4())),
-                'payloadVersion': kwargs.get('payload_version', '3')
-            },
-            'endpoint': {
-                "scope": {
-                    "type": "BearerToken",
-                    "token": kwargs.get('token', 'INVALID')
-                },
-                "endpointId": kwargs.get('endpointId', 'INVALID')
-            },
+            'header': Header(kwargs.get('namespace', 'Alexa'),
+                             kwargs.get('name', 'Response'),
+                             message_id=kwargs.get('messageId', None),
+                             correlation_token=kwargs.get('correlationToken', 'INVALID'),
+                             payload_version=kwargs.get('payload_version', '3')),
+            'endpoint': Endpoint(kwargs.get('endpointId', 'INVALID'),
+                                 token=kwargs.get('token', 'INVALID'),
+                                 cookie=kwargs.get('cookie', None),
+                                 with_cookie='cookie' in kwargs),
             'payload': kwargs.get('payload', {})
         }
 
-        self.event['header']['correlationToken'] = kwargs.get(
-            'correlationToken', 'INVALID')
-
-        if 'cookie' in kwargs:
-            self.event['endpoint']['cookie'] = kwargs.get('cookie', '{}')
-
         # No endpoint property in an AcceptGrant or Discover response event.
-        if self.event['header']['name'] == 'AcceptGrant.Response' or self.event['header']['name'] == 'Discover.Response':
+        if self.event['header'].name in ('AcceptGrant.Response', 'Discover.Response'):
             self.event.pop('endpoint')
 
     def add_context_property(self, **kwargs):
-        self.context_properties.append(self.create_context_property(**kwargs))
-        self.context_properties.append(self.create_context_property())
+        self.add_property(self.context_property(**kwargs))
+
+    def add_property(self, prop):
+        # Takes a lib.models.Property, which may be shared between responses.
+        self.context_properties.append(prop)
+        self.context_properties.append(ENDPOINT_HEALTH)
 
     def add_cookie(self, key, value):
 
@@ -61,67 +112,65 @@ class AlexaResponse:
 
     def add_payload_endpoint(self, endpointId, **kwargs):
         self.payload_endpoints.append(
-            self.create_payload_endpoint(endpointId, **kwargs))
+            self.payload_endpoint(endpointId, **kwargs))
 
-    def create_context_property(self, **kwargs):
-        return {
-            'namespace': kwargs.get('namespace', 'Alexa.EndpointHealth'),
-            'name': kwargs.get('name', 'connectivity'),
-            'value': kwargs.get('value', {'value': 'OK'}),
-            'instance': kwargs.get('instance', 'no-instance'),
-            'timeOfSample': get_utc_timestamp(),
-            'uncertaintyInMilliseconds': kwargs.get('uncertainty_in_milliseconds', 0)
-        }
+    def add_endpoint(self, endpoint):
+        # Takes a lib.models.DiscoveryEndpoint, which may be reused.
+        self.payload_endpoints.append(endpoint)
 
-    def create_payload_endpoint(self, endpointId, **kwargs):
-        # Return the proper structure expected for the endpoint.
-        # All discovery responses must include the additionAttributes
-        additionalAttributes = {
-            'manufacturer': kwargs.get('manufacturer', 'Applied Computer Controls'),
-            'model': kwargs.get('model_name', 'ACCSSPA-MODEL-NAME'),
-        }
-
-        endpoint = {
-            'capabilities': kwargs.get('capabilities', []),
-            'description': kwargs.get('description', 'spa-description'),
-            'displayCategories': kwargs.get('display_categories', ['THERMOSTAT', 'LIGHT']),
-            'endpointId': endpointId,
-            'friendlyName': kwargs.get('friendly_name', 'ACC Spa'),
-            'manufacturerName': kwargs.get('manufacturer_name', 'Applied Computer Controls')
-        }
+    @staticmethod
+    def context_property(**kwargs):
+        return Property(namespace=kwargs.get('namespace', 'Alexa.EndpointHealth'),
+                        name=kwargs.get('name', 'connectivity'),
+                        value=kwargs.get('value', None),
+                        instance=kwargs.get('instance', 'no-instance'),
+                        time_of_sample=kwargs.get('time_of_sample'),
+                        uncertainty=kwargs.get('uncertainty_in_milliseconds', 0))
 
-        endpoint['additionalAttributes'] = kwargs.get(
-            'additionalAttributes', additionalAttributes)
-        if 'cookie' in kwargs:
-            endpoint['cookie'] = kwargs.get('cookie', {})
+    def create_context_property(self, **kwargs):
+        return self.context_property(**kwargs).as_dict()
 
-        return endpoint
+    def create_payload_endpoint(self, endpointId, **kwargs):
+        return self.payload_endpoint(endpointId, **kwargs).as_dict()
 
-    def create_payload_endpoint_capability(self, **kwargs):
+    @staticmethod
+    def payload_endpoint(endpointId, **kwargs):
+        # Return the proper structure expected for the endpoint.
+        # All discovery responses must include the additionAttributes.
+        # Defaults are shared, immutable blocks instead of fresh dicts.
+        if 'manufacturer' in kwargs or 'model_name' in kwargs:
+            additionalAttributes = {
+                'manufacturer': kwargs.get('manufacturer', 'Applied Computer Controls'),
+                'model': kwargs.get('model_name', 'ACCSSPA-MODEL-NAME'),
+            }
+        else:
+            additionalAttributes = DEFAULT_ADDITIONAL_ATTRIBUTES
+
+        return DiscoveryEndpoint(
+            endpointId,
+            capabilities=kwargs.get('capabilities', []),
+            description=kwargs.get('description', 'spa-description'),
+            display_categories=kwargs.get('display_categories', DEFAULT_DISPLAY_CATEGORIES),
+            friendly_name=kwargs.get('friendly_name', 'ACC Spa'),
+            manufacturer_name=kwargs.get('manufacturer_name', 'Applied Computer Controls'),
+            additional_attributes=kwargs.get('additionalAttributes', additionalAttributes),
+            cookie=kwargs.get('cookie', None))
+
+    @staticmethod
+    def create_payload_endpoint_capability(**kwargs):
         # All discovery responses must include the Alexa interface
-        capability = {
-            'type': kwargs.get('type', 'AlexaInterface'),
-            'interface': kwargs.get('interface', 'Alexa'),
-            'version': kwargs.get('version', '3'),
-        }
-
-        if 'instance' in kwargs:
-            capability['instance'] = kwargs.get('instance')
-        if 'capabilityResources' in kwargs:
-            capability['capabilityResources'] = kwargs.get(
-                'capabilityResources')
-
-        supported = kwargs.get('supported', None)
-        if supported:
-            capability['properties'] = {}
-            capability['properties']['supported'] = supported
-            capability['properties']['proactivelyReported'] = kwargs.get(
-                'proactively_reported', False)
-            capability['properties']['retrievable'] = kwargs.get(
-                'retrievable', False)
-        return capability
-    
-    def create_capability_resources(self, **kwargs):
+        return Capability(interface=kwargs.get('interface', 'Alexa'),
+                          version=kwargs.get('version', '3'),
+                          type=kwargs.get('type', 'AlexaInterface'),
+                          instance=kwargs.get('instance', None),
+                          supported=kwargs.get('supported', None),
+                          proactively_reported=kwargs.get('proactively_reported', False),
+                          retrievable=kwargs.get('retrievable', False),
+                          capability_resources=kwargs.get('capabilityResources', None),
+                          configuration=kwargs.get('configuration', None)).as_dict()
+
+    @staticmethod
+    def create_capability_resources(**kwargs):
         return {
             "friendlyNames":
             [{
@@ -134,28 +183,96 @@ class AlexaResponse:
         }
 
     def get(self, remove_empty=True):
+        with metrics.phase('serialize'):
+            return self._get(remove_empty)
+
+    def _get(self, remove_empty):
 
         response = {
             'context': self.context,
-            'event': self.event
+            'event': {key: as_dict(value) for key, value in self.event.items()}
         }
 
         if len(self.context_properties) > 0:
-            response['context']['properties'] = self.context_properties
+            response['context']['properties'] = property_dicts(self.context_properties, self.created)
 
         if len(self.payload_endpoints) > 0:
-            response['event']['payload']['endpoints'] = self.payload_endpoints
+            response['event']['payload']['endpoints'] = [
+                as_dict(endpoint) for endpoint in self.payload_endpoints]
 
         if remove_empty:
             if len(response['context']) < 1:
                 response.pop('context')
 
-        if 'ErrorResponse' in response['event']['header']['name']:
-            logger.error(f"response: {response}")
-        else:
-            logger.info(f"response: {response}")
+        # Lazy: the response is only formatted if the record is emitted.
+        name = response['event']['header']['name']
+        if 'ErrorResponse' in name:
+            logger.error('%s', LazyPayload('response', name, response))
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s', LazyPayload('response', name, response))
         return response
 
+    def serialize(self):
+        with metrics.phase('serialize'):
+            buffer = io.BytesIO()
+            self.write(buffer)
+            data = buffer.getvalue()
+        metrics.set_value('response_bytes', len(data))
+        return data
+
+    def write(self, fp):
+        # Stream the JSON of get() to a binary file-like object, encoding the
+        # payload endpoints one at a time instead of building the full
+        # response dict first. Does not modify the response.
+        encode = _encoder.encode
+        write = fp.write
+
+        context = self.context
+        if len(self.context_properties) > 0:
+            context = dict(context)
+            context['properties'] = property_dicts(self.context_properties, self.created)
+        if len(context) > 0:
+            write(b'{"context": ')
+            write(encode(context).encode('utf-8'))
+            write(b', "event": {')
+        else:
+            write(b'{"event": {')
+
+        separator = b''
+        for key, value in self.event.items():
+            write(separator)
+            separator = b', '
+            write(encode(key).encode('utf-8'))
+            write(b': ')
+            if key == 'payload' and len(self.payload_endpoints) > 0:
+                self._write_payload(write, encode, value)
+            elif isinstance(value, dict):
+                write(encode(value).encode('utf-8'))
+            else:
+                write(value.to_json(encode).encode('utf-8'))
+        write(b'}}')
+
+    def _write_payload(self, write, encode, payload):
+        write(b'{')
+        for key, value in payload.items():
+            if key == 'endpoints':
+                continue
+            write(encode(key).encode('utf-8'))
+            write(b': ')
+            write(encode(value).encode('utf-8'))
+            write(b', ')
+        write(b'"endpoints": [')
+        separator = b''
+        memo = {}
+        for endpoint in self.payload_endpoints:
+            write(separator)
+            separator = b', '
+            if isinstance(endpoint, dict):
+                write(encode(endpoint).encode('utf-8'))
+            else:
+                write(endpoint.to_json(encode, memo).encode('utf-8'))
+        write(b']}')
+
     def set_payload(self, payload):
         self.event['payload'] = payload
 
@@ -175,6 +292,48 @@ class StateResponse(AlexaResponse):
         self.context = kwargs.get('context', {"properties":[]})
 
 
+class ChangeReport(AlexaResponse):
+    # Proactive state event for the Alexa event gateway. token is the LWA
+    # access token of the user; changed properties go in the payload, the
+    # unchanged ones may be added to the context with add_context_property.
+    def __init__(self, **kwargs):
+        kwargs.update(namespace='Alexa', name='ChangeReport', payload={
+            'change': {
+                'cause': {'type': kwargs.get('cause', 'PHYSICAL_INTERACTION')},
+                'properties': []
+            }
+        })
+        kwargs.pop('cause', None)
+        super().__init__(**kwargs)
+        # Not an answer to a directive.
+        self.event['header'].correlation_token = None
+
+    def add_change_property(self, **kwargs):
+        self.event['payload']['change']['properties'].append(
+            self.create_context_property(**kwargs))
+
+
+class DeferredResponse(AlexaResponse):
+    # Answer now, the final Response event follows through the event gateway.
+    def __init__(self, **kwargs):
+        super().__init__(namespace='Alexa', name='DeferredResponse',
+                         correlationToken=kwargs.get('correlationToken', 'INVALID'),
+                         messageId=kwargs.get('messageId', str(uuid.uuid4())),
+                         payload={'estimatedDeferralInSeconds': kwargs.get('estimated_deferral', 5)})
+        self.event.pop('endpoint')
+
+
+class AddOrUpdateReport(AlexaResponse):
+    # Discovery event for endpoints added or changed outside a Discover, or
+    # that did not fit in the Discover.Response. token is the LWA access token.
+    def __init__(self, **kwargs):
+        super().__init__(namespace='Alexa.Discovery', name='AddOrUpdateReport',
+                         messageId=kwargs.get('messageId', None),
+                         payload={'scope': {'type': 'BearerToken', 'token': kwargs.get('token', 'INVALID')}})
+        self.event.pop('endpoint')
+        self.event['header'].correlation_token = None
+
+
 class ErrorResponse(AlexaResponse):
     def __init__(self, **kwargs):
         self.messageId = kwargs.get('messageId', str(uuid.uuid4()))
@@ -185,8 +344,15 @@ class ErrorResponse(AlexaResponse):
         super().__init__(payload={'type': self.typ, 'message': self.message},
                          namespace=kwargs.get('namespace', 'Alexa'),
                          name=kwargs.get('name', 'ErrorResponse'),
-                         messageId=self.messageId)
-        self.event.pop('endpoint')
+                         messageId=self.messageId,
+                         correlationToken=kwargs.get('correlationToken', 'INVALID'),
+                         endpointId=kwargs.get('endpointId', 'INVALID'),
+                         token=kwargs.get('token', 'INVALID'))
+        # Errors about an endpoint name it, so Alexa can match them.
+        if 'endpointId' not in kwargs:
+            self.event.pop('endpoint')
+        # Fields some error types add, e.g. validRange.
+        self.event['payload'].update(kwargs.get('details', {}))
 # Usage: pass arguments as json or use methods to populate request. Pass scope method as parameter for set_endpoint
 
 
@@ -264,13 +430,9 @@ class AlexaRequest:
         self.payload = kwargs.get('payload', {})
 
     def set_header(self, namespace, name, **kwargs):
-        self.header = {
-            "namespace": namespace,
-            "name": name,
-            "messageId": str(uuid.uuid4()),
-            "correlationToken": kwargs.get('correlationToken', str(uuid.uuid4())),
-            "payloadVersion": "3"
-        }
+        self.header = Header(namespace, name,
+                             correlation_token=kwargs.get('correlationToken', str(uuid.uuid4())),
+                             instance=kwargs.get('instance', None)).as_dict()
         return self
 
     def set_payload(self, payload, **kwargs):
@@ -323,9 +485,20 @@ class AlexaToggleRequest(AlexaRequest):
             endpointId, {"type": 'BearerToken', "token": token}, cookie=None)
 
     def set_header(self, namespace, name, instance):
-        super().set_header(namespace, name)
-        self.header['instance'] = instance
-        return self
+        return super().set_header(namespace, name, instance=instance)
+
+
+class AlexaThermostatRequest(AlexaRequest):
+    # SetTargetTemperature takes the new setpoint, AdjustTargetTemperature a
+    # delta, both as value and scale.
+    def __init__(self, endpointId, token, action="SetTargetTemperature", value=38.0, scale='CELSIUS', **kwargs):
+
+        super().__init__()
+        self.set_header(namespace="Alexa.ThermostatController", name=action)
+        self.set_endpoint(
+            endpointId, {"type": 'BearerToken', "token": token}, cookie=None)
+        key = 'targetSetpoint' if action == 'SetTargetTemperature' else 'targetSetpointDelta'
+        self.set_payload({key: {'value': value, 'scale': scale}})
 
 
 class AlexaAuthorizationRequest(AlexaRequest):
@@ -0,0 +1,146 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class TTLCache:
+    # LRU cache whose entries also expire after ttl seconds. Safe to share
+    # between threads; module level instances survive warm invocations.
+    def __init__(self, **kwargs):
+        self.ttl = kwargs.get('ttl', 300)
+        self.maxsize = kwargs.get('maxsize', 1024)
+        self.clock = kwargs.get('clock', time.monotonic)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires = item
+            if expires <= self.clock():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def _set(self, key, value, ttl=None):
+        # Caller holds the lock.
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (value, self.clock() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def _peek(self, key):
+        # Caller holds the lock. No stats, no LRU update.
+        item = self._data.get(key)
+        if item is None or item[1] <= self.clock():
+            return None
+        return item[0]
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+                return True
+            return False
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations
+            }
+
+    def __len__(self):
+        return len(self._data)
+
+
+def token_key(token):
+    # Bearer tokens are never stored, only their hash.
+    return hashlib.sha256(str(token).encode('utf-8')).hexdigest()
+
+
+class DiscoveryCache(TTLCache):
+    # Endpoint lists returned by DeviceCloud.device_discovery, per token hash.
+    def get_endpoints(self, token):
+        return self.get(token_key(token))
+
+    def set_endpoints(self, token, endpoints):
+        self.set(token_key(token), tuple(endpoints))
+
+    def invalidate_token(self, token):
+        if self.invalidate(token_key(token)):
+            logger.info('Discovery cache entry invalidated')
+
+
+class StateCache(TTLCache):
+    # Last known state per endpoint: {key: (value, time of sample)}, where key
+    # is the cloud state key ('lights') and the time is epoch seconds. An
+    # entry is complete when it comes from a full state read, partial updates
+    # (a Toggle, a partial fan-out) only refresh the keys they carry.
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.wall_clock = kwargs.get('wall_clock', time.time)
+
+    def update(self, endpoint_id, values, complete=False, sampled=None):
+        sampled = self.wall_clock() if sampled is None else sampled
+        with self._lock:
+            entry = None if complete else self._peek(endpoint_id)
+            samples = dict(entry[0]) if entry is not None else {}
+            samples.update((key, (value, sampled)) for key, value in values.items())
+            complete = complete or (entry is not None and entry[1])
+            self._set(endpoint_id, (samples, complete))
+        return samples
+
+    def get_fresh(self, endpoint_id, max_age):
+        # Samples of a complete entry whose oldest value is at most max_age
+        # seconds old, else None.
+        entry = self.get(endpoint_id)
+        if entry is None or not entry[1]:
+            return None
+        samples = entry[0]
+        now = self.wall_clock()
+        if any(now - sampled > max_age for _, sampled in samples.values()):
+            return None
+        return samples
+
+
+discovery_cache = DiscoveryCache(
+    ttl=float(os.getenv('discovery_cache_ttl', '300')),
+    maxsize=int(os.getenv('discovery_cache_size', '1024')))
+
+state_cache = StateCache(
+    ttl=float(os.getenv('state_cache_ttl', '300')),
+    maxsize=int(os.getenv('state_cache_size', '4096')))
@@ -0,0 +1,91 @@
+from lib.alexa_message import AlexaResponse, freeze
+from lib.instances import instances
+
+# Discovery capabilities are built once at import and shared, read-only, by
+# every endpoint and response.
+
+
+class CapabilityRegistry:
+    def __init__(self):
+        self._capabilities = {}
+        self._friendly_names = {}
+        self._sets = {}
+        # Instances each spa model has, see model_set.
+        self._models = {}
+        # Instances reported by one capability name each unless mapped here.
+        self._instances = {}
+        self.default_instances = ()
+
+    def register(self, name, **kwargs):
+        # kwargs are the ones taken by AlexaResponse.create_payload_endpoint_capability,
+        # plus friendly_name to build the capabilityResources block.
+        if 'friendly_name' in kwargs:
+            kwargs['capabilityResources'] = self.friendly_names(
+                kwargs.pop('friendly_name'))
+        capability = freeze(
+            AlexaResponse.create_payload_endpoint_capability(**kwargs))
+        self._capabilities[name] = capability
+        self._sets.clear()
+        return capability
+
+    def get(self, name):
+        return self._capabilities[name]
+
+    def friendly_names(self, text, locale='en-US'):
+        key = (text, locale)
+        resources = self._friendly_names.get(key)
+        if resources is None:
+            resources = freeze(AlexaResponse.create_capability_resources(
+                value_text=text, locale=locale))
+            self._friendly_names[key] = resources
+        return resources
+
+    def capability_set(self, *names):
+        # Tuples of capabilities are cached too, so endpoints with the same
+        # interfaces share one capabilities list.
+        capabilities = self._sets.get(names)
+        if capabilities is None:
+            capabilities = tuple(self._capabilities[name] for name in names)
+            self._sets[names] = capabilities
+        return capabilities
+
+    def register_model(self, model, *instances):
+        self._models[model] = tuple(instances)
+
+    def register_instance(self, instance, *names):
+        # A cloud instance advertised by several capabilities.
+        self._instances[instance] = tuple(names)
+        self._sets.clear()
+
+    def model_set(self, model=None, instances=None):
+        # Capabilities of one endpoint: its instances when the cloud reports
+        # them, else those of its model, else the defaults. Instances without
+        # a registered capability are left out.
+        if instances is None:
+            instances = self._models.get(model, self.default_instances)
+        names = tuple(name for instance in instances
+                      for name in self._instances.get(instance, (instance,))
+                      if name in self._capabilities)
+        return self.capability_set('Alexa', *names)
+
+    def __contains__(self, name):
+        return name in self._capabilities
+
+
+capabilities = CapabilityRegistry()
+
+# All discovery responses must include the Alexa interface
+capabilities.register('Alexa')
+# One capability per catalog instance, see lib.instances.
+for _instance in instances:
+    capabilities.register(_instance.name, **_instance.capability())
+# The heater: the setpoint and the water temperature it reads.
+capabilities.register_instance('Spa.Temp', 'Spa.Temp', 'Spa.WaterTemperature')
+
+# Endpoints the cloud tells nothing about keep the original Lights only set.
+capabilities.default_instances = ('Spa.Lights',)
+capabilities.register_model('ACC-100', 'Spa.Lights')
+capabilities.register_model('ACC-200', 'Spa.Lights', 'Spa.Jets')
+capabilities.register_model('ACC-300', 'Spa.Lights', 'Spa.Jets', 'Spa.Temp')
+capabilities.register_model('ACC-400', 'Spa.Lights', 'Spa.Jets', 'Spa.Blower',
+                            'Spa.Pump1', 'Spa.Pump2', 'Spa.Temp')
@@ -1,59 +1,258 @@
-import urllib.request
-import urllib.parse
+import asyncio
 from urllib.error import HTTPError
-from urllib import response
 import os
+import time
+from urllib.parse import quote
 
 import logging
 
+from lib import metrics
+from lib.instances import instances
+from lib.resilience import (CloudUnavailable, DeadlineExceeded, breakers, default_retry,
+                            is_failure, is_retryable, remaining_time)
+from lib.singleflight import AsyncSingleFlight, FlightStats, SingleFlight
+from lib.transport import default_transport, get_async_transport
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-class DeviceCloud:
-
+class CloudConfig:
+    # Device cloud address, read from the environment once per container.
     def __init__(self, **kwargs):
-        self.schema = os.getenv('cloud_schema')
-        self.host = os.getenv('cloud_host')
-        self.port = os.getenv('cloud_port')
+        self.schema = kwargs.get('schema', os.getenv('cloud_schema'))
+        self.host = kwargs.get('host', os.getenv('cloud_host'))
+        self.port = kwargs.get('port', os.getenv('cloud_port'))
         if self.port == '':
             self.url = f'{self.schema}://{self.host}'
         else:
             self.url = f'{self.schema}://{self.host}:{self.port}'
-        self.endpoints = {
-            "base": "spa",
-            "discovery": "discovery",
-            "update_state": "updatestate",
-            "report_state": "reportstate"
-        }
-
-    # Check if user exists in server, using accessToken provided by directive
-    def device_discovery(self, **kwargs):
+
+
+_config = None
+_async_cloud = None
+
+# Identical reads in flight at the same time share one request.
+coalesce = os.getenv('cloud_coalesce', '1').lower() in ('1', 'true', 'yes')
+flight_stats = FlightStats()
+flights = SingleFlight(stats=flight_stats)
+async_flights = AsyncSingleFlight(stats=flight_stats)
+
+
+def get_cloud_config():
+    global _config
+    if _config is None:
+        _config = CloudConfig()
+    return _config
+
+
+def reset_cloud_config():
+    # Re-read the environment on next use (tests, configuration reload).
+    global _config, _async_cloud
+    _config = None
+    _async_cloud = None
+
+
+def get_async_cloud():
+    # Shared AsyncDeviceCloud; it holds no per-loop state, the transport is
+    # resolved for the running loop on every request.
+    global _async_cloud
+    if _async_cloud is None:
+        _async_cloud = AsyncDeviceCloud()
+    return _async_cloud
+
+
+class DeviceCloud:
+    endpoints = {
+        "base": "spa",
+        "discovery": "discovery",
+        "devices": "devices",
+        "update_state": "updatestate",
+        "report_state": "reportstate"
+    }
+
+    def __init__(self, **kwargs):
+        # Pluggable transport, the shared keep-alive pool by default.
+        self.transport = kwargs.get('transport', default_transport)
+        self.timeout = kwargs.get('timeout', None)
+        # Retries apply to idempotent reads only, see get_request.
+        self.retry = kwargs.get('retry', default_retry)
+        self.coalesce = kwargs.get('coalesce', coalesce)
+        config = kwargs.get('config') or get_cloud_config()
+        self.schema = config.schema
+        self.host = config.host
+        self.port = config.port
+        self.url = config.url
+
+    def discovery_url(self, token, page=None):
         url = "/".join([self.url, self.endpoints['base'],
-                       self.endpoints['discovery'], kwargs.get('token')])
-        return self.get_request(url)
+                        self.endpoints['discovery'], token])
+        if page is not None:
+            url += '?page=' + quote(str(page), safe='')
+        return url
+
+    def device_info_url(self, endpoint_id):
+        return "/".join([self.url, self.endpoints['base'],
+                        self.endpoints['devices'], endpoint_id])
+
+    def update_state_url(self, instance, value, token):
+        device = instances.route(instance)
+        return "/".join([self.url, self.endpoints['base'],
+                        self.endpoints['update_state'], device, value, token])
+
+    def report_state_url(self, endpoint_id, subsystem=None):
+        parts = [self.url, self.endpoints['base'],
+                 self.endpoints['report_state'], endpoint_id]
+        if subsystem is not None:
+            parts.append(subsystem)
+        return "/".join(parts)
 
+    # Check if user exists in server, using accessToken provided by directive.
+    # Large accounts are paginated: pass the 'next' cursor of a page as page.
+    def device_discovery(self, **kwargs):
+        return self.get_request(self.discovery_url(kwargs.get('token'), kwargs.get('page')),
+                                idempotent=True)
+
+    # Endpoint metadata: model, friendly name and instances present.
+    def device_info(self, endpoint_id):
+        return self.get_request(self.device_info_url(endpoint_id), idempotent=True)
+
+    # Not retried: a TurnOn that timed out may still have been applied.
     def update_device_state(self, endpoint_id, instance, value, token):
-        device = instance.split(".")[1].lower()
-        url = "/".join([self.url, self.endpoints['base'],
-                       self.endpoints['update_state'], device, value, token])
-        return self.get_request(url)
+        return self.get_request(self.update_state_url(instance, value, token))
 
-    def report_state(self, endpoint_id):
-        url = "/".join([self.url, self.endpoints['base'],
-                       self.endpoints['report_state'], endpoint_id])
-        return self.get_request(url)
-
-    def get_request(self, url):
-        req = urllib.request.Request(url)
-        try:
-            logger.info('"Attempting connection to ')
-            with urllib.request.urlopen(req) as response:
-                the_page = response.read()
-            logger.info(f'GET {url} response status code: {response.status}')
+    # Whole endpoint state, or a single subsystem (e.g. 'lights') of it
+    def report_state(self, endpoint_id, subsystem=None):
+        return self.get_request(self.report_state_url(endpoint_id, subsystem), idempotent=True)
+
+    def get_breaker(self):
+        return breakers.get(self.url)
+
+    def call_timeout(self):
+        # Transport timeout capped by what is left of the directive deadline.
+        default = self.timeout
+        if default is None:
+            default = getattr(self.transport or get_async_transport(), 'timeout', None)
+        timeout = remaining_time(default)
+        if timeout is not None and timeout <= 0:
+            raise DeadlineExceeded('Directive deadline exceeded')
+        return timeout
+
+    def retry_delay(self, error, attempt, attempts):
+        # Seconds to wait before the next attempt, or None to give up.
+        if attempt + 1 >= attempts or not is_retryable(error):
+            return None
+        delay = self.retry.backoff(attempt)
+        remaining = remaining_time()
+        if remaining is not None and delay >= remaining:
+            return None
+        metrics.incr('cloud_retries')
+        logger.warning(f'Retrying cloud call in {delay:.3f}s after {error!r}')
+        return delay
+
+    def failed(self, url, error, started, breaker):
+        status = error.code if isinstance(error, HTTPError) else 0
+        metrics.record_cloud_call(url, status, 0, time.perf_counter() - started)
+        logger.error(f'GET {url} response error')
+        if is_failure(error):
+            breaker.record_failure()
+        else:
+            # The cloud answered (e.g. 404), so it is up.
+            breaker.record_success()
+
+    def unavailable(self, error):
+        # Connection errors and timeouts are raised as CloudUnavailable
+        # (ENDPOINT_UNREACHABLE); HTTPError and anything else propagate as is.
+        return is_failure(error) and not isinstance(error, (HTTPError, CloudUnavailable))
+
+    def get_request(self, url, idempotent=False):
+        # Reads for the same URL (endpoint id or token) share one request.
+        if idempotent and self.coalesce:
+            return flights.do(url, lambda: self.fetch(url, idempotent))
+        return self.fetch(url, idempotent)
+
+    def fetch(self, url, idempotent=False):
+        breaker = self.get_breaker()
+        attempts = max(1, self.retry.attempts) if idempotent else 1
+        for attempt in range(attempts):
+            try:
+                timeout = self.call_timeout()
+                breaker.allow()
+            except CloudUnavailable:
+                metrics.incr('cloud_rejected')
+                raise
+            started = time.perf_counter()
+            try:
+                logger.info('"Attempting connection to ')
+                status, the_page = self.transport.request(
+                    'GET', url, timeout=timeout)
+            except Exception as error:
+                self.failed(url, error, started, breaker)
+                delay = self.retry_delay(error, attempt, attempts)
+                if delay is None:
+                    if self.unavailable(error):
+                        raise CloudUnavailable(f'Device cloud unavailable: {error!r}') from error
+                    raise
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            metrics.record_cloud_call(url, status, len(the_page), time.perf_counter() - started)
+            logger.info(f'GET {url} response status code: {status}')
             return the_page
-        except urllib.error.HTTPError as HTTPError:
-            logger.error(f'GET {url} response error')
-            raise HTTPError
 
 
+class AsyncDeviceCloud(DeviceCloud):
+    # Same API as DeviceCloud, but every call is a coroutine. The transport
+    # defaults to the keep-alive pool of the running event loop.
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.transport = kwargs.get('transport', None)
+
+    async def device_discovery(self, **kwargs):
+        return await self.get_request(self.discovery_url(kwargs.get('token'), kwargs.get('page')),
+                                      idempotent=True)
+
+    async def device_info(self, endpoint_id):
+        return await self.get_request(self.device_info_url(endpoint_id), idempotent=True)
+
+    async def update_device_state(self, endpoint_id, instance, value, token):
+        return await self.get_request(self.update_state_url(instance, value, token))
+
+    async def report_state(self, endpoint_id, subsystem=None):
+        return await self.get_request(self.report_state_url(endpoint_id, subsystem), idempotent=True)
+
+    async def get_request(self, url, idempotent=False):
+        if idempotent and self.coalesce:
+            return await async_flights.do(url, lambda: self.fetch(url, idempotent))
+        return await self.fetch(url, idempotent)
+
+    async def fetch(self, url, idempotent=False):
+        transport = self.transport or get_async_transport()
+        breaker = self.get_breaker()
+        attempts = max(1, self.retry.attempts) if idempotent else 1
+        for attempt in range(attempts):
+            try:
+                timeout = self.call_timeout()
+                breaker.allow()
+            except CloudUnavailable:
+                metrics.incr('cloud_rejected')
+                raise
+            started = time.perf_counter()
+            try:
+                logger.info('"Attempting connection to ')
+                status, the_page = await transport.request(
+                    'GET', url, timeout=timeout)
+            except Exception as error:
+                self.failed(url, error, started, breaker)
+                delay = self.retry_delay(error, attempt, attempts)
+                if delay is None:
+                    if self.unavailable(error):
+                        raise CloudUnavailable(f'Device cloud unavailable: {error!r}') from error
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            metrics.record_cloud_call(url, status, len(the_page), time.perf_counter() - started)
+            logger.info(f'GET {url} response status code: {status}')
+            return the_page
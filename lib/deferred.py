@@ -0,0 +1,144 @@
+import asyncio
+import functools
+import json
+import os
+
+import logging
+
+from lib import metrics, token_store
+from lib.alexa_message import DeferredResponse, ErrorResponse
+from lib.event_loop import add_after_invocation
+from lib.events import flush_on_return, post_event
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Deferred responses. A slow directive (RequestHandler.deferrable) is answered
+# right away with Alexa.DeferredResponse; the directive itself runs as a job on
+# a worker, which posts the final Response event to the event gateway. Needs
+# the user's LWA token, so directives from users without one are answered
+# synchronously as before.
+
+enabled = os.getenv('deferred_responses', '0').lower() in ('1', 'true', 'yes')
+
+
+class LoopWorker:
+    # Runs jobs as tasks on the running event loop, for long-running
+    # processes. A Lambda container may be frozen once it returns, so if it is
+    # picked there pending jobs are drained before the invocation ends, and
+    # the directive does not return any earlier.
+    def __init__(self):
+        self._tasks = set()
+
+    async def submit(self, job):
+        task = asyncio.ensure_future(run_job(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def pending(self):
+        return len(self._tasks)
+
+    async def drain(self):
+        await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+class LambdaWorker:
+    # Runs each job in a new asynchronous (Event) invocation of this function,
+    # see lambda_function. boto3 ships with the Lambda Python runtime.
+    def __init__(self, **kwargs):
+        self.function_name = kwargs.get('function_name', os.getenv('AWS_LAMBDA_FUNCTION_NAME'))
+        self._client = kwargs.get('client', None)
+
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('lambda')
+        return self._client
+
+    async def submit(self, job):
+        invoke = functools.partial(self.client().invoke,
+                                   FunctionName=self.function_name,
+                                   InvocationType='Event',
+                                   Payload=json.dumps({'deferred': job}).encode('utf-8'))
+        await asyncio.get_running_loop().run_in_executor(None, invoke)
+
+    def pending(self):
+        return 0
+
+    async def drain(self):
+        pass
+
+
+def create_worker():
+    # In Lambda only another invocation lets the directive return early.
+    default = 'lambda' if os.getenv('AWS_LAMBDA_FUNCTION_NAME') else 'loop'
+    if os.getenv('deferred_worker', default) == 'lambda':
+        return LambdaWorker()
+    return LoopWorker()
+
+
+_worker = None
+
+
+def get_worker():
+    global _worker
+    if _worker is None:
+        _worker = create_worker()
+    return _worker
+
+
+def set_worker(worker):
+    global _worker
+    _worker = worker
+
+
+async def defer(handler):
+    # DeferredResponse once the job is handed off, None to answer synchronously.
+    token = handler.directive.token
+    if token is None or await token_store.access_token(token) is None:
+        return None
+    try:
+        await get_worker().submit({'request': handler.request, 'token': token})
+    except Exception:
+        logger.exception('Could not defer directive, answering synchronously')
+        return None
+    metrics.incr('deferred')
+    return DeferredResponse(correlationToken=handler.correlationToken,
+                            estimated_deferral=handler.estimated_deferral)
+
+
+async def run_job(job):
+    # Imported here, request_handler imports this module when deferring.
+    from lib.request_handler import RequestFactory
+
+    request = job['request']
+    try:
+        response = await RequestFactory().build_response_async(request, defer=False)
+    except Exception as error:
+        logger.exception('Deferred directive failed')
+        response = ErrorResponse(typ='INTERNAL_ERROR', message=repr(error),
+                                 correlationToken=request['directive']['header'].get('correlationToken', 'INVALID'))
+
+    access_token = await token_store.access_token(job['token'])
+    if access_token is None:
+        logger.error('No access token left for the deferred Response')
+        return False
+    # Events carry the LWA access token instead of the user's bearer token.
+    if 'endpoint' in response.event:
+        response.event['endpoint'].token = access_token
+    try:
+        await post_event(response, access_token)
+    except Exception as error:
+        logger.error(f'Deferred Response not delivered: {error!r}')
+        return False
+    return True
+
+
+@add_after_invocation
+async def drain_on_return():
+    worker = get_worker()
+    if worker.pending():
+        with metrics.phase('deferred'):
+            await worker.drain()
+        # The jobs may have queued change reports.
+        await flush_on_return()
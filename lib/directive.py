@@ -0,0 +1,146 @@
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Single pass parsing and validation of Smart Home v3 directives. The request
+# is walked once into a ParsedDirective that handlers read instead of indexing
+# the raw dict; anything malformed raises DirectiveError, which RequestFactory
+# answers with INVALID_DIRECTIVE before any handler or cloud call runs.
+
+
+class DirectiveError(ValueError):
+    def __init__(self, message, correlation_token=None):
+        super().__init__(message)
+        self.correlation_token = correlation_token
+
+
+class ParsedDirective:
+    __slots__ = ('namespace', 'name', 'instance', 'message_id', 'correlation_token',
+                 'payload_version', 'endpoint_id', 'token', 'cookie', 'payload', 'request')
+
+    def __init__(self, request, header, endpoint, payload):
+        self.request = request
+        self.namespace = header['namespace']
+        self.name = header['name']
+        self.instance = header.get('instance')
+        self.message_id = header.get('messageId')
+        self.correlation_token = header.get('correlationToken')
+        self.payload_version = header.get('payloadVersion')
+        self.payload = payload
+        self.endpoint_id = None
+        self.token = None
+        self.cookie = None
+        if endpoint:
+            self.endpoint_id = endpoint.get('endpointId')
+            self.cookie = endpoint.get('cookie')
+            scope = endpoint.get('scope')
+            if isinstance(scope, dict):
+                self.token = scope.get('token')
+        if self.token is None:
+            # Discover carries the token in payload.scope, AcceptGrant in payload.grantee.
+            scope = payload.get('scope') or payload.get('grantee')
+            if isinstance(scope, dict):
+                self.token = scope.get('token')
+
+    @property
+    def key(self):
+        return (self.namespace, self.name, self.instance)
+
+
+# Rules are (path, check) pairs, compiled once into validators. A path is a
+# dotted location in the directive, e.g. 'endpoint.scope.token'.
+def _present(value):
+    return True
+
+
+def _string(value):
+    return isinstance(value, str) and value != ''
+
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+CHECKS = {
+    'present': _present,
+    'string': _string,
+    'number': _number,
+}
+
+
+def compile_rule(path, check='string'):
+    keys = tuple(path.split('.'))
+    test = CHECKS[check]
+    message = {
+        'present': f'{path} is missing',
+        'string': f'{path} must be a non-empty string',
+        'number': f'{path} must be a number',
+    }[check]
+
+    def validate(directive):
+        value = directive
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                return f'{path} is missing'
+            value = value[key]
+        return None if test(value) else message
+
+    return validate
+
+
+ENDPOINT_RULES = (('endpoint.endpointId', 'string'), ('endpoint.scope.token', 'string'))
+
+_rules = {}
+
+
+def register_rules(namespace, name, *rules):
+    # rules: (path, check) pairs, check being 'string' (default), 'number' or 'present'.
+    _rules[(namespace, name)] = tuple(
+        compile_rule(*rule) if isinstance(rule, tuple) else compile_rule(rule) for rule in rules)
+
+
+register_rules('Alexa.Discovery', 'Discover', 'payload.scope.token')
+# Code and token are only checked for presence; LWA judges their values and
+# AcceptGrant answers ACCEPT_GRANT_FAILED.
+register_rules('Alexa.Authorization', 'AcceptGrant',
+               ('payload.grant.code', 'present'), ('payload.grantee.token', 'present'))
+register_rules('Alexa', 'ReportState', *ENDPOINT_RULES)
+for _name in ('TurnOn', 'TurnOff'):
+    register_rules('Alexa.ToggleController', _name, 'header.instance', *ENDPOINT_RULES)
+register_rules('Alexa.ModeController', 'SetMode', 'header.instance', *ENDPOINT_RULES, 'payload.mode')
+for _name, _key in (('SetTargetTemperature', 'targetSetpoint'),
+                    ('AdjustTargetTemperature', 'targetSetpointDelta')):
+    register_rules('Alexa.ThermostatController', _name, *ENDPOINT_RULES,
+                   (f'payload.{_key}.value', 'number'), f'payload.{_key}.scale')
+
+
+def parse_directive(request):
+    if not isinstance(request, dict) or not isinstance(request.get('directive'), dict):
+        raise DirectiveError('Directive not in message')
+    directive = request['directive']
+    header = directive.get('header')
+    if not isinstance(header, dict):
+        raise DirectiveError('Directive header missing')
+    correlation_token = header.get('correlationToken')
+
+    # Check the payload version.
+    if header.get('payloadVersion') != '3':
+        raise DirectiveError('This skill only supports Smart Home API version 3', correlation_token)
+    if not _string(header.get('namespace')) or not _string(header.get('name')):
+        raise DirectiveError('Directive namespace and name are required', correlation_token)
+
+    endpoint = directive.get('endpoint')
+    if endpoint is not None and not isinstance(endpoint, dict):
+        raise DirectiveError('endpoint must be an object', correlation_token)
+    payload = directive.get('payload')
+    if payload is None:
+        payload = {}
+    elif not isinstance(payload, dict):
+        raise DirectiveError('payload must be an object', correlation_token)
+
+    for validate in _rules.get((header['namespace'], header['name']), ()):
+        error = validate(directive)
+        if error is not None:
+            raise DirectiveError(error, correlation_token)
+    return ParsedDirective(request, header, endpoint, payload)
@@ -0,0 +1,85 @@
+import importlib
+import os
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def handler_path(handler):
+    return f'{handler.__module__}:{handler.__qualname__}'
+
+
+class LazyHandler:
+    # Placeholder for a handler class given as 'module:Class', imported on
+    # first lookup.
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        module, _, name = self.path.partition(':')
+        return getattr(importlib.import_module(module), name)
+
+    def __repr__(self):
+        return f'LazyHandler({self.path!r})'
+
+
+class HandlerRegistry:
+    # Dispatch table keyed by (namespace, name, instance). A handler
+    # registered without instance handles every instance of the directive.
+    def __init__(self):
+        self._table = {}
+
+    def add(self, handler, namespace, name, instance=None, replace=False):
+        key = (namespace, name, instance)
+        existing = self._table.get(key)
+        # The class a lazy entry points at may register itself when imported.
+        if existing is not None and not replace and not (
+                isinstance(existing, LazyHandler) and existing.path == handler_path(handler)):
+            raise ValueError(f'Handler already registered for {key}')
+        self._table[key] = handler
+        return handler
+
+    def add_lazy(self, path, namespace, name, instance=None, replace=False):
+        return self.add(LazyHandler(path), namespace, name, instance, replace)
+
+    def register(self, namespace, name, instance=None, replace=False):
+        # Class decorator, stackable to register several directives.
+        def decorator(handler):
+            return self.add(handler, namespace, name, instance, replace)
+        return decorator
+
+    def remove(self, namespace, name, instance=None):
+        return self._table.pop((namespace, name, instance), None)
+
+    def lookup(self, namespace, name, instance=None):
+        key = (namespace, name, instance)
+        handler = self._table.get(key)
+        if handler is None and instance is not None:
+            key = (namespace, name, None)
+            handler = self._table.get(key)
+        if isinstance(handler, LazyHandler):
+            handler = handler.load()
+            self._table[key] = handler
+        return handler
+
+    def keys(self):
+        return list(self._table)
+
+    def __contains__(self, key):
+        return key in self._table
+
+
+handlers = HandlerRegistry()
+register = handlers.register
+
+
+def load_handler_modules(modules=None):
+    # Extra handler modules (comma separated in handler_modules) register
+    # themselves on import.
+    if modules is None:
+        modules = os.getenv('handler_modules', '')
+    for module in filter(None, (m.strip() for m in modules.split(','))):
+        logger.info('Loading handler module %s', module)
+        importlib.import_module(module)
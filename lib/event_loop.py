@@ -0,0 +1,36 @@
+import asyncio
+import threading
+
+# Each thread keeps its own event loop alive between calls, so asyncio
+# connection pools survive warm invocations of the sync entry points.
+_local = threading.local()
+
+
+def get_event_loop():
+    loop = getattr(_local, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        _local.loop = loop
+    return loop
+
+
+def run_sync(coro):
+    # Run a coroutine to completion from synchronous code.
+    return get_event_loop().run_until_complete(coro)
+
+
+# Coroutine functions awaited at the end of every invocation, for work that
+# must finish before a Lambda container is frozen. Modules register their own
+# when first imported, so nothing runs for features never used.
+after_invocation = []
+
+
+def add_after_invocation(hook):
+    if hook not in after_invocation:
+        after_invocation.append(hook)
+    return hook
+
+
+async def run_after_invocation():
+    for hook in list(after_invocation):
+        await hook()
@@ -0,0 +1,204 @@
+import asyncio
+import io
+import os
+import threading
+from urllib.error import HTTPError
+
+import logging
+
+from lib import metrics, token_store
+from lib.alexa_message import ChangeReport
+from lib.event_loop import add_after_invocation
+from lib.instances import instances
+from lib.resilience import remaining_time
+from lib.transport import get_async_transport
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Proactive ChangeReport events. State changes (from Toggle, or from a cloud
+# webhook) are queued per endpoint; changes to the same endpoint within the
+# window are merged into one event, and each flush sends the queued events in
+# batches to the Alexa event gateway.
+
+DEFAULT_EVENT_GATEWAY_URL = 'https://api.amazonalexa.com/v3/events'
+
+
+def state_property(key, value, time_of_sample=None):
+    # Cloud state key ('lights') -> ChangeReport property kwargs, None for
+    # keys that are not in the instance catalog.
+    instance = instances.by_key(key)
+    if instance is None:
+        return None
+    return instance.property(value, time_of_sample)
+
+
+async def post_event(event, access_token, url=None, transport=None):
+    # POST one event (an AlexaResponse) to the event gateway. Raises
+    # HTTPError when the gateway rejects it.
+    buffer = io.BytesIO()
+    event.write(buffer)
+    url = url or os.getenv('event_gateway_url', DEFAULT_EVENT_GATEWAY_URL)
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+    transport = transport or get_async_transport()
+    return await transport.request('POST', url, buffer.getvalue(), headers)
+
+
+class PendingChange:
+    __slots__ = ('token', 'cause', 'properties')
+
+    def __init__(self, token, cause):
+        self.token = token
+        self.cause = cause
+        # (namespace, instance, name) -> property kwargs, latest value wins.
+        self.properties = {}
+
+
+class ChangeReportSender:
+    def __init__(self, **kwargs):
+        # Read at send time when not given, like the cloud address.
+        self.url = kwargs.get('url', None)
+        self.window = kwargs.get('window', float(os.getenv('change_report_window', '0.5')))
+        self.batch_size = kwargs.get('batch_size', int(os.getenv('change_report_batch_size', '20')))
+        self.enabled = kwargs.get(
+            'enabled', os.getenv('change_reports', '1').lower() in ('1', 'true', 'yes'))
+        # A Lambda container may be frozen as soon as it returns, so by default
+        # pending changes are sent before the invocation ends, waiting at most
+        # flush_timeout seconds: the directive response waits for the flush.
+        # Sends still running then are left on the loop, and a warm container
+        # finishes them on its next invocation.
+        self.flush_on_return = kwargs.get(
+            'flush_on_return', os.getenv('change_report_flush_on_return', '1').lower() in ('1', 'true', 'yes'))
+        self.flush_timeout = kwargs.get('flush_timeout', float(os.getenv('change_report_flush_timeout', '0.1')))
+        self.tokens = kwargs.get('tokens', None)
+        self.transport = kwargs.get('transport', None)
+        self.queued = self.coalesced = self.sent = self.failed = self.dropped = self.late = 0
+        self._pending = {}
+        self._timer = None
+        self._tasks = set()
+        self._lock = threading.Lock()
+
+    def enqueue(self, endpoint_id, token, properties, cause='PHYSICAL_INTERACTION'):
+        # token is the user's grantee (bearer) token, exchanged for the LWA
+        # access token on delivery.
+        if not self.enabled:
+            return
+        with self._lock:
+            change = self._pending.get(endpoint_id)
+            if change is None:
+                change = self._pending[endpoint_id] = PendingChange(token, cause)
+                self.queued += 1
+            else:
+                change.token = token
+                change.cause = cause
+                self.coalesced += 1
+            for prop in properties:
+                change.properties[(prop['namespace'], prop.get('instance'), prop['name'])] = prop
+        self._schedule()
+
+    def enqueue_state(self, endpoint_id, token, state, cause='PHYSICAL_INTERACTION', time_of_sample=None):
+        # state as returned by the cloud, e.g. {'lights': 'On'}.
+        properties = [state_property(key, value, time_of_sample) for key, value in state.items()]
+        self.enqueue(endpoint_id, token, [prop for prop in properties if prop is not None], cause)
+
+    def _schedule(self):
+        # Flush after the window on the running loop; without one, the caller
+        # flushes explicitly.
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        with self._lock:
+            if self._timer is None:
+                self._timer = loop.call_later(self.window, self._flush_later)
+
+    def _flush_later(self):
+        with self._lock:
+            self._timer = None
+        self._flush_task()
+
+    def _flush_task(self):
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def flush_within(self, timeout):
+        # Flush, waiting at most timeout seconds. False if sends are still
+        # running, they go on in the background.
+        done, _ = await asyncio.wait({self._flush_task()}, timeout=timeout)
+        if not done:
+            self.late += 1
+            metrics.incr('change_reports_late')
+            logger.warning(f'ChangeReports still sending after {timeout}s, finishing them in the background')
+        return bool(done)
+
+    def pending(self):
+        return len(self._pending)
+
+    async def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, self._pending = self._pending, {}
+        changes = list(pending.items())
+        for start in range(0, len(changes), self.batch_size):
+            batch = changes[start:start + self.batch_size]
+            await asyncio.gather(*(self.send(endpoint_id, change) for endpoint_id, change in batch))
+        return len(changes)
+
+    async def send(self, endpoint_id, change):
+        try:
+            if self.tokens is not None:
+                access_token = await self.tokens.get_access_token(change.token)
+            else:
+                access_token = await token_store.access_token(change.token)
+        except Exception as error:
+            access_token = None
+            logger.error('No access token for ChangeReport: %r', error)
+        if access_token is None:
+            # The user never granted access (AcceptGrant), nothing to send with.
+            self.dropped += 1
+            return False
+
+        report = ChangeReport(token=access_token, endpointId=endpoint_id, cause=change.cause)
+        for prop in change.properties.values():
+            report.add_change_property(**prop)
+        try:
+            await post_event(report, access_token, self.url, self.transport)
+        except HTTPError as http_error:
+            self.failed += 1
+            logger.error(f'ChangeReport for {endpoint_id} rejected: {http_error.code}')
+            return False
+        except Exception as error:
+            self.failed += 1
+            logger.error(f'ChangeReport for {endpoint_id} failed: {error!r}')
+            return False
+        self.sent += 1
+        metrics.incr('change_reports')
+        return True
+
+    def get_stats(self):
+        return {
+            'pending': len(self._pending),
+            'queued': self.queued,
+            'coalesced': self.coalesced,
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'late': self.late
+        }
+
+
+change_reports = ChangeReportSender()
+
+
+@add_after_invocation
+async def flush_on_return():
+    if change_reports.flush_on_return and change_reports.pending():
+        with metrics.phase('events'):
+            await change_reports.flush_within(remaining_time(change_reports.flush_timeout))
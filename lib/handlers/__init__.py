@@ -0,0 +1,2 @@
+# Built-in directive handlers. They are registered lazily in
+# lib.request_handler and imported on the first directive that needs them.
@@ -0,0 +1,61 @@
+from lib.alexa_message import AlexaResponse, ErrorResponse
+from lib.cache import discovery_cache
+from lib.dispatch import register
+from lib import lwa
+# LWA settings moved to lib.lwa, still importable from here.
+from lib.lwa import client_id, client_secret, lwa_token_url  # noqa: F401
+from lib.payload_log import mask
+from lib.request_handler import RequestHandler
+from lib.token_store import TokenStoreError, get_token_manager
+
+import logging
+from urllib.error import HTTPError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+@register('Alexa.Authorization', 'AcceptGrant')
+class AcceptGrant(RequestHandler):
+    async def build_response_async(self):
+        auth_code = self.directive.payload["grant"]["code"]
+        grantee_token = self.directive.token
+
+        # A (re)linked account may own a different set of spas.
+        discovery_cache.invalidate_token(grantee_token)
+
+        # The code can be exchanged only once: make sure the tokens can be
+        # kept before spending it.
+        try:
+            manager = get_token_manager()
+        except TokenStoreError as error:
+            logger.error(f'No token store: {error}')
+            return self.failed('The skill cannot store the LWA tokens.')
+
+        try:
+            lwa_tokens = await lwa.exchange_code(auth_code)
+        except HTTPError as http_error:
+            logger.error(
+                f"An error occurred: {http_error.read().decode('utf-8')}")
+            return self.failed("Failed to retrieve the LWA tokens from the user's auth code.")
+
+        try:
+            # Kept for events and async responses, see lib.token_store.
+            manager.save_grant(grantee_token, lwa_tokens)
+        except Exception:
+            logger.exception('Saving the LWA tokens failed')
+            return self.failed('Failed to store the LWA tokens.')
+        logger.info("Success!")
+        logger.info("access_token: %s", mask(lwa_tokens['access_token']))
+        logger.info("refresh_token: %s", mask(lwa_tokens['refresh_token']))
+        logger.info("token_type: %s", lwa_tokens['token_type'])
+        logger.info("expires_in: %s", lwa_tokens['expires_in'])
+
+        # Build the success response to send to Alexa
+        return AlexaResponse(namespace="Alexa.Authorization",
+                             name="AcceptGrant.Response",
+                             correlationToken=self.correlationToken)
+
+    def failed(self, message):
+        return ErrorResponse(namespace="Alexa.Authorization", typ='ACCEPT_GRANT_FAILED',
+                             correlationToken=self.correlationToken, message=message)
@@ -0,0 +1,145 @@
+from lib import metrics
+from lib.alexa_message import AddOrUpdateReport, ErrorResponse, DiscoveryResponse
+from lib.cache import discovery_cache
+from lib.capabilities import capabilities
+from lib.dispatch import register
+from lib.event_loop import add_after_invocation
+from lib.request_handler import RequestHandler
+from lib.resilience import CloudUnavailable
+
+import asyncio
+import logging
+import json
+import os
+from urllib.error import HTTPError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# AddOrUpdateReport events for endpoints past the Discover.Response limit.
+_reports = set()
+
+
+@register('Alexa.Discovery', 'Discover')
+class Discover(RequestHandler):
+    # Alexa takes at most 300 endpoints per Discover.Response (and per
+    # AddOrUpdateReport); the rest are sent as AddOrUpdateReport events.
+    max_endpoints = int(os.getenv('discovery_max_endpoints', '300'))
+    # Endpoint metadata reads in flight at once, per Discover.
+    concurrency = int(os.getenv('discovery_concurrency', '8'))
+    # Ask the cloud for model, name and instances of endpoints listed without them.
+    metadata = os.getenv('discovery_metadata', '1').lower() in ('1', 'true', 'yes')
+    # Guard against a cloud that keeps returning a next cursor.
+    max_pages = int(os.getenv('discovery_max_pages', '100'))
+
+    async def build_response_async(self):
+        discovery_response = DiscoveryResponse(
+            namespace='Alexa.Discovery', name='Discover.Response', correlationToken=self.correlationToken)
+
+        # Get user's information from cloud server with token provided in request,
+        # unless a recent Discover for the same token is cached.
+        token = self.directive.token
+        endpoints = discovery_cache.get_endpoints(token)
+        if endpoints is None:
+            try:
+                endpoints = await self.list_endpoints(token)
+            except HTTPError as http_error:
+                logger.error(
+                    f"An error occurred: {http_error.read().decode('utf-8')}")
+                return ErrorResponse(
+                    namespace='Alexa.Discovery',
+                    name='Discovery.ErrorResponse',
+                    typ='DISCOVERY_FAILED',
+                    message='Got HTTPError for directive request')
+            if self.metadata:
+                endpoints = await self.describe_endpoints(endpoints)
+            discovery_cache.set_endpoints(token, endpoints)
+
+        # Gather endpoints with response and send back to Alexa. Capabilities
+        # are prebuilt and shared per model, see lib.capabilities.
+        payload_endpoints = [self.payload_endpoint(endpoint) for endpoint in endpoints]
+        for endpoint in payload_endpoints[:self.max_endpoints]:
+            discovery_response.add_endpoint(endpoint)
+        if len(payload_endpoints) > self.max_endpoints:
+            self.report_overflow(token, payload_endpoints[self.max_endpoints:])
+        return discovery_response
+
+    async def list_endpoints(self, token):
+        # Follow the 'next' cursor of each page until the last one.
+        endpoints = []
+        page = None
+        seen = set()
+        for _ in range(self.max_pages):
+            body = json.loads(await self.server.device_discovery(token=token, page=page))
+            endpoints.extend(body['endpoints'])
+            page = body.get('next')
+            if not page or page in seen:
+                break
+            seen.add(page)
+        else:
+            logger.warning(f'Discovery stopped after {self.max_pages} pages')
+        return endpoints
+
+    async def describe_endpoints(self, endpoints):
+        # Metadata of the endpoints listed without it, read concurrently.
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def describe(endpoint):
+            if 'model' in endpoint or 'instances' in endpoint:
+                return endpoint
+            async with limit:
+                try:
+                    info = json.loads(await self.server.device_info(endpoint['endpoint_id']))
+                except (HTTPError, CloudUnavailable, ValueError) as error:
+                    # Still discovered, with the default capabilities.
+                    logger.warning(f"No metadata for {endpoint['endpoint_id']}: {error!r}")
+                    return endpoint
+            return dict(info, **endpoint)
+
+        return list(await asyncio.gather(*(describe(endpoint) for endpoint in endpoints)))
+
+    def payload_endpoint(self, endpoint):
+        kwargs = {'capabilities': capabilities.model_set(endpoint.get('model'), endpoint.get('instances'))}
+        if endpoint.get('friendly_name'):
+            kwargs['friendly_name'] = endpoint['friendly_name']
+        if endpoint.get('model'):
+            kwargs['model_name'] = endpoint['model']
+        return DiscoveryResponse.payload_endpoint(endpoint['endpoint_id'], **kwargs)
+
+    def report_overflow(self, token, endpoints):
+        task = asyncio.ensure_future(send_reports(token, endpoints, self.max_endpoints))
+        _reports.add(task)
+        task.add_done_callback(_reports.discard)
+
+
+async def send_reports(token, endpoints, size):
+    # Imported here, only large accounts need events and LWA tokens.
+    from lib.events import post_event
+    from lib import token_store
+
+    access_token = await token_store.access_token(token)
+    if access_token is None:
+        logger.error(f'{len(endpoints)} endpoints not discovered, no LWA token to report them with')
+        return 0
+
+    async def send(chunk):
+        report = AddOrUpdateReport(token=access_token)
+        for endpoint in chunk:
+            report.add_endpoint(endpoint)
+        try:
+            await post_event(report, access_token)
+        except Exception as error:
+            logger.error(f'AddOrUpdateReport failed: {error!r}')
+            return 0
+        metrics.incr('discovery_reports')
+        return len(chunk)
+
+    sent = await asyncio.gather(*(send(endpoints[start:start + size])
+                                  for start in range(0, len(endpoints), size)))
+    return sum(sent)
+
+
+@add_after_invocation
+async def drain_reports():
+    if _reports:
+        await asyncio.gather(*list(_reports), return_exceptions=True)
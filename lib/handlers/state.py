@@ -0,0 +1,117 @@
+from lib.alexa_message import StateResponse
+from lib.cache import state_cache
+from lib.dispatch import register
+from lib.event_loop import run_sync
+from lib.instances import instances
+from lib.request_handler import RequestHandler, cloud_error_type
+from lib.resilience import remaining_time
+
+import asyncio
+import logging
+import json
+import os
+import time
+from urllib.error import HTTPError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+@register('Alexa', 'ReportState')
+class ReportState(RequestHandler):
+    # Subsystems read in parallel, one cloud call each. Empty means a single
+    # read of the whole endpoint state.
+    subsystems = tuple(filter(None, os.getenv('report_state_subsystems', '').split(',')))
+    # Deadline in seconds for all the subsystem reads of one directive.
+    deadline = float(os.getenv('report_state_deadline', '2.0'))
+    # Cached state younger than this (seconds) is served without a cloud call.
+    freshness = float(os.getenv('state_cache_freshness', '5.0'))
+
+    def __init__(self, request, **kwargs):
+        super().__init__(request, **kwargs)
+        self.endpoint = self.directive.endpoint_id
+
+    async def build_response_async(self):
+        try:
+            properties = await self.get_properties_async()
+        except HTTPError as http_error:
+            logger.error(f'ReportState {self.endpoint} failed: {http_error}')
+            return self.error(cloud_error_type(http_error), str(http_error))
+        if properties is None:
+            return self.error('ENDPOINT_UNREACHABLE', 'No state read completed before the deadline')
+
+        state_response = StateResponse(
+            correlationToken=self.correlationToken, endpointId=self.endpoint)
+        for prop in properties:
+            state_response.add_context_property(**prop)
+        return state_response
+
+    def get_properties(self):
+        return run_sync(self.get_properties_async())
+
+    async def get_properties_async(self):
+        # Context property kwargs of the endpoint state, None when no read
+        # completed before the deadline. Cloud errors propagate.
+
+        # Serve from the state cache while fresh, Toggle writes through it.
+        samples = state_cache.get_fresh(self.endpoint, self.freshness)
+        partial = False
+        if samples is None:
+            try:
+                if self.subsystems:
+                    status, partial = await self.read_subsystems_async()
+                else:
+                    status = json.loads(await self.server.report_state(self.endpoint))
+            except Exception:
+                state_cache.invalidate(self.endpoint)
+                raise
+            if status is None:
+                state_cache.invalidate(self.endpoint)
+                return None
+            # A partial read keeps older cached values for the missing keys.
+            samples = state_cache.update(self.endpoint, status, complete=not partial)
+
+        # Report the real age of each value. Values from a partial read may
+        # also be out of step with the missing ones.
+        now = time.time()
+        minimum = int(self.deadline * 1000) if partial else 0
+        properties = []
+        for key, (value, sampled) in samples.items():
+            instance = instances.by_key(key)
+            if instance is None:
+                continue
+            properties.append(dict(instance.property(value, sampled),
+                                   uncertainty_in_milliseconds=max(minimum, int((now - sampled) * 1000))))
+        return properties
+
+    async def read_subsystems_async(self):
+        # Fan out one read per subsystem and merge whatever completes before
+        # the deadline. Returns (status, partial), status is None when nothing
+        # was read in time.
+        async def read(subsystem):
+            return json.loads(await self.server.report_state(self.endpoint, subsystem))
+
+        tasks = [asyncio.ensure_future(read(subsystem)) for subsystem in self.subsystems]
+        done, pending = await asyncio.wait(tasks, timeout=remaining_time(self.deadline))
+        for task in pending:
+            task.cancel()
+
+        status = {}
+        errors = []
+        for task in tasks:
+            if task in pending:
+                continue
+            if task.exception() is not None:
+                errors.append(task.exception())
+            else:
+                status.update(task.result())
+
+        partial = bool(pending or errors)
+        if partial:
+            logger.warning('ReportState %s: %d of %d subsystem reads missing',
+                           self.endpoint, len(pending) + len(errors), len(tasks))
+        if not status:
+            if errors:
+                raise errors[0]
+            return None, partial
+        return status, partial
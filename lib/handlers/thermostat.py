@@ -0,0 +1,233 @@
+from lib import metrics
+from lib.alexa_message import AlexaResponse
+from lib.cache import state_cache
+from lib.dispatch import register
+from lib.instances import instances
+from lib.request_handler import RequestHandler
+
+import asyncio
+import logging
+import json
+import os
+import time
+from urllib.error import HTTPError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# The heater's setpoint, see lib.instances. Its scale is the one the device
+# cloud reads and writes; the range the heater accepts is in that scale.
+heater = instances.get('Spa.Temp')
+cloud_scale = heater.scale
+setpoint_min = float(os.getenv('setpoint_min', '26'))
+setpoint_max = float(os.getenv('setpoint_max', '40'))
+
+
+def to_celsius(value, scale):
+    if scale == 'FAHRENHEIT':
+        return (value - 32) * 5 / 9
+    if scale == 'KELVIN':
+        return value - 273.15
+    return value
+
+
+def from_celsius(value, scale):
+    if scale == 'FAHRENHEIT':
+        return value * 9 / 5 + 32
+    if scale == 'KELVIN':
+        return value + 273.15
+    return value
+
+
+def convert(value, scale):
+    # Alexa temperature (value, scale) -> cloud scale, to one decimal.
+    return round(from_celsius(to_celsius(value, scale), cloud_scale), 1)
+
+
+def convert_delta(value, scale):
+    # Differences only scale: a Fahrenheit degree is 5/9 of the others.
+    if scale == 'FAHRENHEIT' and cloud_scale != 'FAHRENHEIT':
+        value = value * 5 / 9
+    elif scale != 'FAHRENHEIT' and cloud_scale == 'FAHRENHEIT':
+        value = value * 9 / 5
+    return value
+
+
+def in_range(value):
+    return setpoint_min <= value <= setpoint_max
+
+
+class SetpointOutOfRange(ValueError):
+    # An adjustment would take the setpoint outside the heater's range.
+    pass
+
+
+class NoHeater(LookupError):
+    # The spa's state has no setpoint to adjust.
+    pass
+
+
+class PendingSetpoint:
+    __slots__ = ('changes', 'write', 'read', 'task')
+
+    def __init__(self, write, read):
+        # ('set', setpoint) and ('adjust', delta), in arrival order.
+        self.changes = []
+        self.write = write
+        self.read = read
+        self.task = None
+
+
+class SetpointCoalescer:
+    # "Raise it by one degree" said three times in a row is one write of the
+    # final setpoint. Changes to an endpoint that arrive while its previous
+    # write is still in flight (or within window seconds) are applied in order
+    # and written together once it completes; every directive gets the final
+    # setpoint. Writes to one endpoint never overlap. An adjustment that would
+    # leave the heater's range is skipped and its directive gets
+    # SetpointOutOfRange.
+    # No window by default: a Lambda container gets one directive at a time and
+    # batches hand a whole run of them over at once (lib.request_handler), so
+    # waiting only adds latency. source.server sets one.
+    def __init__(self, **kwargs):
+        self.window = kwargs.get('window', float(os.getenv('setpoint_window', '0')))
+        self.writes = self.coalesced = 0
+        self._pending = {}
+        self._last = {}
+
+    async def submit(self, endpoint_id, change, write, read):
+        # write(setpoint) -> written setpoint; read() -> current setpoint,
+        # only called when the first change is relative.
+        key = (asyncio.get_running_loop(), endpoint_id)
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = PendingSetpoint(write, read)
+            entry.task = asyncio.ensure_future(self._run(key, entry, self._last.get(key)))
+            self._last[key] = entry.task
+            entry.task.add_done_callback(lambda task: self._done(key, task))
+        else:
+            # The latest directive's token and connection write the result.
+            entry.write = write
+            entry.read = read
+            self.coalesced += 1
+            metrics.incr('setpoint_coalesced')
+        index = len(entry.changes)
+        entry.changes.append(change)
+        setpoint, rejected = await asyncio.shield(entry.task)
+        if index in rejected:
+            raise SetpointOutOfRange(setpoint)
+        return setpoint
+
+    def _done(self, key, task):
+        if self._last.get(key) is task:
+            del self._last[key]
+
+    async def _run(self, key, entry, previous):
+        try:
+            await asyncio.sleep(self.window)
+            if previous is not None:
+                await asyncio.gather(previous, return_exceptions=True)
+        finally:
+            # Changes arriving from now on go to the next write, also when
+            # this one was cancelled.
+            if self._pending.get(key) is entry:
+                del self._pending[key]
+
+        setpoint = None
+        changed = False
+        rejected = set()
+        for index, (kind, value) in enumerate(entry.changes):
+            if kind == 'set':
+                setpoint = value
+                changed = True
+                continue
+            if setpoint is None:
+                setpoint = await entry.read()
+            if in_range(round(setpoint + value, 1)):
+                setpoint = round(setpoint + value, 1)
+                changed = True
+            else:
+                rejected.add(index)
+        if changed:
+            self.writes += 1
+            setpoint = await entry.write(setpoint)
+        return setpoint, rejected
+
+    def get_stats(self):
+        return {'pending': len(self._pending), 'writes': self.writes, 'coalesced': self.coalesced}
+
+
+setpoints = SetpointCoalescer()
+
+
+@register('Alexa.ThermostatController', 'SetTargetTemperature')
+@register('Alexa.ThermostatController', 'AdjustTargetTemperature')
+class Thermostat(RequestHandler):
+    # Spa controllers can take seconds to switch.
+    deferrable = True
+    # Directives to one endpoint in a batch are handed over together, see
+    # SetpointCoalescer.
+    coalesce = True
+    # A cached setpoint younger than this (seconds) is the base of an adjustment.
+    freshness = float(os.getenv('state_cache_freshness', '5.0'))
+
+    async def build_response_async(self):
+        endpoint_id = self.directive.endpoint_id
+        token = self.directive.token
+        payload = self.directive.payload
+
+        if self.directive.name == 'SetTargetTemperature':
+            setpoint = convert(payload['targetSetpoint']['value'], payload['targetSetpoint']['scale'])
+            if not in_range(setpoint):
+                return self.out_of_range()
+            change = ('set', setpoint)
+        else:
+            delta = payload['targetSetpointDelta']
+            change = ('adjust', convert_delta(delta['value'], delta['scale']))
+
+        async def write(value):
+            return await self.write_setpoint(endpoint_id, token, value)
+
+        async def read():
+            return await self.read_setpoint(endpoint_id)
+
+        try:
+            setpoint = await setpoints.submit(endpoint_id, change, write, read)
+        except SetpointOutOfRange:
+            return self.out_of_range()
+        except NoHeater:
+            return self.error('NOT_SUPPORTED_IN_CURRENT_MODE', f'{endpoint_id} has no heater',
+                              details={'currentDeviceMode': 'OTHER'})
+        except HTTPError as http_error:
+            return self.cloud_error(http_error)
+
+        thermostat_response = AlexaResponse(
+            namespace='Alexa', name='Response', token=token, correlationToken=self.correlationToken, endpointId=endpoint_id)
+        thermostat_response.add_context_property(**heater.property(setpoint))
+        return thermostat_response
+
+    async def write_setpoint(self, endpoint_id, token, setpoint):
+        response = json.loads(
+            await self.server.update_device_state(endpoint_id, heater.name, heater.encode(setpoint), token))
+        setpoint = float(response['status']['state'])
+        self.written({'setpoint': setpoint})
+        return setpoint
+
+    async def read_setpoint(self, endpoint_id):
+        entry = state_cache.get(endpoint_id)
+        if entry is not None and 'setpoint' in entry[0]:
+            value, sampled = entry[0]['setpoint']
+            if time.time() - sampled <= self.freshness:
+                return float(value)
+        status = json.loads(await self.server.report_state(endpoint_id))
+        state_cache.update(endpoint_id, status, complete=True)
+        if 'setpoint' not in status:
+            raise NoHeater(endpoint_id)
+        return float(status['setpoint'])
+
+    def out_of_range(self):
+        return self.error(
+            'TEMPERATURE_VALUE_OUT_OF_RANGE',
+            f'The setpoint must be between {setpoint_min:g} and {setpoint_max:g} {cloud_scale}',
+            details={'validRange': {'minimumValue': heater.decode(setpoint_min),
+                                    'maximumValue': heater.decode(setpoint_max)}})
@@ -0,0 +1,57 @@
+from lib.alexa_message import AlexaResponse
+from lib.dispatch import register
+from lib.instances import ModeInstance, instances
+from lib.request_handler import RequestHandler
+
+import logging
+import json
+from urllib.error import HTTPError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+@register('Alexa.ToggleController', 'TurnOn')
+@register('Alexa.ToggleController', 'TurnOff')
+class Toggle(RequestHandler):
+    # Spa controllers can take seconds to switch.
+    deferrable = True
+
+    def value(self):
+        # Directive value, validated against the instance.
+        return self.directive.name
+
+    def valid(self, instance):
+        return instance is not None and instance.namespace == self.directive.namespace
+
+    async def build_response_async(self):
+        endpoint_id = self.directive.endpoint_id
+        token = self.directive.token
+        instance = instances.get(self.directive.instance)
+        value = self.value()
+        if not self.valid(instance):
+            return self.error('INVALID_VALUE', f'{self.directive.instance} does not support {value}')
+
+        try:
+            response = json.loads(
+                await self.server.update_device_state(endpoint_id, instance.name, instance.encode(value), token))
+        except HTTPError as http_error:
+            # A 400 is a part or value this spa's model does not have.
+            return self.cloud_error(http_error)
+
+        self.written({instance.key: response['status']['state']})
+
+        toggle_response = AlexaResponse(
+            namespace='Alexa', name='Response', token=token, correlationToken=self.correlationToken, endpointId=endpoint_id)
+        toggle_response.add_context_property(**instance.property(response['status']['state']))
+        return toggle_response
+
+
+@register('Alexa.ModeController', 'SetMode')
+class Mode(Toggle):
+    # Pump speeds and other multi-value parts, same write path as Toggle.
+    def value(self):
+        return self.directive.payload['mode']
+
+    def valid(self, instance):
+        return isinstance(instance, ModeInstance) and self.value() in instance.values
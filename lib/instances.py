@@ -0,0 +1,160 @@
+import os
+
+# Catalog of the spa's controllable parts. Each instance maps its Alexa name
+# (Spa.Lights) to the interface and property it is reported with, the key of
+# its value in the cloud state ('lights'), the device segment of its cloud
+# update route and the encoding of its values. Toggle, SetMode, ReportState,
+# Discover and ChangeReport events all read this table, built once at import.
+
+
+class Instance:
+    # On/off part: TurnOn/TurnOff are sent to the cloud as they are, and the
+    # cloud state ('On', 'Off') is reported as it is.
+    namespace = 'Alexa.ToggleController'
+    property_name = 'toggleState'
+    # Reported under its instance name; interfaces without instances use None.
+    reports_instance = True
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.key = kwargs.get('key', name.split('.')[1].lower())
+        # None for read-only parts.
+        self.route = kwargs.get('route', self.key)
+        self.friendly_name = kwargs.get('friendly_name', name.replace('.', ' '))
+
+    def encode(self, value):
+        # Directive value -> value segment of the cloud update route.
+        return value
+
+    def decode(self, value):
+        # Cloud state value -> Alexa property value.
+        return value
+
+    def property(self, value, time_of_sample=None):
+        # Property kwargs, as taken by AlexaResponse.add_context_property.
+        return {
+            'namespace': self.namespace,
+            'instance': self.name if self.reports_instance else None,
+            'name': self.property_name,
+            'value': self.decode(value),
+            'time_of_sample': time_of_sample
+        }
+
+    def capability(self):
+        # Discovery capability kwargs, see CapabilityRegistry.register.
+        return {
+            'interface': self.namespace,
+            'instance': self.name,
+            'supported': [{'name': self.property_name}],
+            'friendly_name': self.friendly_name,
+            'proactively_reported': True,
+            'retrievable': True
+        }
+
+
+class ModeInstance(Instance):
+    # Multi-speed part: Alexa modes are '<prefix>.<cloud value>', e.g.
+    # 'Speed.High' for a pump the cloud sets to 'High'.
+    namespace = 'Alexa.ModeController'
+    property_name = 'mode'
+
+    def __init__(self, name, modes, **kwargs):
+        super().__init__(name, **kwargs)
+        self.prefix = kwargs.get('prefix', 'Speed')
+        self.modes = tuple(modes)
+        self.values = frozenset(f'{self.prefix}.{mode}' for mode in self.modes)
+
+    def encode(self, value):
+        return value[len(self.prefix) + 1:]
+
+    def decode(self, value):
+        return f'{self.prefix}.{value}'
+
+    def capability(self):
+        capability = super().capability()
+        capability['configuration'] = {
+            'ordered': True,
+            'supportedModes': [{
+                'value': f'{self.prefix}.{mode}',
+                'modeResources': {'friendlyNames': [
+                    {'@type': 'text', 'value': {'text': mode, 'locale': 'en-US'}}]}
+            } for mode in self.modes]
+        }
+        return capability
+
+
+class TemperatureInstance(Instance):
+    # Temperatures are numbers in the cloud and {value, scale} for Alexa.
+    reports_instance = False
+
+    def __init__(self, name, namespace, property_name, **kwargs):
+        super().__init__(name, **kwargs)
+        self.namespace = namespace
+        self.property_name = property_name
+        self.scale = kwargs.get('scale', os.getenv('temperature_scale', 'CELSIUS'))
+        self.configuration = kwargs.get('configuration', None)
+
+    def encode(self, value):
+        return f'{value:g}'
+
+    def decode(self, value):
+        return {'value': value, 'scale': self.scale}
+
+    def capability(self):
+        capability = super().capability()
+        del capability['instance'], capability['friendly_name']
+        capability['proactively_reported'] = self.route is not None
+        if self.configuration is not None:
+            capability['configuration'] = self.configuration
+        return capability
+
+
+class InstanceCatalog:
+    def __init__(self):
+        self._by_name = {}
+        self._by_key = {}
+
+    def register(self, instance):
+        self._by_name[instance.name] = instance
+        self._by_key[instance.key] = instance
+        return instance
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def by_key(self, key):
+        # Instance of a cloud state key, None for keys Alexa is not told about.
+        return self._by_key.get(key)
+
+    def route(self, name):
+        instance = self._by_name.get(name)
+        if instance is None:
+            # Instances of handler plugins: Spa.Sauna -> sauna.
+            return name.split('.')[1].lower()
+        if instance.route is None:
+            raise ValueError(f'{name} is read-only, the cloud has no update route for it')
+        return instance.route
+
+    def __iter__(self):
+        return iter(self._by_name.values())
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+
+instances = InstanceCatalog()
+
+instances.register(Instance('Spa.Lights'))
+instances.register(Instance('Spa.Jets'))
+instances.register(Instance('Spa.Blower'))
+# Pumps 1..spa_pumps, two speed.
+for _number in range(1, int(os.getenv('spa_pumps', '2')) + 1):
+    instances.register(ModeInstance(f'Spa.Pump{_number}', ('Off', 'Low', 'High'),
+                                    friendly_name=f'Pump {_number}'))
+# The heater: its setpoint, and the water temperature it reads.
+instances.register(TemperatureInstance('Spa.Temp', 'Alexa.ThermostatController', 'targetSetpoint',
+                                       key='setpoint', route='temp',
+                                       configuration={'supportedModes': ['HEAT'],
+                                                      'supportsScheduling': False}))
+instances.register(TemperatureInstance('Spa.WaterTemperature', 'Alexa.TemperatureSensor', 'temperature',
+                                       key='temperature', route=None))
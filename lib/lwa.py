@@ -0,0 +1,48 @@
+import json
+import os
+import urllib.parse
+
+import logging
+
+from lib.transport import get_async_transport
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Login With Amazon token endpoint client.
+
+client_id = os.getenv('lwa_client_id', 'alexa-id')
+client_secret = os.getenv('lwa_client_secret', 'alexa-secret')
+
+# The Login With Amazon API for getting access and refresh tokens from an auth code.
+# Skills hosted for the EU or FE regions may use their regional LWA host
+# (api.amazon.co.uk, api.amazon.co.jp).
+lwa_token_url = os.getenv('lwa_token_url', 'https://api.amazon.com/auth/o2/token')
+
+
+async def request_tokens(**params):
+    """
+    Response will contain the following:
+    - access_token: Used in events and asynchronous responses to directives that you send to the Alexa event gateway.
+    - refresh_token: Used to obtain a new access_token from LWA when this one expires.
+    - token_type: Expected token type is Bearer.
+    - expires_in: Number of seconds until access_token expires (expected to be 3600, or one hour).
+    Raises HTTPError when LWA rejects the request.
+    """
+    params.update(client_id=client_id, client_secret=client_secret)
+    data = urllib.parse.urlencode(params).encode("utf-8")
+    headers = {
+        "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8"
+    }
+    logger.info('LWA %s POST %s', params['grant_type'], lwa_token_url)
+    status, body = await get_async_transport().request(
+        "POST", lwa_token_url, data, headers)
+    return json.loads(body.decode("utf-8"))
+
+
+async def exchange_code(code):
+    return await request_tokens(grant_type="authorization_code", code=code)
+
+
+async def refresh_tokens(refresh_token):
+    return await request_tokens(grant_type="refresh_token", refresh_token=refresh_token)
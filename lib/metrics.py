@@ -0,0 +1,179 @@
+import contextvars
+import json
+import os
+import sys
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Per invocation timing. lambda_handler opens a MetricsRecord, the layers below
+# add phase timings and cloud calls to it, and the finished record is passed to
+# every registered hook (e.g. EMFEmitter). With no hooks registered no record
+# is opened and phase()/record_cloud_call() return right away.
+
+_current = contextvars.ContextVar('metrics_record', default=None)
+
+hooks = []
+
+
+class MetricsRecord:
+    def __init__(self, **dimensions):
+        self.dimensions = dimensions
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.cloud_calls = []
+        self.values = {}
+
+    def add_phase(self, name, elapsed):
+        # Phases seen several times (batch items, fan-out reads) add up.
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def add_cloud_call(self, url, status, size, elapsed):
+        self.cloud_calls.append((url, status, size, elapsed))
+        self.add_phase('cloud', elapsed)
+
+    def set_value(self, name, value):
+        self.values[name] = value
+
+    def incr(self, name, count=1):
+        self.values[name] = self.values.get(name, 0) + count
+
+    def as_dict(self):
+        record = dict(self.dimensions)
+        record['total_ms'] = (time.perf_counter() - self.started) * 1000
+        for name, elapsed in self.phases.items():
+            record[f'{name}_ms'] = elapsed * 1000
+        record['cloud_calls'] = len(self.cloud_calls)
+        record['cloud_status'] = [call[1] for call in self.cloud_calls]
+        record['cloud_bytes'] = sum(call[2] for call in self.cloud_calls)
+        record.update(self.values)
+        return record
+
+
+class _Phase:
+    __slots__ = ('record', 'name', 'started')
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.record.add_phase(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_phase = _NullPhase()
+
+
+def enabled():
+    return bool(hooks)
+
+
+def start(**dimensions):
+    # Returns (record, context token), or (None, None) when disabled.
+    if not hooks:
+        return None, None
+    record = MetricsRecord(**dimensions)
+    return record, _current.set(record)
+
+
+def finish(record, token):
+    if record is None:
+        return None
+    _current.reset(token)
+    data = record.as_dict()
+    for hook in list(hooks):
+        try:
+            hook(data)
+        except Exception:
+            logger.exception('Metrics hook failed')
+    return data
+
+
+def current():
+    return _current.get()
+
+
+def phase(name):
+    record = _current.get()
+    if record is None:
+        return _null_phase
+    return _Phase(record, name)
+
+
+def record_cloud_call(url, status, size, elapsed):
+    record = _current.get()
+    if record is not None:
+        record.add_cloud_call(url, status, size, elapsed)
+
+
+def set_value(name, value):
+    record = _current.get()
+    if record is not None:
+        record.set_value(name, value)
+
+
+def incr(name, count=1):
+    record = _current.get()
+    if record is not None:
+        record.incr(name, count)
+
+
+def add_hook(hook):
+    hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    if hook in hooks:
+        hooks.remove(hook)
+
+
+class EMFEmitter:
+    # CloudWatch Embedded Metric Format: one JSON line per invocation on
+    # stdout, which the Lambda log agent turns into metrics.
+    def __init__(self, **kwargs):
+        self.namespace = kwargs.get('namespace', os.getenv('metrics_namespace', 'SpaSkill'))
+        self.dimension = kwargs.get('dimension', 'directive')
+        self.stream = kwargs.get('stream', None)
+
+    def __call__(self, record):
+        metrics = [{'Name': key, 'Unit': 'Milliseconds'}
+                   for key in record if key.endswith('_ms')]
+        metrics.append({'Name': 'cloud_calls', 'Unit': 'Count'})
+        metrics.append({'Name': 'cloud_bytes', 'Unit': 'Bytes'})
+        if 'response_bytes' in record:
+            metrics.append({'Name': 'response_bytes', 'Unit': 'Bytes'})
+        document = dict(record)
+        document[self.dimension] = str(record.get(self.dimension))
+        document['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [[self.dimension]],
+                'Metrics': metrics
+            }]
+        }
+        stream = self.stream or sys.stdout
+        stream.write(json.dumps(document) + '\n')
+
+
+if os.getenv('metrics_emf', '0').lower() in ('1', 'true', 'yes'):
+    add_hook(EMFEmitter())
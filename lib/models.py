@@ -0,0 +1,221 @@
+import uuid
+from datetime import datetime, timezone
+
+# Compact model objects for the repeated parts of Alexa messages: headers,
+# endpoints, capabilities and properties. They hold only their fields
+# (__slots__, no per-instance dict) and turn into the Alexa JSON shape with
+# as_dict() when serialized. Instances that never change (shared capability
+# blocks, the EndpointHealth property) can be reused by every response.
+
+
+def utc_timestamp(seconds=None):
+    if seconds is not None:
+        return datetime.fromtimestamp(seconds, timezone.utc).isoformat()
+    return datetime.now(timezone.utc).isoformat()
+
+
+class Header:
+    __slots__ = ('namespace', 'name', 'message_id', 'correlation_token', 'payload_version', 'instance')
+
+    def __init__(self, namespace, name, message_id=None, correlation_token=None,
+                 payload_version='3', instance=None):
+        self.namespace = namespace
+        self.name = name
+        self.message_id = message_id or str(uuid.uuid4())
+        self.correlation_token = correlation_token
+        self.payload_version = payload_version
+        self.instance = instance
+
+    def as_dict(self):
+        header = {
+            'namespace': self.namespace,
+            'name': self.name,
+            'messageId': self.message_id,
+        }
+        if self.correlation_token is not None:
+            header['correlationToken'] = self.correlation_token
+        header['payloadVersion'] = self.payload_version
+        if self.instance is not None:
+            header['instance'] = self.instance
+        return header
+
+    def to_json(self, encode):
+        # Same text as encode(self.as_dict()), without the dict.
+        parts = ['{"namespace": ', encode(self.namespace), ', "name": ', encode(self.name),
+                 ', "messageId": ', encode(self.message_id)]
+        if self.correlation_token is not None:
+            parts.append(', "correlationToken": ')
+            parts.append(encode(self.correlation_token))
+        parts.append(', "payloadVersion": ')
+        parts.append(encode(self.payload_version))
+        if self.instance is not None:
+            parts.append(', "instance": ')
+            parts.append(encode(self.instance))
+        parts.append('}')
+        return ''.join(parts)
+
+
+class Endpoint:
+    # Directive or event endpoint: id, bearer token scope and cookie.
+    # with_cookie keeps a None cookie in the output.
+    __slots__ = ('endpoint_id', 'token', 'cookie', 'with_cookie')
+
+    def __init__(self, endpoint_id, token=None, cookie=None, with_cookie=False):
+        self.endpoint_id = endpoint_id
+        self.token = token
+        self.cookie = cookie
+        self.with_cookie = with_cookie
+
+    def as_dict(self, with_cookie=False):
+        endpoint = {
+            'scope': {'type': 'BearerToken', 'token': self.token},
+            'endpointId': self.endpoint_id
+        }
+        if with_cookie or self.with_cookie or self.cookie is not None:
+            endpoint['cookie'] = self.cookie
+        return endpoint
+
+    def to_json(self, encode):
+        # Same text as encode(self.as_dict()), without the dicts.
+        parts = ['{"scope": {"type": "BearerToken", "token": ', encode(self.token),
+                 '}, "endpointId": ', encode(self.endpoint_id)]
+        if self.with_cookie or self.cookie is not None:
+            parts.append(', "cookie": ')
+            parts.append(encode(self.cookie))
+        parts.append('}')
+        return ''.join(parts)
+
+
+class Property:
+    # Context (or change) property. time_of_sample is epoch seconds; None
+    # means the time passed to as_dict (the message time), else now.
+    __slots__ = ('namespace', 'name', 'value', 'instance', 'time_of_sample', 'uncertainty')
+
+    def __init__(self, namespace='Alexa.EndpointHealth', name='connectivity', value=None,
+                 instance='no-instance', time_of_sample=None, uncertainty=0):
+        self.namespace = namespace
+        self.name = name
+        self.value = {'value': 'OK'} if value is None else value
+        self.instance = instance
+        self.time_of_sample = time_of_sample
+        self.uncertainty = uncertainty
+
+    def as_dict(self, now=None, now_stamp=None):
+        # now_stamp: utc_timestamp(now), when the caller already has it.
+        if self.time_of_sample is not None:
+            stamp = utc_timestamp(self.time_of_sample)
+        else:
+            stamp = now_stamp or utc_timestamp(now)
+        prop = {
+            'namespace': self.namespace,
+            'name': self.name,
+            'value': self.value,
+            'instance': self.instance,
+            'timeOfSample': stamp,
+            'uncertaintyInMilliseconds': self.uncertainty
+        }
+        # Properties of interfaces without instances (ThermostatController).
+        if self.instance is None:
+            del prop['instance']
+        return prop
+
+
+def shared_json(value, encode, memo):
+    # JSON text of a block shared by several models, encoded once per memo.
+    # The memo keeps the value alive, so its id is not reused meanwhile.
+    item = memo.get(id(value))
+    if item is None or item[0] is not value:
+        item = memo[id(value)] = (value, encode(value))
+    return item[1]
+
+
+# Reported with every context property, see AlexaResponse.add_context_property.
+ENDPOINT_HEALTH = Property()
+
+
+class Capability:
+    __slots__ = ('interface', 'version', 'type', 'instance', 'supported',
+                 'proactively_reported', 'retrievable', 'capability_resources', 'configuration')
+
+    def __init__(self, interface='Alexa', version='3', type='AlexaInterface', instance=None,
+                 supported=None, proactively_reported=False, retrievable=False,
+                 capability_resources=None, configuration=None):
+        self.interface = interface
+        self.version = version
+        self.type = type
+        self.instance = instance
+        self.supported = supported
+        self.proactively_reported = proactively_reported
+        self.retrievable = retrievable
+        self.capability_resources = capability_resources
+        self.configuration = configuration
+
+    def as_dict(self):
+        capability = {
+            'type': self.type,
+            'interface': self.interface,
+            'version': self.version,
+        }
+        if self.instance is not None:
+            capability['instance'] = self.instance
+        if self.capability_resources is not None:
+            capability['capabilityResources'] = self.capability_resources
+        if self.supported:
+            capability['properties'] = {
+                'supported': self.supported,
+                'proactivelyReported': self.proactively_reported,
+                'retrievable': self.retrievable
+            }
+        if self.configuration is not None:
+            capability['configuration'] = self.configuration
+        return capability
+
+
+class DiscoveryEndpoint:
+    # One endpoint of a Discover.Response. capabilities, display_categories
+    # and additional_attributes are usually shared, read-only blocks.
+    __slots__ = ('endpoint_id', 'capabilities', 'description', 'display_categories',
+                 'friendly_name', 'manufacturer_name', 'additional_attributes', 'cookie')
+
+    def __init__(self, endpoint_id, capabilities=(), description='spa-description',
+                 display_categories=(), friendly_name='ACC Spa',
+                 manufacturer_name='Applied Computer Controls', additional_attributes=None,
+                 cookie=None):
+        self.endpoint_id = endpoint_id
+        self.capabilities = capabilities
+        self.description = description
+        self.display_categories = display_categories
+        self.friendly_name = friendly_name
+        self.manufacturer_name = manufacturer_name
+        self.additional_attributes = additional_attributes
+        self.cookie = cookie
+
+    def as_dict(self):
+        endpoint = {
+            'capabilities': self.capabilities,
+            'description': self.description,
+            'displayCategories': self.display_categories,
+            'endpointId': self.endpoint_id,
+            'friendlyName': self.friendly_name,
+            'manufacturerName': self.manufacturer_name,
+            'additionalAttributes': self.additional_attributes
+        }
+        if self.cookie is not None:
+            endpoint['cookie'] = self.cookie
+        return endpoint
+
+    def to_json(self, encode, memo):
+        # Same text as encode(self.as_dict()), with the shared blocks encoded
+        # once per message.
+        parts = ['{"capabilities": ', shared_json(self.capabilities, encode, memo),
+                 ', "description": ', encode(self.description),
+                 ', "displayCategories": ', shared_json(self.display_categories, encode, memo),
+                 ', "endpointId": ', encode(self.endpoint_id),
+                 ', "friendlyName": ', encode(self.friendly_name),
+                 ', "manufacturerName": ', encode(self.manufacturer_name),
+                 ', "additionalAttributes": ', shared_json(self.additional_attributes, encode, memo)]
+        if self.cookie is not None:
+            parts.append(', "cookie": ')
+            parts.append(encode(self.cookie))
+        parts.append('}')
+        return ''.join(parts)
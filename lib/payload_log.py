@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+
+# Request/response payload logging. Payloads are only serialized when a
+# record is actually emitted, full dumps are opt-in (log_payloads=1) and can
+# be sampled per directive name, e.g. log_sample_rates="ReportState=0.01,*=1".
+
+REDACTED_KEYS = frozenset(['token', 'access_token', 'refresh_token', 'code',
+                           'client_secret'])
+
+
+def mask(value):
+    # Keep the last 4 characters, enough to correlate log lines.
+    if value is None:
+        return None
+    value = str(value)
+    if len(value) <= 4:
+        return '***'
+    return '***' + value[-4:]
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {key: mask(item) if key in REDACTED_KEYS and not isinstance(item, (dict, list))
+                else redact(item)
+                for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+def parse_sample_rates(value):
+    rates = {}
+    for item in (value or '').split(','):
+        if '=' not in item:
+            continue
+        name, rate = item.split('=', 1)
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+class LazyPayload:
+    # Formats to one JSON line when (and only when) a log handler asks for it.
+    def __init__(self, kind, name, payload, max_bytes=2048):
+        self.kind = kind
+        self.name = name
+        self.payload = payload
+        self.max_bytes = max_bytes
+
+    def __str__(self):
+        payload = self.payload
+        if isinstance(payload, bytes):
+            # Serialized response, see AlexaResponse.serialize.
+            payload = json.loads(payload)
+        text = json.dumps(redact(payload), default=str)
+        record = {'kind': self.kind, 'directive': self.name}
+        if self.max_bytes and len(text) > self.max_bytes:
+            record['truncated'] = len(text)
+            record['payload'] = text[:self.max_bytes]
+            return json.dumps(record)
+        return json.dumps(record)[:-1] + ', "payload": ' + text + '}'
+
+
+class PayloadLogger:
+    def __init__(self, logger, **kwargs):
+        self.logger = logger
+        self.enabled = kwargs.get(
+            'enabled', os.getenv('log_payloads', '0').lower() in ('1', 'true', 'yes'))
+        self.rates = kwargs.get(
+            'rates', parse_sample_rates(os.getenv('log_sample_rates')))
+        self.max_bytes = kwargs.get(
+            'max_bytes', int(os.getenv('log_payload_max_bytes', '2048')))
+        self.random = kwargs.get('random', None)
+
+    def sampled(self, name):
+        rate = self.rates.get(name, self.rates.get('*', 1.0))
+        if rate >= 1.0:
+            return True
+        if rate <= 0.0:
+            return False
+        if self.random is None:
+            import random
+            self.random = random.random
+        return self.random() < rate
+
+    def log(self, kind, name, payload, level=logging.INFO):
+        if not self.enabled or not self.logger.isEnabledFor(level):
+            return False
+        if not self.sampled(name):
+            return False
+        self.logger.log(level, '%s', LazyPayload(kind, name, payload, self.max_bytes))
+        return True
+
+
+def directive_name(request):
+    try:
+        return request['directive']['header']['name']
+    except (KeyError, TypeError):
+        return None
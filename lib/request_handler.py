@@ -1,209 +1,261 @@
-from lib.alexa_message import AlexaResponse, ErrorResponse, DiscoveryResponse, StateResponse
-from lib.cloud_apis import DeviceCloud
-
+from lib import metrics
+from lib.alexa_message import AlexaResponse, ErrorResponse
+from lib.cloud_apis import get_async_cloud
+from lib.directive import DirectiveError, parse_directive
+from lib.dispatch import handlers, load_handler_modules
+from lib.event_loop import run_sync
+from lib.resilience import CloudUnavailable
+
+import asyncio
+import importlib
 import logging
-import json
-import urllib.request
-import urllib.parse
+import os
 from urllib.error import HTTPError
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-client_id = 'alexa-id'
-client_secret = 'alexa-secret'
-
-name_request = {'AcceptGrant': 'AcceptGrant',
-                'Discover': 'Discover',
-                'TurnOn': 'Toggle',
-                'TurnOff': 'Toggle',
-                'ReportState': 'ReportState'}
+# Built-in handlers, imported on the first directive that needs them.
+builtin_handlers = {
+    'lib.handlers.authorization:AcceptGrant': [('Alexa.Authorization', 'AcceptGrant')],
+    'lib.handlers.discovery:Discover': [('Alexa.Discovery', 'Discover')],
+    'lib.handlers.state:ReportState': [('Alexa', 'ReportState')],
+    'lib.handlers.toggle:Toggle': [('Alexa.ToggleController', 'TurnOn'),
+                                   ('Alexa.ToggleController', 'TurnOff')],
+    'lib.handlers.toggle:Mode': [('Alexa.ModeController', 'SetMode')],
+    'lib.handlers.thermostat:Thermostat': [('Alexa.ThermostatController', 'SetTargetTemperature'),
+                                           ('Alexa.ThermostatController', 'AdjustTargetTemperature')],
+}
+for path, keys in builtin_handlers.items():
+    for key in keys:
+        handlers.add_lazy(path, *key)
+
+
+def __getattr__(name):
+    # Handler classes used to live in this module; keep them importable from
+    # here without loading them at startup.
+    for path in builtin_handlers:
+        module, _, attribute = path.partition(':')
+        if attribute == name:
+            return getattr(importlib.import_module(module), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+# Maximum number of directive groups processed at once in a batch.
+batch_concurrency = int(os.getenv('batch_concurrency', '32'))
+
+
+def cloud_error_type(http_error):
+    # Alexa error type of a device cloud HTTPError: the cloud answers 404 for
+    # endpoints and tokens it does not know, 401/403 for tokens it refuses
+    # and other 4xx for values the spa does not take.
+    if http_error.code in (404, 410):
+        return 'NO_SUCH_ENDPOINT'
+    if http_error.code in (401, 403):
+        return 'INVALID_AUTHORIZATION_CREDENTIAL'
+    if 400 <= http_error.code < 500:
+        return 'INVALID_VALUE'
+    return 'ENDPOINT_UNREACHABLE'
+
+
+def batch_group_key(request, index):
+    # Directives for the same endpoint (or the same token for Discover) are
+    # grouped and run in order, different groups run concurrently.
+    try:
+        directive = request['directive']
+        endpoint = directive.get('endpoint') or {}
+        if endpoint.get('endpointId'):
+            return ('endpoint', endpoint['endpointId'])
+        scope = (directive.get('payload') or {}).get('scope') or {}
+        if scope.get('token'):
+            return ('token', scope['token'])
+    except (KeyError, TypeError, AttributeError):
+        pass
+    return ('item', index)
+
+
+def coalesces(request):
+    try:
+        directive = parse_directive(request)
+    except DirectiveError:
+        return False
+    return getattr(handlers.lookup(*directive.key), 'coalesce', False)
+
+
+def batch_runs(requests, indexes):
+    # A group's directives run one after the other, except that consecutive
+    # ones for a coalescing handler are started together, in order, so the
+    # handler can merge them.
+    runs = []
+    previous = False
+    for index in indexes:
+        current = coalesces(requests[index])
+        if runs and current and previous:
+            runs[-1].append(index)
+        else:
+            runs.append([index])
+        previous = current
+    return runs
 
 
 class RequestHandler():
-    def __init__(self, request):
+    # Slow handlers may answer with a DeferredResponse, see lib.deferred.
+    deferrable = False
+    # Handlers merging concurrent directives to one endpoint get a batch's
+    # consecutive ones at once, see batch_runs.
+    coalesce = False
+    # estimatedDeferralInSeconds sent to Alexa.
+    estimated_deferral = int(os.getenv('deferred_estimate', '5'))
+
+    def __init__(self, request, **kwargs):
         self.request = request
-        self.server = DeviceCloud()
-        self.correlationToken = self.request['directive']['header']['correlationToken']
+        # Parsed once by RequestFactory; parsed here for handlers built directly.
+        self.directive = kwargs.get('directive') or parse_directive(request)
+        self.server = kwargs.get('server') or get_async_cloud()
+        self.correlationToken = self.directive.correlation_token
 
+    # Sync API kept as a thin wrapper around the async handler.
     def handle_request(self):
-        return AlexaResponse().get()
+        return run_sync(self.handle_request_async())
 
+    async def handle_request_async(self):
+        with metrics.phase('build'):
+            response = await self.build_response_async()
+        return response.get()
 
-class AcceptGrant(RequestHandler):
-    def handle_request(self):
-        auth_code = self.request["directive"]["payload"]["grant"]["code"]
+    # Handlers build an AlexaResponse; get() or serialize() renders it.
+    async def build_response_async(self):
+        return AlexaResponse()
 
-        # The Login With Amazon API for getting access and refresh tokens from an auth code.
-        lwa_token_url = "https://api.amazon.com/auth/o2/token"
+    def error(self, typ, message, **kwargs):
+        # ErrorResponse naming the directive's endpoint, so Alexa can match it.
+        if self.directive.endpoint_id:
+            kwargs.update(endpointId=self.directive.endpoint_id, token=self.directive.token)
+        return ErrorResponse(typ=typ, message=message, correlationToken=self.correlationToken, **kwargs)
 
-        data = urllib.parse.urlencode(
-            {
-                "grant_type": "authorization_code",
-                "code": auth_code,
-                "client_id": client_id,
-                "client_secret": client_secret
-            }
-        ).encode("utf-8")
+    def cloud_error(self, http_error):
+        # ErrorResponse for a failed cloud write, see cloud_error_type.
+        typ = cloud_error_type(http_error)
+        if typ in ('NO_SUCH_ENDPOINT', 'INVALID_AUTHORIZATION_CREDENTIAL'):
+            from lib.cache import discovery_cache, state_cache
 
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8"
-        }
+            # The token may no longer own this spa.
+            discovery_cache.invalidate_token(self.directive.token)
+            state_cache.invalidate(self.directive.endpoint_id)
+        return self.error(typ, f'Got HTTPError for directive request: {http_error}')
 
-        logger.info(f'AcceptGrant POST data: {data}')
+    def written(self, state):
+        # State the cloud confirmed writing, {key: value} as in its state.
+        from lib.cache import state_cache
+        from lib.events import change_reports
 
-        url_request = urllib.request.Request(
-            lwa_token_url, data, headers, "POST")
+        # Write through, so ReportState can answer from the cache.
+        state_cache.update(self.directive.endpoint_id, state)
+        # Other Alexa devices of the user learn about it by ChangeReport.
+        change_reports.enqueue_state(self.directive.endpoint_id, self.directive.token, state,
+                                     cause='VOICE_INTERACTION')
 
-        try:
-            with urllib.request.urlopen(url_request) as response:
-                """
-                Response will contain the following:
-                - access_token: Used in events and asynchronous responses to directives that you send to the Alexa event gateway.
-                - refresh_token: Used to obtain a new access_token from LWA when this one expires.
-                - token_type: Expected token type is Bearer.
-                - expires_in: Number of seconds until access_token expires (expected to be 3600, or one hour).
-                """
-                lwa_tokens = json.loads(response.read().decode("utf-8"))
-
-                # TODO: Save the LWA tokens in a secure location, such as AWS Secrets Manager.
-                logger.info("Success!")
-                logger.info(f"access_token: {lwa_tokens['access_token']}")
-                logger.info(f"refresh_token: {lwa_tokens['refresh_token']}")
-                logger.info(f"token_type: {lwa_tokens['token_type']}")
-                logger.info(f"expires_in: {lwa_tokens['expires_in']}")
-        except HTTPError as http_error:
-            logger.error(
-                f"An error occurred: {http_error.read().decode('utf-8')}")
-            response = ErrorResponse(namespace="Alexa.Authorization",
-                                     typ='ACCEPT_GRANT_FAILED',
-                                     message="Failed to retrieve the LWA tokens from the user's auth code.")
-        else:
-            # Build the success response to send to Alexa
-            response = AlexaResponse(namespace="Alexa.Authorization",
-                                     name="AcceptGrant.Response",
-                                     correlationToken=self.correlationToken)
-        return response.get()
-
-
-class Discover(RequestHandler):
-    def handle_request(self):
-        discovery_response = DiscoveryResponse(
-            namespace='Alexa.Discovery', name='Discover.Response', correlationToken=self.correlationToken)
-
-        # Create the response and add capabilities.
-        capability_alexa = discovery_response.create_payload_endpoint_capability()
-
-        spa_lights_capability_resources = discovery_response.create_capability_resources(
-            value_text='Spa Lights')
-        capability_alexa_togglecontroller = discovery_response.create_payload_endpoint_capability(
-            interface='Alexa.ToggleController',
-            instance='Spa.Lights',
-            supported=[{'name': 'toggleState'}],
-            capabilityResources=spa_lights_capability_resources,
-            retrievable=True)
-
-        # Get user's information from cloud server with token provided in request
-        try:
-            toggle_response = json.loads(self.server.device_discovery(
-                token=self.request['directive']['payload']['scope']['token']))
-        except HTTPError as http_error:
-            logger.error(
-                f"An error occurred: {http_error.read().decode('utf-8')}")
-            return ErrorResponse(
-                namespace='Alexa.Discovery',
-                name='Discovery.ErrorResponse',
-                typ='DISCOVERY_FAILED',
-                message='Got HTTPError for directive request').get()
-
-        # Gather endpoints with response and send back to Alexa
-        for endpoint in toggle_response['endpoints']:
-            discovery_response.add_payload_endpoint(
-                endpoint['endpoint_id'],
-                capabilities=[capability_alexa,
-                              capability_alexa_togglecontroller])
-        return discovery_response.get()
-
-
-class ReportState(RequestHandler):
-    def __init__(self, request):
-        super().__init__(request)
-        self.endpoint = self.request['directive']['endpoint']['endpointId']
-        self.inst_namespace = {
-            "lights": "Alexa.ToggleController"
-        }
-        self.inst_name = {
-            "lights": "toggleState"
-        }
-
-    def handle_request(self):
-        state_response = StateResponse(
-            correlationToken=self.correlationToken, endpointId=self.endpoint)
-        status = json.loads(self.server.report_state(self.endpoint))
-        for key in status:
-            state_response.add_context_property(namespace=self.inst_namespace[key],
-                                                instance='Spa.'+key.capitalize(), name=self.inst_name[key], value=status[key])
-
-        return state_response.get()
-    
-    # TODO: unused
-    def get_properties(self):
-        response = json.loads(self.server.report_state(self.endpoint))
-        properties = []
-        for key in response:
-            prop = {}
-            # TODO: de donde saco el namespace y el name? de la directiva no porque es reportState. En algun lado tiene que haber
-            # un registro de las interfaces habilitadas para el endpoint. Deberian ser siempre las mismas.
-            prop['instance'] = 'Spa.' + key.capitalize()
-            prop['namespace'] = 'Alexa.ToggleController'
-            prop['name'] = 'toggleState'
-            prop['value'] = response[key].capitalize()
-            properties.append(prop)
-
-        return properties
-
-
-class Toggle(RequestHandler):
-    def handle_request(self):
-        endpoint_id = self.request['directive']['endpoint']['endpointId']
-        instance = self.request['directive']['header']['instance']
-        token = self.request['directive']['endpoint']['scope']['token']
-        value = self.request['directive']['header']['name']
-
-        try:
-            response = json.loads(
-                self.server.update_device_state(endpoint_id, instance, value, token))
-        except HTTPError:
-            return AlexaResponse(
-                namespace='Alexa.ToggleController',
-                name='ToggleController.ErrorResponse',
-                payload={'type': 'HTTP_ERROR', 'message': 'Got HTTPError for directive request. Token not found'}).get()
-
-        toggle_response = AlexaResponse(
-            namespace='Alexa', name='Response', token=token, correlationToken=self.correlationToken, endpointId=endpoint_id)
-        toggle_response.add_context_property(namespace="Alexa.ToggleController",
-                                             instance=instance, name='toggleState', value=response['status']['state'])
-        return toggle_response.get()
 
 # Error itself doesn't handle an interface request, but acts as an AlexaResponse wrapper for errors
 
 
 class RequestFactory():
+    # Sync API kept as a thin wrapper around the async pipeline.
     def create_request_response(self, request):
-        messageId = request['directive']['header']['messageId']
-        # Validate the request is an Alexa smart home directive.
-        if 'directive' not in request:
-            return ErrorResponse(typ='INVALID_DIRECTIVE', message='Directive not in message').get()
-
-        # Check the payload version.
-        payload_version = request['directive']['header']['payloadVersion']
-        if payload_version != '3':
-            return ErrorResponse(typ='INVALID_DIRECTIVE', message='This skill only supports Smart Home API version 3').get()
-
-        # Create handler for directive
-        name = request['directive']['header']['name']
+        return run_sync(self.create_request_response_async(request))
+
+    def create_batch_response(self, requests, **kwargs):
+        return run_sync(self.create_batch_response_async(requests, **kwargs))
+
+    async def create_batch_response_async(self, requests, **kwargs):
+        # All directives share one cloud client, and so one connection pool.
+        server = kwargs.get('server') or get_async_cloud()
+        limit = asyncio.Semaphore(kwargs.get('concurrency', batch_concurrency))
+        responses = [None] * len(requests)
+
+        groups = {}
+        for index, request in enumerate(requests):
+            groups.setdefault(batch_group_key(request, index), []).append(index)
+
+        async def run_group(indexes):
+            async with limit:
+                for run in batch_runs(requests, indexes):
+                    results = await asyncio.gather(*(
+                        self.create_safe_response_async(requests[index], server=server, defer=False)
+                        for index in run))
+                    for index, response in zip(run, results):
+                        responses[index] = response
+
+        await asyncio.gather(*(run_group(indexes) for indexes in groups.values()))
+        return responses
+
+    async def create_safe_response_async(self, request, **kwargs):
+        # A failing directive becomes an ErrorResponse instead of failing the batch.
+        try:
+            return await self.create_request_response_async(request, **kwargs)
+        except HTTPError as http_error:
+            logger.error(f'Batch directive failed: {http_error}')
+            return self.error_response(request, cloud_error_type(http_error), str(http_error)).get()
+        except Exception as error:
+            logger.exception('Batch directive failed')
+            return self.error_response(request, 'INTERNAL_ERROR', repr(error)).get()
+
+    @staticmethod
+    def error_response(request, typ, message):
+        # ErrorResponse carrying the directive's correlation token and endpoint.
         try:
-            targetclass = name_request[name]
-        except KeyError:
-            return ErrorResponse(typ='INVALID_DIRECTIVE', message='Unimplemented interface.').get()
-        return globals()[targetclass](request).handle_request()
+            directive = parse_directive(request)
+        except DirectiveError as error:
+            return ErrorResponse(typ=typ, message=message, correlationToken=error.correlation_token or 'INVALID')
+        kwargs = {}
+        if directive.endpoint_id:
+            kwargs.update(endpointId=directive.endpoint_id, token=directive.token)
+        return ErrorResponse(typ=typ, message=message,
+                             correlationToken=directive.correlation_token or 'INVALID', **kwargs)
+
+    async def create_request_response_async(self, request, **kwargs):
+        return (await self.build_response_async(request, **kwargs)).get()
+
+    def create_serialized_response(self, request, **kwargs):
+        return run_sync(self.create_serialized_response_async(request, **kwargs))
+
+    async def create_serialized_response_async(self, request, **kwargs):
+        # JSON bytes written straight from the response, without the get() dict.
+        return (await self.build_response_async(request, **kwargs)).serialize()
+
+    async def build_response_async(self, request, **kwargs):
+        with metrics.phase('validate'):
+            # Validate the request is an Alexa smart home v3 directive, see
+            # lib.directive. Malformed ones never reach a handler.
+            try:
+                directive = parse_directive(request)
+            except DirectiveError as error:
+                return ErrorResponse(typ='INVALID_DIRECTIVE', message=str(error),
+                                     correlationToken=error.correlation_token or 'INVALID')
+
+        with metrics.phase('dispatch'):
+            # Create handler for directive
+            handler = handlers.lookup(*directive.key)
+            if handler is None:
+                return ErrorResponse(typ='INVALID_DIRECTIVE', message='Unimplemented interface.',
+                                     correlationToken=directive.correlation_token or 'INVALID')
+            handler = handler(request, directive=directive, **kwargs)
+
+        # Includes the cloud calls, which are also reported on their own.
+        with metrics.phase('build'):
+            if handler.deferrable and kwargs.get('defer', True):
+                from lib import deferred
+
+                if deferred.enabled:
+                    response = await deferred.defer(handler)
+                    if response is not None:
+                        return response
+            try:
+                return await handler.build_response_async()
+            except CloudUnavailable as error:
+                # Cloud down, circuit open or out of time: answer right away.
+                logger.error(f'Device cloud unavailable: {error}')
+                return handler.error('ENDPOINT_UNREACHABLE', str(error))
+
+
+load_handler_modules()
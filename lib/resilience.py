@@ -0,0 +1,173 @@
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from urllib.error import HTTPError
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Deadlines, retries and circuit breakers for the device cloud calls.
+
+
+class CloudUnavailable(Exception):
+    # The device cloud could not be reached; handlers answer ENDPOINT_UNREACHABLE.
+    pass
+
+
+class CircuitOpenError(CloudUnavailable):
+    pass
+
+
+class DeadlineExceeded(CloudUnavailable):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds, clock=time.monotonic):
+        self.clock = clock
+        self.expires = clock() + seconds
+
+    def remaining(self):
+        return self.expires - self.clock()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+# Time kept back from the Lambda budget to build and return the response.
+deadline_reserve = float(os.getenv('deadline_reserve_ms', '500')) / 1000
+
+
+def deadline_from_context(context, reserve=None):
+    # Lambda context -> Deadline, or None outside Lambda.
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining is None:
+        return None
+    reserve = deadline_reserve if reserve is None else reserve
+    return Deadline(max(0.0, get_remaining() / 1000 - reserve))
+
+
+def set_deadline(deadline):
+    return _deadline.set(deadline)
+
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+
+def current_deadline():
+    return _deadline.get()
+
+
+def remaining_time(default=None):
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    remaining = deadline.remaining()
+    return remaining if default is None else min(default, remaining)
+
+
+def is_failure(error):
+    # Errors that count against the circuit breaker. A 4xx means the cloud is
+    # up and answered.
+    if isinstance(error, HTTPError):
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, (OSError, TimeoutError, asyncio.TimeoutError, CloudUnavailable))
+
+
+def is_retryable(error):
+    return is_failure(error) and not isinstance(error, (CircuitOpenError, DeadlineExceeded))
+
+
+class RetryPolicy:
+    # Bounded retries with full jitter exponential backoff.
+    def __init__(self, **kwargs):
+        self.attempts = kwargs.get('attempts', int(os.getenv('cloud_retry_attempts', '3')))
+        self.base = kwargs.get('base', float(os.getenv('cloud_retry_base', '0.05')))
+        self.cap = kwargs.get('cap', float(os.getenv('cloud_retry_cap', '1.0')))
+        self.random = kwargs.get('random', random.uniform)
+
+    def backoff(self, attempt):
+        return self.random(0, min(self.cap, self.base * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    # closed -> open after `failures` consecutive failures; open fails fast
+    # for `reset_timeout` seconds, then half-open lets one trial call through.
+    # Its result closes or reopens the circuit; a trial that never reports
+    # back (cancelled) is replaced after another reset_timeout.
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.failure_threshold = kwargs.get('failures', int(os.getenv('breaker_failures', '5')))
+        self.reset_timeout = kwargs.get('reset_timeout', float(os.getenv('breaker_reset_timeout', '30')))
+        self.clock = kwargs.get('clock', time.monotonic)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            now = self.clock()
+            if now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.opened_at = now
+                return
+        raise CircuitOpenError(f'Circuit open for {self.name}')
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info('Circuit for %s closed', self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning('Circuit for %s opened after %d failures',
+                                   self.name, self.failures)
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+
+class BreakerRegistry:
+    # One breaker per device cloud host, shared across warm invocations.
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(name, CircuitBreaker(name, **self.kwargs))
+        return breaker
+
+    def snapshot(self):
+        return {name: {'state': breaker.state, 'failures': breaker.failures}
+                for name, breaker in list(self._breakers.items())}
+
+    def clear(self):
+        with self._lock:
+            self._breakers.clear()
+
+
+breakers = BreakerRegistry()
+default_retry = RetryPolicy()
@@ -0,0 +1,118 @@
+import asyncio
+import threading
+
+import logging
+
+from lib import metrics
+from lib.resilience import DeadlineExceeded, remaining_time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Single-flight: concurrent callers asking for the same key share one call and
+# its result (or error) instead of each making their own. Keys only live while
+# the call is in flight, nothing is cached afterwards.
+
+
+class FlightStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.collapsed = 0
+
+    def incr(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return {'calls': self.calls, 'collapsed': self.collapsed}
+
+    def reset(self):
+        with self._lock:
+            self.calls = self.collapsed = 0
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # Thread mode. Followers wait for the leader, at most until their own
+    # directive deadline.
+    def __init__(self, **kwargs):
+        self.stats = kwargs.get('stats') or FlightStats()
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            self.stats.incr('collapsed')
+            metrics.incr('cloud_collapsed')
+            if not call.done.wait(remaining_time()):
+                raise DeadlineExceeded('Directive deadline exceeded waiting for a shared call')
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        self.stats.incr('calls')
+        try:
+            call.result = function()
+            return call.result
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class AsyncSingleFlight:
+    # asyncio mode. The shared call runs as its own task, so a caller that is
+    # cancelled (e.g. a ReportState fan-out deadline) does not cancel it for
+    # the others. Calls are keyed per event loop.
+    def __init__(self, **kwargs):
+        self.stats = kwargs.get('stats') or FlightStats()
+        self._calls = {}
+
+    async def do(self, key, factory):
+        key = (asyncio.get_running_loop(), key)
+        task = self._calls.get(key)
+        if task is None:
+            self.stats.incr('calls')
+            task = asyncio.ensure_future(factory())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        else:
+            self.stats.incr('collapsed')
+            metrics.incr('cloud_collapsed')
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), remaining_time())
+        except asyncio.TimeoutError:
+            if task.done():
+                raise
+            raise DeadlineExceeded('Directive deadline exceeded waiting for a shared call')
+
+    def _done(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the error as retrieved, every waiter may have gone.
+        if not task.cancelled():
+            task.exception()
+
+    def __len__(self):
+        return len(self._calls)
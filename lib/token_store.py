@@ -0,0 +1,272 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+
+import logging
+
+from lib import lwa
+from lib.cache import token_key
+from lib.singleflight import AsyncSingleFlight
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# LWA tokens per user, saved by AcceptGrant and used to send events to the
+# Alexa event gateway. Users are keyed by the hash of their grantee (bearer)
+# token, the same token Alexa puts in the directive scope.
+
+
+class TokenStoreError(RuntimeError):
+    # The token store is not configured, or configured unsafely.
+    pass
+
+
+class TokenStore(ABC):
+    # Storage backend: load/save/delete token dicts per user key.
+    @abstractmethod
+    def load(self, user):
+        pass
+
+    @abstractmethod
+    def save(self, user, tokens):
+        pass
+
+    @abstractmethod
+    def delete(self, user):
+        pass
+
+
+class MemoryTokenStore(TokenStore):
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def load(self, user):
+        with self._lock:
+            tokens = self._tokens.get(user)
+            return dict(tokens) if tokens is not None else None
+
+    def save(self, user, tokens):
+        with self._lock:
+            self._tokens[user] = dict(tokens)
+
+    def delete(self, user):
+        with self._lock:
+            self._tokens.pop(user, None)
+
+
+class KMSCipher:
+    # Encrypts token records with a KMS key. A record is a few hundred bytes,
+    # well under the 4 KB KMS takes directly, so no data key is needed. The
+    # user is the encryption context: a record moved to another user does not
+    # decrypt. boto3 ships with the Lambda Python runtime.
+    def __init__(self, key_id, **kwargs):
+        self.key_id = key_id
+        self._client = kwargs.get('client', None)
+
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('kms')
+        return self._client
+
+    def encrypt(self, user, text):
+        return self.client().encrypt(KeyId=self.key_id, Plaintext=text.encode('utf-8'),
+                                     EncryptionContext={'user': user})['CiphertextBlob']
+
+    def decrypt(self, user, blob):
+        return self.client().decrypt(CiphertextBlob=bytes(blob),
+                                     EncryptionContext={'user': user})['Plaintext'].decode('utf-8')
+
+
+class SQLiteTokenStore(TokenStore):
+    # Token records in a SQLite file only its owner can read (0600; SQLite
+    # gives its journal the same mode), encrypted with the KMS key
+    # token_store_kms_key. Plain JSON records need token_store_plaintext=1,
+    # for local runs. The file must outlive the container (an EFS mount in
+    # Lambda), so token_store_path has no default.
+    def __init__(self, **kwargs):
+        import sqlite3
+
+        self.path = kwargs.get('path', os.getenv('token_store_path'))
+        if not self.path:
+            raise TokenStoreError('token_store=sqlite needs token_store_path')
+        self.cipher = kwargs.get('cipher')
+        if self.cipher is None and os.getenv('token_store_kms_key'):
+            self.cipher = KMSCipher(os.getenv('token_store_kms_key'))
+        plaintext = kwargs.get('plaintext', os.getenv('token_store_plaintext', '0').lower() in ('1', 'true', 'yes'))
+        if self.cipher is None and not plaintext:
+            raise TokenStoreError('token_store=sqlite needs token_store_kms_key, '
+                                  'or token_store_plaintext=1 to keep tokens unencrypted')
+        # Created owner-only before SQLite opens it; tightened if it exists.
+        os.close(os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600))
+        os.chmod(self.path, 0o600)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS tokens '
+                             '(user TEXT PRIMARY KEY, record BLOB NOT NULL, updated REAL NOT NULL)')
+
+    def load(self, user):
+        with self._lock:
+            row = self._db.execute('SELECT record FROM tokens WHERE user = ?', (user,)).fetchone()
+        if row is None:
+            return None
+        try:
+            record = row[0] if self.cipher is None else self.cipher.decrypt(user, row[0])
+            return json.loads(record)
+        except Exception as error:
+            logger.error('Unreadable token record, ignoring it: %r', error)
+            return None
+
+    def save(self, user, tokens):
+        record = json.dumps(tokens)
+        if self.cipher is not None:
+            record = self.cipher.encrypt(user, record)
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO tokens (user, record, updated) VALUES (?, ?, ?)',
+                             (user, record, time.time()))
+
+    def delete(self, user):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM tokens WHERE user = ?', (user,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class TokenManager:
+    # Serves access tokens from memory until `refresh_margin` seconds before
+    # they expire. Inside that margin the token is still returned while a
+    # background refresh runs; once expired callers wait for the refresh.
+    # Concurrent refreshes for one user share a single LWA call.
+    def __init__(self, **kwargs):
+        self.store = kwargs.get('store') or MemoryTokenStore()
+        self.refresher = kwargs.get('refresher', lwa.refresh_tokens)
+        self.refresh_margin = kwargs.get('refresh_margin', float(os.getenv('token_refresh_margin', '300')))
+        self.clock = kwargs.get('clock', time.time)
+        self.refreshes = 0
+        self._cache = {}
+        self._flights = AsyncSingleFlight()
+        self._background = set()
+
+    def save_grant(self, grantee_token, lwa_tokens):
+        user = token_key(grantee_token)
+        self._save(user, lwa_tokens)
+        return user
+
+    def _save(self, user, lwa_tokens, previous=None):
+        tokens = {
+            'access_token': lwa_tokens['access_token'],
+            # LWA may leave the refresh token out of a refresh response.
+            'refresh_token': lwa_tokens.get('refresh_token') or (previous or {}).get('refresh_token'),
+            'token_type': lwa_tokens.get('token_type', 'bearer'),
+            'expires_at': self.clock() + float(lwa_tokens.get('expires_in', 3600))
+        }
+        self.store.save(user, tokens)
+        self._cache[user] = tokens
+        return tokens
+
+    def forget(self, grantee_token):
+        user = token_key(grantee_token)
+        self._cache.pop(user, None)
+        self.store.delete(user)
+
+    def _load(self, user):
+        tokens = self._cache.get(user)
+        if tokens is None:
+            tokens = self.store.load(user)
+            if tokens is not None:
+                self._cache[user] = tokens
+        return tokens
+
+    async def get_access_token(self, grantee_token):
+        # None when the user never granted access.
+        user = token_key(grantee_token)
+        tokens = self._load(user)
+        if tokens is None:
+            return None
+        left = tokens['expires_at'] - self.clock()
+        if left <= 0:
+            tokens = await self.refresh(user)
+            if tokens is None:
+                return None
+        elif left <= self.refresh_margin:
+            self.refresh_in_background(user)
+        return tokens['access_token']
+
+    async def refresh(self, user):
+        return await self._flights.do(user, lambda: self._refresh(user))
+
+    def refresh_in_background(self, user):
+        task = asyncio.ensure_future(self.refresh(user))
+        self._background.add(task)
+        task.add_done_callback(self._refreshed)
+
+    def _refreshed(self, task):
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Background token refresh failed: %r', task.exception())
+
+    async def _refresh(self, user):
+        # Re-read the store, another container may have refreshed already.
+        tokens = self.store.load(user) or self._cache.get(user)
+        if tokens is None:
+            # Forgotten (e.g. the skill was disabled) before the refresh ran.
+            return None
+        if tokens['expires_at'] - self.clock() > self.refresh_margin:
+            self._cache[user] = tokens
+            return tokens
+        self.refreshes += 1
+        lwa_tokens = await self.refresher(tokens['refresh_token'])
+        if self._load(user) is None:
+            # Forgotten while LWA answered: do not bring the grant back.
+            logger.info('LWA tokens forgotten during refresh, dropping them')
+            return None
+        logger.info('Refreshed LWA access token')
+        return self._save(user, lwa_tokens, tokens)
+
+
+def create_store(kind=None):
+    # token_store: 'sqlite', 'memory' (tests and local runs, lost on every
+    # cold start) or 'package.module:Class' for a TokenStore over a managed
+    # store. There is no default: without a store that outlives the container
+    # grants vanish and events silently stop, so an unset store is an error.
+    if kind is None:
+        kind = os.getenv('token_store')
+    if kind == 'sqlite':
+        return SQLiteTokenStore()
+    if kind == 'memory':
+        logger.warning('token_store=memory, LWA grants are lost when the container stops')
+        return MemoryTokenStore()
+    if kind and ':' in kind:
+        import importlib
+
+        module, _, name = kind.partition(':')
+        return getattr(importlib.import_module(module), name)()
+    raise TokenStoreError(f"token_store is {kind!r}: set it to 'sqlite', 'memory' or 'package.module:Class'")
+
+
+_manager = None
+
+
+def get_token_manager():
+    global _manager
+    if _manager is None:
+        _manager = TokenManager(store=create_store())
+    return _manager
+
+
+async def access_token(grantee_token):
+    # The user's LWA access token for events; None without one, or without a
+    # token store to keep it in.
+    try:
+        manager = get_token_manager()
+    except TokenStoreError as error:
+        logger.error(f'No token store: {error}')
+        return None
+    return await manager.get_access_token(grantee_token)
@@ -0,0 +1,418 @@
+import asyncio
+import io
+import os
+import threading
+import time
+import urllib.parse
+import weakref
+from urllib.error import HTTPError
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    if value is None or value == '':
+        return default
+    return float(value)
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    if value is None or value == '':
+        return default
+    return int(value)
+
+
+class TransportStats:
+    # Counters are shared by every pool of a transport, so they are guarded by
+    # a lock. Reads go through snapshot() to get a consistent view.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+        self.evicted = 0
+        self.discarded = 0
+        self.requests = 0
+
+    def incr(self, counter, amount=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'opened': self.opened,
+                'reused': self.reused,
+                'evicted': self.evicted,
+                'discarded': self.discarded,
+                'requests': self.requests
+            }
+
+    def reset(self):
+        with self._lock:
+            self.opened = self.reused = self.evicted = 0
+            self.discarded = self.requests = 0
+
+
+class UrllibTransport:
+    # Original behaviour: one urlopen (and one handshake) per request.
+    def __init__(self, **kwargs):
+        self.timeout = kwargs.get('timeout', None)
+        self.stats = TransportStats()
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        import urllib.request
+
+        req = urllib.request.Request(url, body, headers or {}, method)
+        timeout = timeout if timeout is not None else self.timeout
+        self.stats.incr('requests')
+        self.stats.incr('opened')
+        if timeout is None:
+            resp = urllib.request.urlopen(req)
+        else:
+            resp = urllib.request.urlopen(req, timeout=timeout)
+        with resp:
+            return resp.status, resp.read()
+
+
+class ConnectionPool:
+    # Idle keep-alive connections for a single (schema, host, port). Connections
+    # are handed out LIFO so the most recently used (least likely to have been
+    # closed by the server) socket is reused first.
+    def __init__(self, schema, host, port, **kwargs):
+        self.schema = schema
+        self.host = host
+        self.port = port
+        self.maxsize = kwargs.get('maxsize', 10)
+        self.timeout = kwargs.get('timeout', None)
+        self.idle_timeout = kwargs.get('idle_timeout', 60)
+        self.stats = kwargs.get('stats') or TransportStats()
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def new_connection(self, timeout=None):
+        # Imported here, the asyncio path does not need http.client.
+        import http.client
+
+        timeout = timeout if timeout is not None else self.timeout
+        if self.schema == 'https':
+            conn = http.client.HTTPSConnection(
+                self.host, self.port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(
+                self.host, self.port, timeout=timeout)
+        self.stats.incr('opened')
+        return conn
+
+    def get(self, timeout=None):
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used > self.idle_timeout:
+                    self._close(conn, 'evicted')
+                    continue
+                self.stats.incr('reused')
+                self.set_timeout(conn, timeout)
+                return conn, True
+        return self.new_connection(timeout), False
+
+    def set_timeout(self, conn, timeout=None):
+        conn.timeout = timeout if timeout is not None else self.timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(conn.timeout)
+
+    def put(self, conn):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append((conn, time.monotonic()))
+                return
+        self._close(conn, 'discarded')
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            keep = []
+            for conn, last_used in self._idle:
+                if now - last_used > self.idle_timeout:
+                    self._close(conn, 'evicted')
+                else:
+                    keep.append((conn, last_used))
+            self._idle = keep
+
+    def close(self):
+        with self._lock:
+            for conn, _ in self._idle:
+                conn.close()
+            self._idle = []
+
+    def _close(self, conn, counter):
+        self.stats.incr(counter)
+        conn.close()
+
+    def __len__(self):
+        return len(self._idle)
+
+
+class PooledTransport:
+    # Keep-alive transport. Pools are keyed by (schema, host, port) and live as
+    # long as the transport does, so a module level instance survives warm
+    # Lambda invocations.
+    def __init__(self, **kwargs):
+        self.maxsize = kwargs.get('maxsize', _env_int('cloud_pool_size', 10))
+        self.timeout = kwargs.get('timeout', _env_float('cloud_timeout', 5.0))
+        self.idle_timeout = kwargs.get(
+            'idle_timeout', _env_float('cloud_pool_idle_timeout', 60.0))
+        self.stats = TransportStats()
+        self.pools = {}
+        self._lock = threading.Lock()
+
+    def get_pool(self, schema, host, port):
+        key = (schema, host, port)
+        pool = self.pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self.pools.get(key)
+                if pool is None:
+                    pool = ConnectionPool(schema, host, port,
+                                          maxsize=self.maxsize,
+                                          timeout=self.timeout,
+                                          idle_timeout=self.idle_timeout,
+                                          stats=self.stats)
+                    self.pools[key] = pool
+        return pool
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        import http.client
+
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        pool = self.get_pool(parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path = f'{path}?{parts.query}'
+        headers = dict(headers or {})
+        headers.setdefault('Connection', 'keep-alive')
+
+        self.stats.incr('requests')
+        conn, reused = pool.get(timeout)
+        try:
+            status, reason, resp_headers, data, will_close = self._send(
+                conn, method, path, body, headers)
+        except (http.client.RemoteDisconnected, ConnectionResetError,
+                BrokenPipeError, http.client.CannotSendRequest):
+            conn.close()
+            if not reused:
+                raise
+            # The server dropped an idle keep-alive connection; retry once on
+            # a fresh one.
+            logger.info(f'Stale pooled connection to {parts.hostname}, reconnecting')
+            conn = pool.new_connection(timeout)
+            try:
+                status, reason, resp_headers, data, will_close = self._send(
+                    conn, method, path, body, headers)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        if will_close:
+            conn.close()
+        else:
+            pool.put(conn)
+
+        if status >= 400:
+            raise HTTPError(url, status, reason, resp_headers, io.BytesIO(data))
+        return status, data
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        data = resp.read()
+        return resp.status, resp.reason, resp.headers, data, resp.will_close
+
+    def evict_idle(self):
+        for pool in list(self.pools.values()):
+            pool.evict_idle()
+
+    def close(self):
+        for pool in list(self.pools.values()):
+            pool.close()
+
+    def get_stats(self):
+        stats = self.stats.snapshot()
+        stats['idle'] = sum(len(pool) for pool in list(self.pools.values()))
+        return stats
+
+
+class AsyncConnection:
+    # Minimal HTTP/1.1 client connection on top of asyncio streams.
+    def __init__(self, schema, host, port, **kwargs):
+        self.schema = schema
+        self.host = host
+        self.port = port
+        self.timeout = kwargs.get('timeout', None)
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        context = None
+        if self.schema == 'https':
+            import ssl
+            context = ssl.create_default_context()
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=context)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None, headers=None):
+        if self.writer is None:
+            await self.connect()
+
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}']
+        for key, value in (headers or {}).items():
+            lines.append(f'{key}: {value}')
+        if body is not None:
+            lines.append(f'Content-Length: {len(body)}')
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if body is not None:
+            self.writer.write(body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError(
+                'Remote end closed connection without response')
+        version, status, reason = (status_line.decode(
+            'latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        status = int(status)
+
+        # Header names are lower-cased, repeated headers keep the last value.
+        resp_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            resp_headers[name.strip().lower()] = value.strip()
+
+        connection = resp_headers.get('connection', '').lower()
+        will_close = connection == 'close' or (
+            version == 'HTTP/1.0' and connection != 'keep-alive')
+
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            data = b''
+        elif resp_headers.get('transfer-encoding', '').lower() == 'chunked':
+            data = await self._read_chunked()
+        elif 'content-length' in resp_headers:
+            data = await self.reader.readexactly(int(resp_headers['content-length']))
+        else:
+            data = await self.reader.read()
+            will_close = True
+        return status, reason, resp_headers, data, will_close
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                break
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readline()
+        # Skip trailers.
+        while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        return b''.join(chunks)
+
+
+class AsyncConnectionPool(ConnectionPool):
+    # Same bookkeeping as ConnectionPool, but with asyncio stream connections.
+    # Streams belong to the loop that opened them, see get_async_transport.
+    def new_connection(self, timeout=None):
+        timeout = timeout if timeout is not None else self.timeout
+        self.stats.incr('opened')
+        return AsyncConnection(self.schema, self.host, self.port, timeout=timeout)
+
+    def set_timeout(self, conn, timeout=None):
+        conn.timeout = timeout if timeout is not None else self.timeout
+
+
+class AsyncPooledTransport(PooledTransport):
+    def get_pool(self, schema, host, port):
+        key = (schema, host, port)
+        pool = self.pools.get(key)
+        if pool is None:
+            pool = AsyncConnectionPool(schema, host, port,
+                                       maxsize=self.maxsize,
+                                       timeout=self.timeout,
+                                       idle_timeout=self.idle_timeout,
+                                       stats=self.stats)
+            self.pools[key] = pool
+        return pool
+
+    async def request(self, method, url, body=None, headers=None, timeout=None):
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        pool = self.get_pool(parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path = f'{path}?{parts.query}'
+        headers = dict(headers or {})
+        headers.setdefault('Connection', 'keep-alive')
+
+        self.stats.incr('requests')
+        conn, reused = pool.get(timeout)
+        try:
+            status, reason, resp_headers, data, will_close = await asyncio.wait_for(
+                conn.request(method, path, body, headers), conn.timeout)
+        except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+            conn.close()
+            if not reused:
+                raise
+            logger.info(f'Stale pooled connection to {parts.hostname}, reconnecting')
+            conn = pool.new_connection(timeout)
+            try:
+                status, reason, resp_headers, data, will_close = await asyncio.wait_for(
+                    conn.request(method, path, body, headers), conn.timeout)
+            except BaseException:
+                conn.close()
+                raise
+        except BaseException:
+            # Includes timeouts and cancellation: the stream is in an unknown
+            # state and cannot go back to the pool.
+            conn.close()
+            raise
+
+        if will_close:
+            conn.close()
+        else:
+            pool.put(conn)
+
+        if status >= 400:
+            raise HTTPError(url, status, reason, resp_headers, io.BytesIO(data))
+        return status, data
+
+
+# Module level so connections survive between warm invocations.
+default_transport = PooledTransport()
+
+_async_transports = weakref.WeakKeyDictionary()
+
+
+def get_async_transport(loop=None):
+    # One asyncio transport per event loop.
+    loop = loop or asyncio.get_running_loop()
+    transport = _async_transports.get(loop)
+    if transport is None:
+        transport = AsyncPooledTransport()
+        _async_transports[loop] = transport
+    return transport
@@ -12,37 +12,103 @@
 # language governing permissions and limitations under the License.
 
 
-import json
 import logging
-import datetime
-from datetime import datetime, timezone
 
 # local modules
 from lib.request_handler import RequestFactory
+from lib.event_loop import run_after_invocation, run_sync
+from lib import metrics
+from lib import resilience
+from lib.payload_log import PayloadLogger, directive_name
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Full request/response dumps are opt-in, see lib.payload_log.
+payload_log = PayloadLogger(logger)
+
 
 def lambda_handler(request, context):
+    return run_sync(async_lambda_handler(request, context))
+
+
+async def async_lambda_handler(request, context, run_hooks=True, serialize=False):
+    # serialize: a single directive's response comes back as JSON bytes,
+    # written by AlexaResponse.serialize, for callers that send it on.
+    # Anything but a dict or a list is a malformed directive, see RequestFactory.
+    keys = request if isinstance(request, dict) else ()
+    if isinstance(request, list) or 'directives' in keys:
+        name = 'Batch'
+    elif 'webhook' in keys:
+        name = 'Webhook'
+    elif 'deferred' in keys:
+        name = 'Deferred'
+    else:
+        name = directive_name(request)
+    record, token = metrics.start(directive=name)
+    # Cloud calls share what is left of the Lambda timeout, see lib.resilience.
+    deadline_token = resilience.set_deadline(resilience.deadline_from_context(context))
+    try:
+        response = await handle_directive(request, context, name, serialize)
+        # Deferred jobs, change reports, see lib.event_loop. Long-running
+        # processes run them on their own loop instead, see source.server.
+        if run_hooks:
+            await run_after_invocation()
+        return response
+    finally:
+        resilience.reset_deadline(deadline_token)
+        metrics.finish(record, token)
 
+
+async def handle_directive(request, context, name, serialize=False):
     # Dump the request for logging - check the CloudWatch logs.
-    logger.info('lambda_handler request  -----')
-    logger.info(json.dumps(request))
+    payload_log.log('request', name, request)
 
     if context is not None:
-        logger.info('lambda_handler context  -----')
-        logger.info(context)
+        logger.info('lambda_handler context: %s', context)
     else:
         logger.info('lambda_handler context is None')
 
-    response = RequestFactory().create_request_response(request)
-    return send_response(response)
+    if name == 'Webhook':
+        return send_response(handle_webhook(request['webhook']), name)
+
+    # Job of a deferred directive, see lib.deferred.LambdaWorker.
+    if name == 'Deferred':
+        from lib import deferred
+
+        return send_response({'delivered': await deferred.run_job(request['deferred'])}, name)
+
+    # Batch mode: a list of directives, or {"directives": [...]}.
+    if name == 'Batch':
+        directives = request if isinstance(request, list) else request['directives']
+        responses = await RequestFactory().create_batch_response_async(directives)
+        return send_response({'responses': responses}, name)
+
+    if serialize:
+        response = await RequestFactory().create_serialized_response_async(request)
+    else:
+        response = await RequestFactory().create_request_response_async(request)
+    return send_response(response, name)
+
+
+def handle_webhook(webhook):
+    # State change pushed by the device cloud:
+    # {"webhook": {"endpointId": ..., "token": ..., "state": {"lights": "On"}}}
+    # Only reachable through the function's own triggers, not from Alexa.
+    from lib.events import change_reports
+
+    try:
+        change_reports.enqueue_state(webhook['endpointId'], webhook['token'], webhook['state'])
+    except (KeyError, TypeError, AttributeError):
+        return {'queued': False, 'error': 'endpointId, token and state are required'}
+    return {'queued': True}
 
 # Send the response
 
 
-def send_response(response):
-    print('lambda_handler response -----')
-    print(json.dumps(response))
+def send_response(response, name=None):
+    # The Lambda runtime serializes the response; response_bytes is only
+    # recorded where this code produces the bytes (serialize=True), see
+    # AlexaResponse.serialize.
+    payload_log.log('response', name, response)
     return response
@@ -0,0 +1,439 @@
+# Standalone HTTP entry point: serves the same directives as lambda_handler
+# from a pool of pre-forked worker processes, for soak tests on one box and
+# as an on-prem fallback when Lambda is throttled. Linux/macOS only (fork).
+#
+# Usage:
+#   python -m source.server                        # one worker per core on 127.0.0.1:8080
+#   python -m source.server --port 9000 --workers 4
+#
+# Routes:
+#   POST /          a directive (or batch, webhook) -> its response, as JSON
+#   GET  /health    200 while the worker accepts requests, 503 while stopping
+#   GET  /metrics   request counters of every worker, and the pools, breakers
+#                   and coalesced reads of the worker answering
+#
+# Signals to the parent: SIGHUP starts a new generation of workers, which
+# import the code afresh, and then stops the old one gracefully; SIGTERM or
+# SIGINT stop all workers gracefully. A worker that stops finishes its
+# requests in flight and its pending events before exiting.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from multiprocessing.sharedctypes import RawArray
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Per worker slot in the shared stats array.
+FIELDS = ('pid', 'generation', 'started', 'ready', 'requests', 'errors', 'in_flight', 'latency_ms')
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           411: 'Length Required', 413: 'Payload Too Large', 500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+
+
+class RequestContext:
+    # Stands in for the Lambda context: the time left to answer one request,
+    # see lib.resilience.deadline_from_context.
+    def __init__(self, timeout):
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+    def __repr__(self):
+        return f'RequestContext(remaining_ms={self.get_remaining_time_in_millis()})'
+
+
+class WorkerStats:
+    # Counters of every worker in shared memory. Each worker only writes its
+    # own slot, so no lock is needed; any worker can read them all.
+    def __init__(self, slots):
+        self.slots = slots
+        self._values = RawArray('d', slots * len(FIELDS))
+
+    def reset(self, slot, pid, generation):
+        base = slot * len(FIELDS)
+        for index in range(len(FIELDS)):
+            self._values[base + index] = 0
+        self.set(slot, 'pid', pid)
+        self.set(slot, 'generation', generation)
+        self.set(slot, 'started', time.time())
+
+    def set(self, slot, field, value):
+        self._values[slot * len(FIELDS) + FIELDS.index(field)] = value
+
+    def add(self, slot, field, amount=1):
+        self._values[slot * len(FIELDS) + FIELDS.index(field)] += amount
+
+    def get(self, slot):
+        base = slot * len(FIELDS)
+        return dict(zip(FIELDS, self._values[base:base + len(FIELDS)]))
+
+    def snapshot(self, alive=None):
+        # alive: pid -> bool, to leave out slots of exited workers.
+        workers = []
+        for slot in range(self.slots):
+            stats = self.get(slot)
+            if not stats['pid'] or (alive is not None and not alive(int(stats['pid']))):
+                continue
+            stats['pid'] = int(stats['pid'])
+            stats['generation'] = int(stats['generation'])
+            for field in ('ready', 'requests', 'errors', 'in_flight'):
+                stats[field] = int(stats[field])
+            stats['latency_ms'] = round(stats['latency_ms'], 3)
+            workers.append(stats)
+        totals = {field: sum(worker[field] for worker in workers)
+                  for field in ('requests', 'errors', 'in_flight')}
+        return dict(totals, workers=workers)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Worker:
+    # One process: an asyncio HTTP/1.1 server on the inherited socket, with
+    # its own event loop, connection pools and caches.
+    def __init__(self, sock, slot, stats, generation, **kwargs):
+        self.sock = sock
+        self.slot = slot
+        self.stats = stats
+        self.generation = generation
+        self.request_timeout = kwargs.get('request_timeout', float(os.getenv('server_request_timeout', '8')))
+        self.keepalive_timeout = kwargs.get('keepalive_timeout', float(os.getenv('server_keepalive_timeout', '5')))
+        self.graceful_timeout = kwargs.get('graceful_timeout', float(os.getenv('server_graceful_timeout', '10')))
+        self.max_body = kwargs.get('max_body', int(os.getenv('server_max_body', str(1024 * 1024))))
+        self.stopping = False
+        self._connections = set()
+        # Connections waiting for their next request, closed at once on stop.
+        self._idle = set()
+        self._stop = None
+        self.handler = None
+
+    def run(self):
+        # Events are sent by the window timer, not before each response: the
+        # loop keeps running between requests here.
+        os.environ.setdefault('change_report_flush_on_return', '0')
+        # Directives to one spa arrive on separate requests here; give them a
+        # moment to be merged into one setpoint write.
+        os.environ.setdefault('setpoint_window', '0.25')
+        # Imported after the fork, so each generation runs the current code.
+        from source import lambda_function
+        from lib.event_loop import get_event_loop
+
+        self.handler = lambda_function
+        loop = get_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.serve())
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, self._stop.set)
+        server = await asyncio.start_server(self.connection, sock=self.sock, backlog=1024)
+        self.stats.set(self.slot, 'ready', 1)
+        logger.info('Worker %d (generation %d) serving', os.getpid(), self.generation)
+        await self._stop.wait()
+
+        # Graceful stop: no new connections, let the open ones finish.
+        self.stopping = True
+        server.close()
+        for task in self._idle:
+            task.cancel()
+        if self._connections:
+            await asyncio.wait(list(self._connections), timeout=self.graceful_timeout)
+        # Deferred jobs, change reports and discovery events still pending.
+        from lib.event_loop import run_after_invocation
+
+        events = sys.modules.get('lib.events')
+        if events is not None:
+            events.change_reports.flush_on_return = True
+        await run_after_invocation()
+        logger.info('Worker %d stopped', os.getpid())
+
+    async def connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            await self.handle_connection(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        while not self.stopping:
+            self._idle.add(task)
+            try:
+                line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+            except (asyncio.TimeoutError, TimeoutError):
+                return
+            finally:
+                self._idle.discard(task)
+            if not line:
+                return
+            try:
+                method, path, version = line.decode('latin-1').split()
+            except ValueError:
+                await self.respond(writer, 400, {'error': 'Bad request line'}, False)
+                return
+            headers = {}
+            while True:
+                header = await reader.readline()
+                if header in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = header.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            if 'transfer-encoding' in headers:
+                await self.respond(writer, 411, {'error': 'Content-Length required'}, False)
+                return
+            try:
+                length = int(headers.get('content-length') or 0)
+            except ValueError:
+                length = -1
+            if length < 0:
+                await self.respond(writer, 400, {'error': 'Bad Content-Length'}, False)
+                return
+            if length > self.max_body:
+                await self.respond(writer, 413, {'error': 'Request too large'}, False)
+                return
+            body = await reader.readexactly(length) if length else b''
+
+            keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            status, payload = await self.dispatch(method, path.split('?')[0], body)
+            await self.respond(writer, status, payload, keep_alive and not self.stopping)
+            if not keep_alive:
+                return
+
+    async def respond(self, writer, status, payload, keep_alive):
+        # Directive responses arrive already serialized.
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        head = (f'HTTP/1.1 {status} {REASONS.get(status, "")}\r\n'
+                'Content-Type: application/json\r\n'
+                f'Content-Length: {len(data)}\r\n'
+                f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+        writer.write(head.encode('latin-1') + data)
+        await writer.drain()
+
+    async def dispatch(self, method, path, body):
+        if path == '/health':
+            if self.stopping:
+                return 503, {'status': 'stopping', 'pid': os.getpid()}
+            return 200, {'status': 'ok', 'pid': os.getpid(), 'generation': self.generation}
+        if path == '/metrics':
+            return 200, dict(self.stats.snapshot(process_alive), process=self.process_stats())
+        if path != '/':
+            return 404, {'error': f'No route {path}'}
+        if method != 'POST':
+            return 405, {'error': 'POST a directive'}
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return 400, {'error': 'Body is not JSON'}
+        return await self.handle(request)
+
+    def process_stats(self):
+        # Pools, breakers and coalesced reads are per process: these are the
+        # ones of the worker answering.
+        from lib.cloud_apis import flight_stats
+        from lib.resilience import breakers
+        from lib.transport import get_async_transport
+
+        return {'pid': os.getpid(), 'transport': get_async_transport().get_stats(),
+                'breakers': breakers.snapshot(), 'flights': flight_stats.snapshot()}
+
+    async def handle(self, request):
+        self.stats.add(self.slot, 'requests')
+        self.stats.add(self.slot, 'in_flight')
+        started = time.perf_counter()
+        try:
+            # After-invocation hooks run at shutdown instead, see serve.
+            # Single directives come back as JSON bytes, see respond.
+            response = await self.handler.async_lambda_handler(
+                request, RequestContext(self.request_timeout), run_hooks=False, serialize=True)
+            return 200, response
+        except Exception as error:
+            self.stats.add(self.slot, 'errors')
+            logger.exception('Directive failed')
+            return 500, {'error': repr(error)}
+        finally:
+            self.stats.add(self.slot, 'in_flight', -1)
+            self.stats.add(self.slot, 'latency_ms', (time.perf_counter() - started) * 1000)
+
+
+class DirectiveServer:
+    # Parent process: owns the listening socket, forks the workers, restarts
+    # those that die and handles reload and shutdown signals.
+    def __init__(self, **kwargs):
+        self.host = kwargs.get('host', os.getenv('server_host', '127.0.0.1'))
+        self.port = kwargs.get('port', int(os.getenv('server_port', '8080')))
+        self.workers = kwargs.get('workers', int(os.getenv('server_workers', '0')) or os.cpu_count() or 1)
+        self.graceful_timeout = kwargs.get('graceful_timeout', float(os.getenv('server_graceful_timeout', '10')))
+        self.worker_kwargs = kwargs.get('worker_kwargs', {})
+        self.generation = 0
+        # Two sets of slots, so a new generation starts while the old drains.
+        self.stats = WorkerStats(self.workers * 2)
+        self.sock = None
+        self._children = {}  # pid -> (generation, index, started)
+        self._reload = self._stop = False
+
+    def bind(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(1024)
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        logger.info('Listening on %s:%d with %d workers', self.host, self.port, self.workers)
+
+    def slot(self, generation, index):
+        return (generation % 2) * self.workers + index
+
+    def spawn(self, index):
+        generation = self.generation
+        slot = self.slot(generation, index)
+        pid = os.fork()
+        if pid:
+            self._children[pid] = (generation, index, time.monotonic())
+            return pid
+        # Child: never returns into the parent's stack.
+        code = 0
+        try:
+            for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, signal.SIG_DFL)
+            # Ctrl-C reaches the whole process group; the parent decides.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.stats.reset(slot, os.getpid(), generation)
+            Worker(self.sock, slot, self.stats, generation, **self.worker_kwargs).run()
+        except BaseException:
+            logger.exception('Worker failed')
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def start_generation(self):
+        for index in range(self.workers):
+            self.spawn(index)
+
+    def signal_workers(self, signum, generation=None):
+        for pid, (worker_generation, _, _) in list(self._children.items()):
+            if generation is None or worker_generation == generation:
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def reap(self):
+        # Exited children; workers of the current generation are replaced.
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self._children.clear()
+                return
+            if pid == 0:
+                return
+            generation, index, started = self._children.pop(pid, (None, None, None))
+            if generation == self.generation and not self._stop:
+                logger.warning('Worker %d exited (status %d), restarting', pid, status)
+                if time.monotonic() - started < 1:
+                    # Crashing on start: do not spin.
+                    time.sleep(1)
+                self.spawn(index)
+
+    def run(self):
+        if self.sock is None:
+            self.bind()
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        self.start_generation()
+        while not self._stop:
+            if self._reload:
+                self._reload = False
+                self.reload()
+            self.reap()
+            time.sleep(0.05)
+        self.shutdown()
+
+    def reload(self):
+        # New workers first, so the socket is always served; once they are
+        # ready the old ones finish their requests and exit.
+        old = self.generation
+        self.generation += 1
+        logger.info('Reloading: generation %d', self.generation)
+        # Slots are reused every other generation: stragglers from before
+        # the previous reload must go.
+        self.signal_workers(signal.SIGKILL, old - 1)
+        self.start_generation()
+        self.wait_ready(self.generation)
+        self.signal_workers(signal.SIGTERM, old)
+
+    def wait_ready(self, generation, timeout=30):
+        slots = [self.slot(generation, index) for index in range(self.workers)]
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and not self._stop:
+            if all(self.stats.get(slot)['ready'] and self.stats.get(slot)['generation'] == generation
+                   for slot in slots):
+                return True
+            self.reap()
+            time.sleep(0.05)
+        logger.warning('Generation %d not ready after %ss', generation, timeout)
+        return False
+
+    def shutdown(self):
+        logger.info('Stopping %d workers', len(self._children))
+        self.signal_workers(signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while self._children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.05)
+        self.signal_workers(signal.SIGKILL)
+        while self._children:
+            try:
+                pid, _ = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            self._children.pop(pid, None)
+        self._children.clear()
+        self.sock.close()
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._stop = True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve Alexa directives over HTTP')
+    parser.add_argument('--host', default=os.getenv('server_host', '127.0.0.1'))
+    parser.add_argument('-p', '--port', type=int, default=int(os.getenv('server_port', '8080')))
+    parser.add_argument('-w', '--workers', type=int, default=int(os.getenv('server_workers', '0')),
+                        help='worker processes (default: one per core)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(name)s %(message)s')
+    DirectiveServer(host=args.host, port=args.port, workers=args.workers or os.cpu_count() or 1).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
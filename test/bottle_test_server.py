@@ -1,4 +1,24 @@
-from bottle import Bottle, run, response
+# Stand-in for the spa device cloud, Login With Amazon and the Alexa event
+# gateway. Besides the four spas the tests use, it simulates a fleet of
+# generated spas and injects latency, slow tails and errors per route:
+#
+#   python -m test.bottle_test_server --spas 5000 --seed 7 \
+#       --faults '{"reportstate": {"latency": ["lognormal", 0.05, 0.5], "error_rate": 0.01}}'
+#
+# The same seed gives the same spas and, request for request, the same faults.
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+from socketserver import ThreadingMixIn
+from threading import Lock
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from bottle import Bottle, ServerAdapter, run, request, response
 
 spa_map = {
     "0101": "spa_test_1",
@@ -22,19 +42,247 @@ spa_state = {
     },
     "spa_test_4":
     {
-        'lights': 'Off'
+        'lights': 'Off',
+        'temperature': 36.5,
+        'setpoint': 37.0
     }
 }
 
+# Commercial account: many spas, listed discovery_page_size at a time.
+hotel_token = 'hotel-0001'
+hotel_spas = [f'hotel_spa_{number:03}' for number in range(1, 321)]
+discovery_page_size = 100
+# Accounts listing several spas, token -> spas.
+accounts = {hotel_token: hotel_spas}
+
+device_info = {
+    spa: {'model': 'ACC-100', 'friendly_name': 'ACC Spa'} for spa in spa_state
+}
+# Has all parts: the tests switch its jets and pumps and set its heater.
+device_info['spa_test_4']['model'] = 'ACC-400'
+# Range of the heater setpoint, Celsius.
+setpoint_range = (26.0, 40.0)
+for number, spa in enumerate(hotel_spas):
+    device_info[spa] = {'model': 'ACC-200' if number % 2 else 'ACC-100',
+                        'friendly_name': f'Hotel Spa {number + 1}'}
+
+# Setpoint writes received, (spa, setpoint), for tests.
+setpoint_writes = []
+
+# Generated spas: spa sim_spa_<n> is owned by token sim-<n>, and the fleet
+# account lists them all. Each model has the parts of its namesake in
+# lib.capabilities.
+fleet_token = 'sim-fleet'
+switch_states = ('On', 'Off')
+pump_states = ('Off', 'Low', 'High')
+model_parts = {
+    'ACC-100': {'lights': switch_states},
+    'ACC-200': {'lights': switch_states, 'jets': switch_states},
+    'ACC-300': {'lights': switch_states, 'jets': switch_states, 'setpoint': None},
+    'ACC-400': {'lights': switch_states, 'jets': switch_states, 'blower': switch_states,
+                'pump1': pump_states, 'pump2': pump_states, 'setpoint': None}
+}
+generated = []
+
+
+def generate_spas(count, seed=None):
+    # Replaces the spas of a previous call, count 0 removes them.
+    for token, spa in generated:
+        spa_map.pop(token, None)
+        spa_state.pop(spa, None)
+        device_info.pop(spa, None)
+    generated.clear()
+    accounts.pop(fleet_token, None)
+
+    rng = random.Random(f'{seed}:spas') if seed is not None else random.Random()
+    models = sorted(model_parts)
+    for number in range(count):
+        token, spa = f'sim-{number:05}', f'sim_spa_{number:05}'
+        model = rng.choice(models)
+        state = {}
+        for part, values in model_parts[model].items():
+            if values is None:
+                state['setpoint'] = rng.randrange(60, 81) / 2
+                state['temperature'] = round(rng.uniform(setpoint_range[0], setpoint_range[1]), 1)
+            else:
+                state[part] = rng.choice(values)
+        spa_map[token] = spa
+        spa_state[spa] = state
+        device_info[spa] = {'model': model, 'friendly_name': f'Spa {number + 1}'}
+        generated.append((token, spa))
+    if count:
+        accounts[fleet_token] = [spa for _, spa in generated]
+    return generated
+
+
+class Latency:
+    # Delay in seconds drawn per request from a distribution:
+    #   0.05 or ['constant', 0.05]
+    #   ['uniform', low, high]
+    #   ['exponential', mean]
+    #   ['lognormal', median, sigma]
+    #   ['normal', mean, stdev]  (negative draws are 0)
+    def __init__(self, spec):
+        if isinstance(spec, (int, float)):
+            spec = ['constant', spec]
+        self.kind = spec[0]
+        self.params = [float(param) for param in spec[1:]]
+        if self.kind not in ('constant', 'uniform', 'exponential', 'lognormal', 'normal'):
+            raise ValueError(f'Unknown latency distribution {self.kind}')
+
+    def draw(self, rng):
+        if self.kind == 'constant':
+            return self.params[0]
+        if self.kind == 'uniform':
+            return rng.uniform(*self.params)
+        if self.kind == 'exponential':
+            return rng.expovariate(1 / self.params[0]) if self.params[0] else 0.0
+        if self.kind == 'lognormal':
+            return rng.lognormvariate(math.log(self.params[0]), self.params[1])
+        return max(0.0, rng.gauss(*self.params))
+
+
+class RouteFaults:
+    # What one route does to each request: wait latency, plus tail with
+    # probability tail_rate, then fail with error_status with probability
+    # error_rate.
+    def __init__(self, **kwargs):
+        self.latency = Latency(kwargs.get('latency', 0))
+        self.tail_rate = float(kwargs.get('tail_rate', 0))
+        self.tail = Latency(kwargs.get('tail', 0))
+        self.error_rate = float(kwargs.get('error_rate', 0))
+        self.error_status = int(kwargs.get('error_status', 503))
+
+    def draw(self, rng):
+        # -> (delay, tail, error status or None), always drawing in this order.
+        delay = self.latency.draw(rng)
+        tail = rng.random() < self.tail_rate
+        if tail:
+            delay += self.tail.draw(rng)
+        error = rng.random() < self.error_rate
+        return delay, tail, self.error_status if error else None
+
+
+class Simulator:
+    # Bottle plugin injecting the faults configured per route name ('*' for
+    # the routes without their own). With a seed, request n of a path on a
+    # route draws the same faults whatever the interleaving of the server
+    # threads.
+    name = 'simulator'
+    api = 2
+
+    def __init__(self, **kwargs):
+        self.seed = None
+        self.faults = {}
+        self._lock = Lock()
+        self._counts = {}
+        self._stats = {}
+        self._random = random.Random()
+        self.configure(**kwargs)
+
+    def configure(self, **kwargs):
+        # faults: {route name: RouteFaults kwargs}, or the same as JSON.
+        faults = kwargs.get('faults') or {}
+        if isinstance(faults, str):
+            faults = json.loads(faults)
+        self.faults = {route: RouteFaults(**spec) for route, spec in faults.items()}
+        self.seed = kwargs.get('seed')
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+            self._stats.clear()
+            self._random = random.Random(self.seed)
+
+    def draw(self, route, path):
+        faults = self.faults.get(route) or self.faults.get('*')
+        if faults is None:
+            return 0.0, False, None
+        with self._lock:
+            if self.seed is None:
+                return faults.draw(self._random)
+            number = self._counts.get((route, path), 0)
+            self._counts[(route, path)] = number + 1
+        return faults.draw(random.Random(f'{self.seed}:{route}:{path}:{number}'))
+
+    def record(self, route, delay, tail, error):
+        with self._lock:
+            stats = self._stats.setdefault(route, {'requests': 0, 'tails': 0, 'errors': 0, 'delay': 0.0})
+            stats['requests'] += 1
+            stats['tails'] += tail
+            stats['errors'] += error is not None
+            stats['delay'] += delay
+
+    def get_stats(self):
+        with self._lock:
+            return {route: dict(stats) for route, stats in self._stats.items()}
+
+    def apply(self, callback, route):
+        name = route.name or route.rule
+
+        def wrapper(*args, **kwargs):
+            delay, tail, error = self.draw(name, request.path)
+            self.record(name, delay, tail, error)
+            if delay:
+                time.sleep(delay)
+            if error is not None:
+                response.status = error
+                return 'Simulated failure'
+            return callback(*args, **kwargs)
+        return wrapper
+
+
+class ThreadedServer(ServerAdapter):
+    # wsgiref with a thread per connection: a slow request does not hold up
+    # the others, as it does with Bottle's default server.
+    def run(self, app):
+        quiet = self.quiet
+
+        class Server(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
+        class Handler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                if not quiet:
+                    super().log_request(*args, **kwargs)
+
+        self.srv = make_server(self.host, self.port, app, Server, Handler)
+        self.srv.serve_forever()
+
+
+simulator = Simulator()
 app = Bottle()
+app.install(simulator)
+
 
+def configure(**kwargs):
+    # spas, seed and faults, defaulting to sim_spas, sim_seed and sim_faults.
+    seed = kwargs.get('seed', os.getenv('sim_seed'))
+    generate_spas(int(kwargs.get('spas', os.getenv('sim_spas', '0'))), seed)
+    simulator.configure(seed=seed, faults=kwargs.get('faults', os.getenv('sim_faults')))
 
-def run_server():
-    run(app, host='localhost', port=3434)
 
+def run_server(**kwargs):
+    # server: 'threaded', or any Bottle server adapter name ('wsgiref',
+    # 'gevent', 'aiohttp', ... when installed).
+    server = kwargs.get('server', os.getenv('sim_server', 'threaded'))
+    if server == 'threaded':
+        server = ThreadedServer
+    run(app, server=server, host=kwargs.get('host', 'localhost'), port=kwargs.get('port', 3434),
+        quiet=kwargs.get('quiet', False))
 
-@app.route('/spa/discovery/<token>')
+
+@app.route('/spa/discovery/<token>', name='discovery')
 def discovery(token=None):
+    if token in accounts:
+        spas = accounts[token]
+        start = int(request.query.get('page') or 0)
+        end = start + discovery_page_size
+        page = {'endpoints': [{'endpoint_id': spa} for spa in spas[start:end]]}
+        if end < len(spas):
+            page['next'] = str(end)
+        return page
 
     try:
         return {
@@ -49,39 +297,167 @@ def discovery(token=None):
         return 'Token does not match any existing spa'
 
 
-@app.route('/spa/reportstate/<endpoint>')
+@app.route('/spa/devices/<endpoint>', name='devices')
+def device(endpoint=None):
+    try:
+        return device_info[endpoint]
+    except KeyError:
+        response.status = 404
+        return 'No such endpoint'
+
+
+@app.route('/spa/reportstate/<endpoint>', name='reportstate')
 def report_state(endpoint=None):
     try:
         return spa_state[endpoint]
     except KeyError:
-        response.status = 400
+        response.status = 404
+        return 'No such endpoint'
+
+
+@app.route('/spa/reportstate/<endpoint>/<subsystem>', name='reportstate_subsystem')
+def report_subsystem_state(endpoint=None, subsystem=None):
+    if endpoint not in spa_state:
+        response.status = 404
         return 'No such endpoint'
+    try:
+        return {subsystem: spa_state[endpoint][subsystem]}
+    except (KeyError, TypeError):
+        response.status = 400
+        return 'No such subsystem'
 
 
-@app.route('/spa/updatestate/lights/<value>/<token>')
-def device_update(value=None, token=None):
+@app.route('/spa/updatestate/temp/<value>/<token>', name='setpoint')
+def setpoint_update(value=None, token=None):
     try:
         spa = spa_map[token]
     except KeyError:
+        response.status = 404
+        return 'Token does not match any existing spa'
+    if 'setpoint' not in model_parts[device_info[spa]['model']]:
+        response.status = 400
+        return 'The spa has no heater'
+    try:
+        setpoint = float(value)
+    except ValueError:
+        response.status = 400
+        return 'Bad setpoint'
+    if not setpoint_range[0] <= setpoint <= setpoint_range[1]:
         response.status = 400
+        return 'Setpoint out of range'
+    setpoint_writes.append((spa, setpoint))
+    spa_state[spa]['setpoint'] = setpoint
+    return {
+        "status":
+            {
+                "endpoint_id": spa,
+                "state": setpoint
+            }
+    }
+
+
+# Values each device route takes, and the state they leave it in.
+switch_values = {'TurnOn': 'On', 'TurnOff': 'Off'}
+pump_values = {state: state for state in pump_states}
+device_values = {
+    'lights': switch_values,
+    'jets': switch_values,
+    'blower': switch_values,
+    'pump1': pump_values,
+    'pump2': pump_values
+}
+
+
+@app.route('/spa/updatestate/<device>/<value>/<token>', name='updatestate')
+def device_update(device=None, value=None, token=None):
+    try:
+        spa = spa_map[token]
+    except KeyError:
+        response.status = 404
         return 'Token does not match any existing spa'
 
     try:
-        if value == 'TurnOff':
-            spa_state[spa] = 'Off'
-        elif value == 'TurnOn':
-            spa_state[spa] = 'On'
+        state = device_values[device][value]
+    except KeyError:
+        response.status = 400
+        return 'No such device or value'
+    if device not in model_parts[device_info[spa]['model']]:
+        response.status = 400
+        return 'The spa has no such device'
+    spa_state[spa][device] = state
+    return {
+        "status":
+            {
+                "endpoint_id": spa,
+                "state": state
+            }
+    }
+
+
+# Login With Amazon stand-in, see lwa_token_url in lib.lwa
+@app.post('/auth/o2/token', name='lwa')
+def lwa_token():
+    if request.forms.get('grant_type') == 'refresh_token':
+        refresh_token = request.forms.get('refresh_token') or ''
+        if not refresh_token.startswith('Atzr|'):
+            response.status = 400
+            return {'error': 'invalid_grant',
+                    'error_description': 'The request has an invalid parameter : refresh_token'}
         return {
-            "status":
-                {
-                    "endpoint_id": spa,
-                    "state": spa_state[spa]
-                }
+            'access_token': 'Atza|access-' + refresh_token[len('Atzr|refresh-'):] + '-refreshed',
+            'refresh_token': refresh_token,
+            'token_type': 'bearer',
+            'expires_in': 3600
         }
-    except KeyError:
+    code = request.forms.get('code')
+    if not code or code == 'None' or code.startswith('invalid'):
         response.status = 400
-        return 'Internal spa-token pair map error'
+        return {'error': 'invalid_grant',
+                'error_description': 'The request has an invalid grant parameter : code'}
+    return {
+        'access_token': f'Atza|access-{code}',
+        'refresh_token': f'Atzr|refresh-{code}',
+        'token_type': 'bearer',
+        'expires_in': 3600
+    }
+
+
+# Alexa event gateway stand-in, see event_gateway_url in lib.events
+events = []
+
+
+@app.post('/v3/events', name='events')
+def event_gateway():
+    if not (request.get_header('Authorization') or '').startswith('Bearer Atza|'):
+        response.status = 401
+        return {'code': 'INVALID_ACCESS_TOKEN_EXCEPTION'}
+    events.append(request.json)
+    response.status = 202
+    return ''
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Spa cloud stand-in')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('-p', '--port', type=int, default=int(os.getenv('SPA_TEST_PORT', '3434')))
+    parser.add_argument('--spas', type=int, default=int(os.getenv('sim_spas', '0')),
+                        help='spas to generate, listed by the sim-fleet token')
+    parser.add_argument('--seed', default=os.getenv('sim_seed'))
+    parser.add_argument('--faults', default=os.getenv('sim_faults'),
+                        help='JSON {route: {latency, tail_rate, tail, error_rate, error_status}}, or @file')
+    parser.add_argument('--server', default=os.getenv('sim_server', 'threaded'))
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    faults = args.faults
+    if faults and faults.startswith('@'):
+        with open(faults[1:]) as fp:
+            faults = fp.read()
+    configure(spas=args.spas, seed=args.seed, faults=faults)
+    run_server(host=args.host, port=args.port, server=args.server, quiet=args.quiet)
+
 
+configure()
 
 if __name__ == '__main__':
-    run_server()
+    sys.exit(main())
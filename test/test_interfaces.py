@@ -1,22 +1,53 @@
-import unittest
+import asyncio
+import copy
+import http.client
+import io
+import json
+import logging
 import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import time
-from urllib.error import HTTPError
-import pytest
-from source import lambda_function
-from lib import alexa_message as message
-from lib.request_handler import RequestFactory, ReportState, Toggle
-from lib.cloud_apis import DeviceCloud
+import unittest
 import urllib.error
-import json
+import urllib.request
+from contextlib import suppress
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from threading import Thread
+from urllib.error import HTTPError
+
+from lib import alexa_message as message
+from lib import deferred, lwa, metrics, resilience, token_store
+from lib.cache import TTLCache, StateCache, discovery_cache, state_cache, token_key
+from lib.capabilities import capabilities
+from lib.cloud_apis import DeviceCloud, AsyncDeviceCloud, CloudConfig, flight_stats
+from lib.directive import DirectiveError, parse_directive
+from lib.dispatch import HandlerRegistry, handlers
+from lib.event_loop import run_sync
+from lib.events import ChangeReportSender, change_reports, state_property
+from lib.handlers.thermostat import SetpointCoalescer
+from lib.instances import instances
+from lib.models import Capability, DiscoveryEndpoint, Header, Property, ENDPOINT_HEALTH
+from lib.payload_log import PayloadLogger, LazyPayload, redact, parse_sample_rates
+from lib.request_handler import RequestFactory, RequestHandler, ReportState, Thermostat, Toggle, batch_group_key
+from lib.resilience import CircuitBreaker, CircuitOpenError, CloudUnavailable, Deadline, RetryPolicy
+from lib.singleflight import SingleFlight
+from lib.token_store import (KMSCipher, MemoryTokenStore, SQLiteTokenStore, TokenManager, TokenStoreError,
+                             create_store, get_token_manager)
+from lib.transport import PooledTransport, UrllibTransport, AsyncPooledTransport
+from source import lambda_function
 from test import bottle_test_server as ms
-from contextlib import suppress
 
 
 os.environ['cloud_host'] = 'localhost'
 os.environ['cloud_port'] = '3434'
 os.environ['cloud_schema'] = 'http'
+os.environ['token_store'] = 'memory'
 
 # os.environ['cloud_host'] = 'milonet.duckdns.org'
 # os.environ['cloud_port'] = ''
@@ -36,6 +67,12 @@ class TestCommon(unittest.TestCase):
         self.assertEqual(response['event']['payload']
                          ['type'], 'INVALID_DIRECTIVE')
 
+    def test_not_a_directive(self):
+        for request in ('directives', None, 42):
+            response = lambda_function.lambda_handler(request, None)
+            self.assertEqual(response['event']['header']['name'], 'ErrorResponse')
+            self.assertEqual(response['event']['payload']['type'], 'INVALID_DIRECTIVE')
+
 
 class TestAcceptGrant(unittest.TestCase):
     def test_accept_grant_no_code(self):
@@ -61,6 +98,171 @@ class TestAcceptGrant(unittest.TestCase):
                          ['type'], 'ACCEPT_GRANT_FAILED')
 
 
+class FakeKMS:
+    # Reversible stand-in for the KMS client, bound to the encryption context.
+    def encrypt(self, KeyId, Plaintext, EncryptionContext):
+        return {'CiphertextBlob': json.dumps([KeyId, EncryptionContext, Plaintext[::-1].hex()]).encode()}
+
+    def decrypt(self, CiphertextBlob, EncryptionContext):
+        key_id, context, blob = json.loads(CiphertextBlob)
+        if context != EncryptionContext:
+            raise ValueError('InvalidCiphertextException')
+        return {'Plaintext': bytes.fromhex(blob)[::-1]}
+
+
+class TestTokenStore(unittest.TestCase):
+    def test_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tokens.db')
+            store = SQLiteTokenStore(path=path, plaintext=True)
+            store.save('user', {'access_token': 'Atza|secret'})
+            store.close()
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            store = SQLiteTokenStore(path=path, plaintext=True)
+            self.assertEqual(store.load('user'), {'access_token': 'Atza|secret'})
+            store.delete('user')
+            self.assertIsNone(store.load('user'))
+            # Records it cannot read are ignored.
+            store.save('user', {})
+            with store._db:
+                store._db.execute('UPDATE tokens SET record = ?', (b'\x00sealed',))
+            self.assertIsNone(store.load('user'))
+            store.close()
+
+    def test_sqlite_store_mode(self):
+        # An existing file is made owner-only.
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tokens.db')
+            open(path, 'w').close()
+            os.chmod(path, 0o644)
+            SQLiteTokenStore(path=path, plaintext=True).close()
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+    def test_sqlite_store_kms(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tokens.db')
+            cipher = KMSCipher('alias/tokens', client=FakeKMS())
+            store = SQLiteTokenStore(path=path, cipher=cipher)
+            store.save('user', {'access_token': 'Atza|secret'})
+            self.assertEqual(store.load('user'), {'access_token': 'Atza|secret'})
+            record, = store._db.execute('SELECT record FROM tokens').fetchone()
+            self.assertNotIn(b'Atza|secret', bytes(record))
+            # A record moved to another user does not decrypt.
+            with store._db:
+                store._db.execute('INSERT INTO tokens VALUES (?, ?, 0)', ('other', record))
+            self.assertIsNone(store.load('other'))
+            store.close()
+
+            # No key and no plaintext opt-in, or no path: no store.
+            with self.assertRaises(TokenStoreError):
+                SQLiteTokenStore(path=path, plaintext=False)
+            with self.assertRaises(TokenStoreError):
+                SQLiteTokenStore(path=None, plaintext=True)
+
+    def test_refresh_schedule(self):
+        now = [1000.0]
+        calls = []
+
+        async def refresher(refresh_token):
+            calls.append(refresh_token)
+            await asyncio.sleep(0.01)
+            return {'access_token': f'access-{len(calls)}', 'expires_in': 3600}
+
+        manager = TokenManager(refresher=refresher, refresh_margin=300, clock=lambda: now[0])
+        manager.save_grant('0101', {'access_token': 'access-0', 'refresh_token': 'refresh',
+                                    'token_type': 'bearer', 'expires_in': 3600})
+        self.assertIsNone(run_sync(manager.get_access_token('unknown')))
+        self.assertEqual(run_sync(manager.get_access_token('0101')), 'access-0')
+        self.assertEqual(calls, [])
+
+        # Close to expiry: the old token is served while a refresh runs.
+        now[0] += 3400
+
+        async def in_margin():
+            token = await manager.get_access_token('0101')
+            await asyncio.gather(*manager._background)
+            return token
+
+        self.assertEqual(run_sync(in_margin()), 'access-0')
+        self.assertEqual(run_sync(manager.get_access_token('0101')), 'access-1')
+
+        # Expired: callers wait, and share one refresh.
+        now[0] += 3600
+
+        async def expired():
+            return await asyncio.gather(*(manager.get_access_token('0101') for _ in range(3)))
+
+        self.assertEqual(run_sync(expired()), ['access-2'] * 3)
+        self.assertEqual(calls, ['refresh', 'refresh'])
+
+    def test_forget_during_refresh(self):
+        now = [1000.0]
+
+        async def refresher(refresh_token):
+            manager.forget('0101')
+            return {'access_token': 'access-1', 'expires_in': 3600}
+
+        manager = TokenManager(refresher=refresher, refresh_margin=300, clock=lambda: now[0])
+        manager.save_grant('0101', {'access_token': 'access-0', 'refresh_token': 'refresh'})
+        now[0] += 3400
+
+        async def in_margin():
+            token = await manager.get_access_token('0101')
+            results = await asyncio.gather(*manager._background, return_exceptions=True)
+            return token, results
+
+        self.assertEqual(run_sync(in_margin()), ('access-0', [None]))
+        self.assertIsNone(run_sync(manager.get_access_token('0101')))
+
+        # Expired and forgotten before the refresh reads the store.
+        manager.save_grant('0101', {'access_token': 'access-0', 'refresh_token': 'refresh'})
+        now[0] += 7200
+        manager.store.delete(token_key('0101'))
+        manager._cache.clear()
+        self.assertIsNone(run_sync(manager.refresh(token_key('0101'))))
+
+    def test_create_store(self):
+        with self.assertRaises(TokenStoreError):
+            create_store('')
+        self.assertIsInstance(create_store('memory'), MemoryTokenStore)
+        self.assertIsInstance(create_store('lib.token_store:MemoryTokenStore'), MemoryTokenStore)
+
+    def test_accept_grant_without_store(self):
+        # The grant code is not spent when the tokens could not be kept.
+        exchanged = []
+
+        async def exchange_code(code):
+            exchanged.append(code)
+
+        manager, exchange = token_store._manager, lwa.exchange_code
+        token_store._manager, lwa.exchange_code = None, exchange_code
+        os.environ['token_store'] = ''
+        try:
+            request = message.AlexaAuthorizationRequest(
+                grant_code='good_code', grantee_token='grantee').get()
+            response = lambda_function.lambda_handler(request, None)
+            self.assertEqual(response['event']['payload']['type'], 'ACCEPT_GRANT_FAILED')
+            self.assertEqual(exchanged, [])
+        finally:
+            os.environ['token_store'] = 'memory'
+            token_store._manager, lwa.exchange_code = manager, exchange
+
+    def test_accept_grant_saves_tokens(self):
+        default_url = lwa.lwa_token_url
+        lwa.lwa_token_url = 'http://localhost:3434/auth/o2/token'
+        try:
+            request = message.AlexaAuthorizationRequest(
+                grant_code='good_code', grantee_token='grantee').get()
+            response = lambda_function.lambda_handler(request, None)
+            self.assertEqual(response['event']['header']['name'], 'AcceptGrant.Response')
+            manager = get_token_manager()
+            self.assertEqual(run_sync(manager.get_access_token('grantee')), 'Atza|access-good_code')
+            tokens = run_sync(lwa.refresh_tokens('Atzr|refresh-good_code'))
+            self.assertEqual(tokens['access_token'], 'Atza|access-good_code-refreshed')
+        finally:
+            lwa.lwa_token_url = default_url
+
+
 class TestDiscovery(unittest.TestCase):
 
     def test_discovery_good_token(self):
@@ -95,6 +297,168 @@ class TestDiscovery(unittest.TestCase):
         self.assertEqual(response['event']['header']
                          ['name'], 'Discovery.ErrorResponse')
 
+    def test_discovery_metadata(self):
+        discovery_cache.clear()
+        request = message.AlexaDiscoveryRequest(token='0101').get()
+        endpoint = lambda_function.lambda_handler(request, None)['event']['payload']['endpoints'][0]
+        self.assertEqual(endpoint['additionalAttributes']['model'], 'ACC-100')
+        self.assertEqual([c.get('instance') for c in endpoint['capabilities']], [None, 'Spa.Lights'])
+
+    def test_discovery_paginated(self):
+        discovery_cache.clear()
+        ms.events.clear()
+        os.environ['event_gateway_url'] = 'http://localhost:3434/v3/events'
+        get_token_manager().save_grant(ms.hotel_token, {'access_token': 'Atza|access-hotel',
+                                                        'refresh_token': 'Atzr|refresh-hotel',
+                                                        'expires_in': 3600})
+        try:
+            request = message.AlexaDiscoveryRequest(token=ms.hotel_token).get()
+            response = lambda_function.lambda_handler(request, None)
+        finally:
+            del os.environ['event_gateway_url']
+            get_token_manager().forget(ms.hotel_token)
+
+        endpoints = response['event']['payload']['endpoints']
+        self.assertEqual(len(endpoints), 300)
+        self.assertEqual(endpoints[0]['endpointId'], 'hotel_spa_001')
+        self.assertEqual(endpoints[1]['friendlyName'], 'Hotel Spa 2')
+        instances = [[c.get('instance') for c in e['capabilities']] for e in endpoints[:2]]
+        self.assertEqual(instances, [[None, 'Spa.Lights'], [None, 'Spa.Lights', 'Spa.Jets']])
+
+        # The endpoints past the limit follow as an AddOrUpdateReport event.
+        reports = [event for event in ms.events
+                   if event['event']['header']['name'] == 'AddOrUpdateReport']
+        self.assertEqual(len(reports), 1)
+        payload = reports[0]['event']['payload']
+        self.assertEqual(payload['scope']['token'], 'Atza|access-hotel')
+        self.assertEqual([e['endpointId'] for e in payload['endpoints']], ms.hotel_spas[300:])
+
+    def test_discovery_concurrency(self):
+        class ListingCloud:
+            def __init__(self):
+                self.active = self.peak = 0
+
+            async def device_discovery(self, token, page=None):
+                page = int(page or 0)
+                body = {'endpoints': [{'endpoint_id': f'spa_{n}'} for n in range(page, page + 10)]}
+                if page < 20:
+                    body['next'] = str(page + 10)
+                return json.dumps(body)
+
+            async def device_info(self, endpoint_id):
+                self.active += 1
+                self.peak = max(self.peak, self.active)
+                await asyncio.sleep(0.001)
+                self.active -= 1
+                if endpoint_id == 'spa_3':
+                    raise HTTPError(endpoint_id, 404, 'Not Found', {}, None)
+                return json.dumps({'model': 'ACC-200'})
+
+        discovery_cache.clear()
+        cloud = ListingCloud()
+        request = message.AlexaDiscoveryRequest(token='lister').get()
+        handler = handlers.lookup('Alexa.Discovery', 'Discover', None)
+        concurrency, handler.concurrency = handler.concurrency, 4
+        try:
+            response = handler(request, server=cloud).handle_request()
+        finally:
+            handler.concurrency = concurrency
+        endpoints = response['event']['payload']['endpoints']
+        self.assertEqual(len(endpoints), 30)
+        self.assertEqual(cloud.peak, 4)
+        # No metadata: still discovered, with the default capabilities.
+        self.assertEqual(len(endpoints[3]['capabilities']), 2)
+        self.assertEqual(len(endpoints[4]['capabilities']), 3)
+
+
+class TestCache(unittest.TestCase):
+    def test_ttl_and_lru(self):
+        now = [0]
+        cache = TTLCache(ttl=10, maxsize=2, clock=lambda: now[0])
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        now[0] = 11
+        self.assertIsNone(cache.get('a'))
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['expirations'], 1)
+
+    def test_discovery_cached(self):
+        discovery_cache.clear()
+        request = message.AlexaDiscoveryRequest(token='0202').get()
+        lambda_function.lambda_handler(request, None)
+        self.assertNotIn('0202', ''.join(discovery_cache._data.keys()))
+        self.assertIn(token_key('0202'), discovery_cache._data)
+
+        hits = discovery_cache.get_stats()['hits']
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(discovery_cache.get_stats()['hits'], hits + 1)
+        self.assertEqual(response['event']['payload']['endpoints'][0]['endpointId'],
+                         'spa_test_2')
+
+        discovery_cache.invalidate_token('0202')
+        self.assertIsNone(discovery_cache.get_endpoints('0202'))
+
+    def test_toggle_error_invalidates(self):
+        discovery_cache.set_endpoints('0000', [{'endpoint_id': 'spa_test_1'}])
+        request = message.AlexaToggleRequest('spa_test_1', '0000', 'TurnOn').get()
+        Toggle(request).handle_request()
+        self.assertIsNone(discovery_cache.get_endpoints('0000'))
+
+
+class TestCapabilities(unittest.TestCase):
+    def test_shared_and_immutable(self):
+        lights = capabilities.get('Spa.Lights')
+        self.assertEqual(lights['interface'], 'Alexa.ToggleController')
+        self.assertEqual(lights['capabilityResources']['friendlyNames'][0]['value']['text'],
+                         'Spa Lights')
+        with self.assertRaises(TypeError):
+            lights['instance'] = 'Spa.Jets'
+        with self.assertRaises(TypeError):
+            lights['properties'].update({'retrievable': False})
+        self.assertIs(copy.deepcopy(lights), lights)
+        self.assertIs(capabilities.capability_set('Alexa', 'Spa.Lights'),
+                      capabilities.capability_set('Alexa', 'Spa.Lights'))
+
+    def test_discovery_serialization(self):
+        response = message.DiscoveryResponse(
+            namespace='Alexa.Discovery', name='Discover.Response')
+        for endpoint_id in ('spa_a', 'spa_b'):
+            response.add_payload_endpoint(
+                endpoint_id, capabilities=capabilities.capability_set('Alexa', 'Spa.Lights'))
+        response = response.get()
+        endpoints = response['event']['payload']['endpoints']
+        self.assertIs(endpoints[0]['capabilities'], endpoints[1]['capabilities'])
+
+        endpoints = json.loads(json.dumps(response))['event']['payload']['endpoints']
+        self.assertEqual([e['endpointId'] for e in endpoints], ['spa_a', 'spa_b'])
+        self.assertEqual(endpoints[0]['capabilities'][1], {
+            'type': 'AlexaInterface',
+            'interface': 'Alexa.ToggleController',
+            'version': '3',
+            'instance': 'Spa.Lights',
+            'capabilityResources': {'friendlyNames': [
+                {'@type': 'text', 'value': {'text': 'Spa Lights', 'locale': 'en-US'}}]},
+            'properties': {'supported': [{'name': 'toggleState'}],
+                           'proactivelyReported': True,
+                           'retrievable': True}})
+        self.assertEqual(endpoints[0]['displayCategories'], ['THERMOSTAT', 'LIGHT'])
+
+    def test_model_sets(self):
+        heater = capabilities.model_set('ACC-300')
+        self.assertEqual([c['interface'] for c in heater],
+                         ['Alexa', 'Alexa.ToggleController', 'Alexa.ToggleController',
+                          'Alexa.ThermostatController', 'Alexa.TemperatureSensor'])
+        self.assertEqual(json.loads(json.dumps(heater[3]['configuration'])), {'supportedModes': ['HEAT'], 'supportsScheduling': False})
+        self.assertNotIn('instance', heater[3])
+        self.assertIs(capabilities.model_set(instances=['Spa.Lights', 'Spa.Sauna']),
+                      capabilities.model_set('unknown-model'))
+
 
 class TestToggle(unittest.TestCase):
 
@@ -194,6 +558,246 @@ class TestToggle(unittest.TestCase):
         self.assertTrue(found)
 
 
+class TestInstances(unittest.TestCase):
+    token = 'este-es-nuestro.access.token'
+
+    def setUp(self):
+        state_cache.clear()
+
+    def set_mode(self, mode, instance='Spa.Pump1'):
+        request = message.AlexaRequest().set_header('Alexa.ModeController', 'SetMode', instance=instance) \
+            .set_endpoint('spa_test_4', {'type': 'BearerToken', 'token': self.token}) \
+            .set_payload({'mode': mode}).get()
+        return lambda_function.lambda_handler(request, None)
+
+    def test_catalog(self):
+        pump = instances.get('Spa.Pump2')
+        self.assertEqual((pump.key, pump.route, pump.namespace), ('pump2', 'pump2', 'Alexa.ModeController'))
+        self.assertEqual(pump.encode('Speed.Low'), 'Low')
+        self.assertIs(instances.by_key('setpoint'), instances.get('Spa.Temp'))
+        self.assertEqual(instances.route('Spa.Temp'), 'temp')
+        self.assertEqual(instances.route('Spa.Sauna'), 'sauna')
+        with self.assertRaisesRegex(ValueError, 'read-only'):
+            DeviceCloud().update_state_url('Spa.WaterTemperature', '30', self.token)
+        self.assertEqual(state_property('pump1', 'Low')['value'], 'Speed.Low')
+        self.assertIsNone(state_property('filter', 'Dirty'))
+
+    def test_toggle_jets(self):
+        request = message.AlexaToggleRequest('spa_test_4', self.token, 'TurnOn', instance='Spa.Jets').get()
+        response = lambda_function.lambda_handler(request, None)
+        prop = response['context']['properties'][0]
+        self.assertEqual((prop['instance'], prop['value']), ('Spa.Jets', 'On'))
+        self.assertEqual(ms.spa_state['spa_test_4']['jets'], 'On')
+        self.assertEqual(ms.spa_state['spa_test_4']['lights'], 'Off')
+
+    def test_part_not_in_model(self):
+        # spa_test_1 is an ACC-100, lights only.
+        request = message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOn', instance='Spa.Jets').get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(response['event']['payload']['type'], 'INVALID_VALUE')
+        self.assertEqual(response['event']['endpoint']['endpointId'], 'spa_test_1')
+        self.assertNotIn('jets', ms.spa_state['spa_test_1'])
+
+    def test_set_mode(self):
+        response = self.set_mode('Speed.High')
+        prop = response['context']['properties'][0]
+        self.assertEqual((prop['namespace'], prop['instance'], prop['name'], prop['value']),
+                         ('Alexa.ModeController', 'Spa.Pump1', 'mode', 'Speed.High'))
+        self.assertEqual(ms.spa_state['spa_test_4']['pump1'], 'High')
+
+        state_cache.clear()
+        request = message.AlexaStateRequest(endpointId='spa_test_4', token=self.token).get()
+        properties = lambda_function.lambda_handler(request, None)['context']['properties']
+        modes = [prop['value'] for prop in properties if prop['name'] == 'mode']
+        self.assertEqual(modes, ['Speed.High'])
+
+    def test_invalid_values(self):
+        ms.spa_state['spa_test_4']['pump1'] = 'Off'
+        response = self.set_mode('Speed.Turbo')
+        self.assertEqual(response['event']['payload']['type'], 'INVALID_VALUE')
+        self.assertEqual(response['event']['endpoint']['endpointId'], 'spa_test_4')
+        self.assertEqual(self.set_mode('Speed.Low', 'Spa.Lights')['event']['payload']['type'], 'INVALID_VALUE')
+        request = message.AlexaToggleRequest('spa_test_4', self.token, 'TurnOn', instance='Spa.Pump1').get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(response['event']['payload']['type'], 'INVALID_VALUE')
+        self.assertEqual(ms.spa_state['spa_test_4']['pump1'], 'Off')
+
+    def test_mode_capability(self):
+        pump = capabilities.get('Spa.Pump1')
+        self.assertEqual(pump['interface'], 'Alexa.ModeController')
+        self.assertEqual([mode['value'] for mode in pump['configuration']['supportedModes']],
+                         ['Speed.Off', 'Speed.Low', 'Speed.High'])
+        self.assertEqual([c.get('instance') for c in capabilities.model_set('ACC-400')][1:6],
+                         ['Spa.Lights', 'Spa.Jets', 'Spa.Blower', 'Spa.Pump1', 'Spa.Pump2'])
+
+
+class SetpointCloud:
+    # Setpoint writes take a while, so directives can pile up behind them.
+    def __init__(self, setpoint):
+        self.setpoint = setpoint
+        self.writes = []
+        self.reads = 0
+
+    async def report_state(self, endpoint_id, subsystem=None):
+        self.reads += 1
+        return json.dumps({'setpoint': self.setpoint})
+
+    async def update_device_state(self, endpoint_id, instance, value, token):
+        self.writes.append((instance, value))
+        await asyncio.sleep(0.01)
+        self.setpoint = float(value)
+        return json.dumps({'status': {'endpoint_id': endpoint_id, 'state': self.setpoint}})
+
+
+class TestThermostat(unittest.TestCase):
+    token = 'este-es-nuestro.access.token'
+
+    def setUp(self):
+        state_cache.clear()
+        ms.setpoint_writes.clear()
+
+    def setpoint(self, response):
+        for prop in response['context']['properties']:
+            if prop['name'] == 'targetSetpoint':
+                self.assertNotIn('instance', prop)
+                return prop['value']
+
+    def test_set_target_temperature(self):
+        request = message.AlexaThermostatRequest('spa_test_4', self.token, value=38.5).get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(response['event']['header']['name'], 'Response')
+        self.assertEqual(self.setpoint(response), {'value': 38.5, 'scale': 'CELSIUS'})
+        self.assertEqual(ms.spa_state['spa_test_4']['setpoint'], 38.5)
+
+        request = message.AlexaThermostatRequest('spa_test_4', self.token, value=100.4,
+                                                 scale='FAHRENHEIT').get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(self.setpoint(response), {'value': 38.0, 'scale': 'CELSIUS'})
+
+    def test_adjust_and_report_state(self):
+        ms.spa_state['spa_test_4']['setpoint'] = 37.0
+        request = message.AlexaThermostatRequest('spa_test_4', self.token, 'AdjustTargetTemperature',
+                                                 value=-1).get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(self.setpoint(response), {'value': 36.0, 'scale': 'CELSIUS'})
+
+        state_cache.clear()
+        request = message.AlexaStateRequest(endpointId='spa_test_4', token=self.token).get()
+        properties = lambda_function.lambda_handler(request, None)['context']['properties']
+        temperatures = {prop['name']: prop['value'] for prop in properties
+                        if prop['namespace'] in ('Alexa.TemperatureSensor', 'Alexa.ThermostatController')}
+        self.assertEqual(temperatures, {'temperature': {'value': 36.5, 'scale': 'CELSIUS'},
+                                        'targetSetpoint': {'value': 36.0, 'scale': 'CELSIUS'}})
+
+    def test_out_of_range(self):
+        request = message.AlexaThermostatRequest('spa_test_4', self.token, value=45).get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(response['event']['payload']['type'], 'TEMPERATURE_VALUE_OUT_OF_RANGE')
+        self.assertEqual(response['event']['payload']['validRange']['maximumValue'],
+                         {'value': 40.0, 'scale': 'CELSIUS'})
+        self.assertEqual(response['event']['endpoint']['endpointId'], 'spa_test_4')
+        self.assertEqual(ms.setpoint_writes, [])
+
+        request = message.AlexaThermostatRequest('spa_test_4', self.token, value='hot').get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(response['event']['payload']['type'], 'INVALID_DIRECTIVE')
+
+    def test_adjustments_coalesced(self):
+        cloud = SetpointCloud(37.0)
+
+        def adjust(delta):
+            request = message.AlexaThermostatRequest('spa_c', '0101', 'AdjustTargetTemperature',
+                                                     value=delta).get()
+            return Thermostat(request, server=cloud).handle_request_async()
+
+        async def burst():
+            first = asyncio.ensure_future(adjust(1))
+            await asyncio.sleep(0.001)
+            # These arrive while the first write is in flight.
+            return [await first] + list(await asyncio.gather(adjust(1), adjust(1), adjust(-0.5)))
+
+        responses = run_sync(burst())
+        self.assertEqual(cloud.writes, [('Spa.Temp', '38'), ('Spa.Temp', '39.5')])
+        self.assertEqual(cloud.reads, 1)
+        self.assertEqual([self.setpoint(r)['value'] for r in responses], [38.0, 39.5, 39.5, 39.5])
+
+        # An adjustment leaving the heater's range is refused, the others
+        # in the same write still apply.
+        async def raise_twice():
+            return await asyncio.gather(adjust(5), adjust(-1))
+
+        responses = run_sync(raise_twice())
+        self.assertEqual(responses[0]['event']['payload']['type'], 'TEMPERATURE_VALUE_OUT_OF_RANGE')
+        self.assertEqual(self.setpoint(responses[1])['value'], 38.5)
+        self.assertEqual(cloud.writes[-1], ('Spa.Temp', '38.5'))
+
+        responses = run_sync(raise_twice())
+        self.assertEqual(responses[0]['event']['payload']['type'], 'TEMPERATURE_VALUE_OUT_OF_RANGE')
+        self.assertEqual(cloud.writes[-1], ('Spa.Temp', '37.5'))
+
+    def test_no_heater(self):
+        # spa_test_1 is an ACC-100: no setpoint to adjust or set.
+        request = message.AlexaThermostatRequest('spa_test_1', '0101', 'AdjustTargetTemperature',
+                                                 value=1).get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(response['event']['payload']['type'], 'NOT_SUPPORTED_IN_CURRENT_MODE')
+        self.assertEqual(response['event']['endpoint']['endpointId'], 'spa_test_1')
+
+        request = message.AlexaThermostatRequest('spa_test_1', '0101', value=38).get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(response['event']['payload']['type'], 'INVALID_VALUE')
+        self.assertEqual(response['event']['endpoint']['endpointId'], 'spa_test_1')
+        self.assertEqual(ms.setpoint_writes, [])
+
+    def test_cloud_errors(self):
+        # Only a spa or token the cloud does not know drops the token's discovery.
+        discovery_cache.set_endpoints('0101', [{'endpoint_id': 'spa_test_1'}])
+        request = message.AlexaThermostatRequest('spa_test_1', '0101', value=38).get()
+        lambda_function.lambda_handler(request, None)
+        self.assertIsNotNone(discovery_cache.get_endpoints('0101'))
+        discovery_cache.invalidate_token('0101')
+
+        request = message.AlexaThermostatRequest('spa_test_4', 'unknown-token', value=38).get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(response['event']['payload']['type'], 'NO_SUCH_ENDPOINT')
+        self.assertEqual(response['event']['endpoint']['endpointId'], 'spa_test_4')
+
+    def test_cancelled_write_not_pending(self):
+        coalescer = SetpointCoalescer(window=1)
+
+        async def write(value):
+            return value
+
+        async def read():
+            return 37.0
+
+        async def cancel():
+            submit = asyncio.ensure_future(coalescer.submit('spa_c', ('set', 38.0), write, read))
+            await asyncio.sleep(0.01)
+            entry, = coalescer._pending.values()
+            entry.task.cancel()
+            await asyncio.gather(submit, return_exceptions=True)
+            return coalescer.get_stats()['pending']
+
+        self.assertEqual(run_sync(cancel()), 0)
+
+    def test_batch_adjustments(self):
+        ms.spa_state['spa_test_4']['setpoint'] = 37.0
+        requests = [message.AlexaThermostatRequest('spa_test_4', self.token, 'AdjustTargetTemperature',
+                                                   value=delta).get()
+                    for delta in (1, 1, 5, -0.5)]
+        response = lambda_function.lambda_handler({'directives': requests}, None)
+        responses = response['responses']
+
+        # One write of the final setpoint; the adjustment past 40 is refused.
+        self.assertEqual(ms.setpoint_writes, [('spa_test_4', 38.5)])
+        self.assertEqual([self.setpoint(r) for r in responses[:2] + responses[3:]],
+                         [{'value': 38.5, 'scale': 'CELSIUS'}] * 3)
+        self.assertEqual(responses[2]['event']['payload']['type'], 'TEMPERATURE_VALUE_OUT_OF_RANGE')
+        self.assertEqual([r['event']['header']['correlationToken'] for r in responses],
+                         [r['directive']['header']['correlationToken'] for r in requests])
+
+
 class TestReportState(unittest.TestCase):
     def test_directive(self):
         request = message.AlexaStateRequest(
@@ -259,6 +863,16 @@ class TestReportState(unittest.TestCase):
         with self.assertRaises(urllib.error.HTTPError):
             properties = ReportState(request).get_properties()
 
+    def test_unknown_endpoint(self):
+        state_cache.clear()
+        request = message.AlexaStateRequest(endpointId='no-endpoint', token='0111').get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(response['event']['header']['name'], 'ErrorResponse')
+        self.assertEqual(response['event']['payload']['type'], 'NO_SUCH_ENDPOINT')
+        self.assertEqual(response['event']['header']['correlationToken'],
+                         request['directive']['header']['correlationToken'])
+        self.assertEqual(response['event']['endpoint']['endpointId'], 'no-endpoint')
+
     def test_response(self):
         response = message.StateResponse(endpointId='spa_test_2').get()
         self.assertEqual(response['event']['header']['namespace'], 'Alexa')
@@ -301,6 +915,1163 @@ class TestReportState(unittest.TestCase):
         self.assertTrue(found)
 
 
+class SlowCloud:
+    # Fake AsyncDeviceCloud answering each subsystem after a delay.
+    def __init__(self, delays):
+        self.delays = delays
+
+    async def report_state(self, endpoint_id, subsystem=None):
+        delay = self.delays[subsystem]
+        if delay is None:
+            raise urllib.error.HTTPError('url', 400, 'Bad Request', {}, None)
+        await asyncio.sleep(delay)
+        return json.dumps({subsystem: 'On'})
+
+
+class TestReportStateFanOut(unittest.TestCase):
+    def setUp(self):
+        state_cache.clear()
+
+    def properties(self, response):
+        return {prop['instance']: prop for prop in response['context']['properties']
+                if prop['namespace'] != 'Alexa.EndpointHealth'}
+
+    def test_cloud_subsystem(self):
+        request = message.AlexaStateRequest(endpointId='spa_test_2', token='0202').get()
+        handler = ReportState(request)
+        handler.subsystems = ('lights',)
+        properties = self.properties(handler.handle_request())
+        self.assertEqual(properties['Spa.Lights']['value'], 'Off')
+        self.assertEqual(properties['Spa.Lights']['uncertaintyInMilliseconds'], 0)
+
+    def test_partial_after_deadline(self):
+        request = message.AlexaStateRequest(endpointId='spa_test_2', token='0202').get()
+        handler = ReportState(request, server=SlowCloud({'lights': 0, 'jets': 1}))
+        handler.subsystems = ('lights', 'jets')
+        handler.deadline = 0.05
+        properties = self.properties(handler.handle_request())
+        self.assertEqual(list(properties), ['Spa.Lights'])
+        self.assertEqual(properties['Spa.Lights']['uncertaintyInMilliseconds'], 50)
+
+    def test_all_reads_missing(self):
+        request = message.AlexaStateRequest(endpointId='spa_test_2', token='0202').get()
+        handler = ReportState(request, server=SlowCloud({'lights': 1, 'jets': None}))
+        handler.subsystems = ('lights', 'jets')
+        handler.deadline = 0.05
+        response = handler.handle_request()
+        self.assertEqual(response['event']['payload']['type'], 'INVALID_VALUE')
+        self.assertEqual(response['event']['endpoint']['endpointId'], 'spa_test_2')
+
+        handler = ReportState(request, server=SlowCloud({'lights': 1, 'jets': 1}))
+        handler.subsystems = ('lights', 'jets')
+        handler.deadline = 0.05
+        response = handler.handle_request()
+        self.assertEqual(response['event']['payload']['type'], 'ENDPOINT_UNREACHABLE')
+
+
+class CountingCloud:
+    def __init__(self, state):
+        self.state = state
+        self.calls = 0
+
+    async def report_state(self, endpoint_id, subsystem=None):
+        self.calls += 1
+        return json.dumps(self.state)
+
+
+class TestStateCache(unittest.TestCase):
+    def test_update_and_freshness(self):
+        now = [100.0]
+        cache = StateCache(ttl=60, maxsize=2, wall_clock=lambda: now[0])
+        cache.update('spa', {'lights': 'On'})
+        self.assertIsNone(cache.get_fresh('spa', 5))
+        cache.update('spa', {'lights': 'Off', 'jets': 'On'}, complete=True)
+        now[0] = 103.0
+        cache.update('spa', {'lights': 'On'})
+        self.assertEqual(cache.get_fresh('spa', 5),
+                         {'lights': ('On', 103.0), 'jets': ('On', 100.0)})
+        now[0] = 106.0
+        self.assertIsNone(cache.get_fresh('spa', 5))
+
+    def test_report_state_served_from_cache(self):
+        state_cache.clear()
+        cloud = CountingCloud({'lights': 'Off'})
+        request = message.AlexaStateRequest(endpointId='spa_cached', token='0202').get()
+        ReportState(request, server=cloud).handle_request()
+        self.assertEqual(cloud.calls, 1)
+
+        state_cache.update('spa_cached', {'lights': 'On'}, sampled=time.time() - 2)
+        response = ReportState(request, server=cloud).handle_request()
+        self.assertEqual(cloud.calls, 1)
+        prop = response['context']['properties'][0]
+        self.assertEqual(prop['value'], 'On')
+        self.assertGreaterEqual(prop['uncertaintyInMilliseconds'], 2000)
+        self.assertLess(prop['uncertaintyInMilliseconds'], 5000)
+
+        state_cache.invalidate('spa_cached')
+        ReportState(request, server=cloud).handle_request()
+        self.assertEqual(cloud.calls, 2)
+
+    def test_toggle_writes_through(self):
+        state_cache.clear()
+        state_cache.update('spa_test_1', {'lights': 'Off'}, complete=True)
+        request = message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOn').get()
+        Toggle(request).handle_request()
+        self.assertEqual(state_cache.get_fresh('spa_test_1', 5)['lights'][0], 'On')
+
+        request = message.AlexaToggleRequest('spa_test_1', 'bad-token', 'TurnOn').get()
+        Toggle(request).handle_request()
+        self.assertIsNone(state_cache.get_fresh('spa_test_1', 5))
+
+
+class StaticTokens:
+    async def get_access_token(self, grantee_token):
+        return None if grantee_token == 'unknown' else f'Atza|{grantee_token}'
+
+
+class RecordingTransport:
+    def __init__(self):
+        self.posts = []
+
+    async def request(self, method, url, body=None, headers=None, timeout=None):
+        self.posts.append((url, json.loads(body), headers))
+        return 202, b''
+
+
+class SlowGateway(RecordingTransport):
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    async def request(self, method, url, body=None, headers=None, timeout=None):
+        await asyncio.sleep(self.delay)
+        return await super().request(method, url, body, headers, timeout)
+
+
+class TestChangeReport(unittest.TestCase):
+    def test_change_report(self):
+        report = message.ChangeReport(token='Atza|x', endpointId='spa', cause='APP_INTERACTION')
+        report.add_change_property(namespace='Alexa.ToggleController', instance='Spa.Lights',
+                                   name='toggleState', value='On')
+        event = report.get()['event']
+        self.assertEqual(event['header']['name'], 'ChangeReport')
+        self.assertNotIn('correlationToken', event['header'])
+        self.assertEqual(event['endpoint']['scope']['token'], 'Atza|x')
+        self.assertEqual(event['payload']['change']['cause'], {'type': 'APP_INTERACTION'})
+        self.assertEqual(event['payload']['change']['properties'][0]['value'], 'On')
+
+    def test_coalesced_batches(self):
+        transport = RecordingTransport()
+        sender = ChangeReportSender(url='http://gateway/v3/events', tokens=StaticTokens(),
+                                    transport=transport, batch_size=2, window=10)
+
+        async def changes():
+            sender.enqueue_state('spa_a', '0101', {'lights': 'On'})
+            sender.enqueue_state('spa_a', '0101', {'lights': 'Off'})
+            sender.enqueue_state('spa_b', '0202', {'lights': 'On'})
+            sender.enqueue_state('spa_c', 'unknown', {'lights': 'On'})
+            return await sender.flush()
+
+        self.assertEqual(run_sync(changes()), 3)
+        self.assertEqual(len(transport.posts), 2)
+        url, event, headers = transport.posts[0]
+        self.assertEqual(headers['Authorization'], 'Bearer Atza|0101')
+        properties = event['event']['payload']['change']['properties']
+        self.assertEqual([prop['value'] for prop in properties], ['Off'])
+        self.assertEqual(sender.get_stats(), {'pending': 0, 'queued': 3, 'coalesced': 1,
+                                              'sent': 2, 'failed': 0, 'dropped': 1, 'late': 0})
+
+    def test_window_flush(self):
+        transport = RecordingTransport()
+        sender = ChangeReportSender(url='http://gateway/v3/events', tokens=StaticTokens(),
+                                    transport=transport, window=0.01)
+
+        async def change():
+            sender.enqueue_state('spa_a', '0101', {'lights': 'On'})
+            await asyncio.sleep(0.1)
+
+        run_sync(change())
+        self.assertEqual(len(transport.posts), 1)
+
+    def test_toggle_sends_change_report(self):
+        ms.events.clear()
+        get_token_manager().save_grant('0101', {'access_token': 'Atza|access-0101',
+                                               'refresh_token': 'Atzr|refresh-0101',
+                                               'expires_in': 3600})
+        change_reports.url = 'http://localhost:3434/v3/events'
+        try:
+            request = message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOn').get()
+            lambda_function.lambda_handler(request, None)
+            response = lambda_function.lambda_handler(
+                {'webhook': {'endpointId': 'spa_test_1', 'token': '0101', 'state': {'lights': 'Off'}}}, None)
+            self.assertEqual(response, {'queued': True})
+        finally:
+            change_reports.url = None
+            get_token_manager().forget('0101')
+        self.assertEqual(len(ms.events), 2)
+        event = ms.events[0]['event']
+        self.assertEqual(event['endpoint']['endpointId'], 'spa_test_1')
+        self.assertEqual(event['payload']['change']['cause']['type'], 'VOICE_INTERACTION')
+        self.assertEqual(ms.events[1]['event']['payload']['change']['properties'][0]['value'], 'Off')
+
+    def test_slow_gateway_does_not_delay_directive(self):
+        gateway = SlowGateway(1.0)
+        change_reports.transport, change_reports.tokens = gateway, StaticTokens()
+        late = change_reports.late
+        try:
+            request = message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOn').get()
+            started = time.perf_counter()
+            response = lambda_function.lambda_handler(request, None)
+            elapsed = time.perf_counter() - started
+            self.assertEqual(response['event']['header']['name'], 'Response')
+            self.assertLess(elapsed, change_reports.flush_timeout + 0.5)
+            self.assertEqual(change_reports.late, late + 1)
+            self.assertEqual(gateway.posts, [])
+
+            # The next invocation of a warm container finishes the send.
+            async def next_invocation():
+                await asyncio.gather(*list(change_reports._tasks))
+            run_sync(next_invocation())
+            self.assertEqual(len(gateway.posts), 1)
+        finally:
+            change_reports.transport = change_reports.tokens = None
+
+
+class FakeLambdaClient:
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, **kwargs):
+        self.invocations.append(kwargs)
+
+
+class TestDeferred(unittest.TestCase):
+    def setUp(self):
+        ms.events.clear()
+        deferred.enabled = True
+        os.environ['event_gateway_url'] = 'http://localhost:3434/v3/events'
+        get_token_manager().save_grant('0101', {'access_token': 'Atza|access-0101',
+                                               'refresh_token': 'Atzr|refresh-0101',
+                                               'expires_in': 3600})
+
+    def tearDown(self):
+        deferred.enabled = False
+        deferred.set_worker(None)
+        del os.environ['event_gateway_url']
+        get_token_manager().forget('0101')
+
+    def responses(self):
+        return [event for event in ms.events if event['event']['header']['name'] == 'Response']
+
+    def test_deferred_toggle(self):
+        request = message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOn').get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(response['event']['header']['name'], 'DeferredResponse')
+        self.assertEqual(response['event']['payload'], {'estimatedDeferralInSeconds': 5})
+        correlation_token = request['directive']['header']['correlationToken']
+        self.assertEqual(response['event']['header']['correlationToken'], correlation_token)
+
+        # Outside Lambda the loop worker runs the job; lambda_handler drains
+        # it before returning.
+        self.assertIsInstance(deferred.get_worker(), deferred.LoopWorker)
+        final = self.responses()
+        self.assertEqual(len(final), 1)
+        self.assertEqual(final[0]['event']['header']['correlationToken'], correlation_token)
+        self.assertEqual(final[0]['event']['endpoint']['scope']['token'], 'Atza|access-0101')
+        self.assertEqual(final[0]['context']['properties'][0]['name'], 'toggleState')
+
+    def test_synchronous_without_token(self):
+        get_token_manager().forget('0101')
+        request = message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOff').get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(response['event']['header']['name'], 'Response')
+        self.assertEqual(self.responses(), [])
+
+    def test_worker_default(self):
+        os.environ['AWS_LAMBDA_FUNCTION_NAME'] = 'spa-skill'
+        try:
+            worker = deferred.create_worker()
+        finally:
+            del os.environ['AWS_LAMBDA_FUNCTION_NAME']
+        self.assertIsInstance(worker, deferred.LambdaWorker)
+        self.assertEqual(worker.function_name, 'spa-skill')
+        self.assertIsInstance(deferred.create_worker(), deferred.LoopWorker)
+
+    def test_synchronous_without_store(self):
+        manager = token_store._manager
+        token_store._manager = None
+        os.environ['token_store'] = ''
+        try:
+            request = message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOff').get()
+            response = lambda_function.lambda_handler(request, None)
+        finally:
+            os.environ['token_store'] = 'memory'
+            token_store._manager = manager
+        self.assertEqual(response['event']['header']['name'], 'Response')
+
+    def test_lambda_worker(self):
+        client = FakeLambdaClient()
+        deferred.set_worker(deferred.LambdaWorker(function_name='spa-skill', client=client))
+        request = message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOn').get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(response['event']['header']['name'], 'DeferredResponse')
+        self.assertEqual(self.responses(), [])
+
+        invocation = client.invocations[0]
+        self.assertEqual(invocation['InvocationType'], 'Event')
+        self.assertEqual(lambda_function.lambda_handler(json.loads(invocation['Payload']), None),
+                         {'delivered': True})
+        self.assertEqual(len(self.responses()), 1)
+
+
+class TestDirective(unittest.TestCase):
+    def respond(self, request):
+        cloud = CountingCloud({'lights': 'On'})
+        response = run_sync(RequestFactory().create_request_response_async(request, server=cloud))
+        self.assertEqual(cloud.calls, 0)
+        return response
+
+    def assertInvalid(self, request, message=None):
+        response = self.respond(request)
+        self.assertEqual(response['event']['header']['name'], 'ErrorResponse')
+        self.assertEqual(response['event']['payload']['type'], 'INVALID_DIRECTIVE')
+        if message is not None:
+            self.assertEqual(response['event']['payload']['message'], message)
+        return response
+
+    def test_parsed_fields(self):
+        request = message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOn').get()
+        directive = parse_directive(request)
+        self.assertEqual(directive.key, ('Alexa.ToggleController', 'TurnOn', 'Spa.Lights'))
+        self.assertEqual(directive.endpoint_id, 'spa_test_1')
+        self.assertEqual(directive.token, '0101')
+        self.assertEqual(directive.correlation_token,
+                         request['directive']['header']['correlationToken'])
+
+        discover = message.AlexaDiscoveryRequest(token='0202').get()
+        self.assertEqual(parse_directive(discover).token, '0202')
+
+    def test_missing_endpoint(self):
+        request = message.AlexaStateRequest(endpointId='spa_test_1', token='0101').get()
+        del request['directive']['endpoint']
+        response = self.assertInvalid(request, 'endpoint.endpointId is missing')
+        self.assertEqual(response['event']['header']['correlationToken'],
+                         request['directive']['header']['correlationToken'])
+
+    def test_bad_scope(self):
+        request = message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOff').get()
+        request['directive']['endpoint']['scope'] = 'token'
+        self.assertInvalid(request, 'endpoint.scope.token is missing')
+
+        request = message.AlexaDiscoveryRequest(token='0202').get()
+        request['directive']['payload']['scope']['token'] = 202
+        self.assertInvalid(request, 'payload.scope.token must be a non-empty string')
+
+    def test_wrong_types(self):
+        request = message.AlexaStateRequest(endpointId='spa_test_1', token='0101').get()
+        request['directive']['payload'] = []
+        self.assertInvalid(request, 'payload must be an object')
+
+        request = message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOn').get()
+        del request['directive']['header']['instance']
+        self.assertInvalid(request, 'header.instance is missing')
+
+        self.assertInvalid({'directive': []}, 'Directive not in message')
+        self.assertInvalid({'directive': {'header': {'payloadVersion': '3', 'name': 'Discover'}}},
+                           'Directive namespace and name are required')
+
+    def test_handler_parses_directly(self):
+        request = message.AlexaStateRequest(endpointId='spa_test_1', token='0101').get()
+        del request['directive']['endpoint']['scope']
+        with self.assertRaises(DirectiveError):
+            ReportState(request, server=CountingCloud({}))
+
+
+class TestDispatch(unittest.TestCase):
+    def test_lookup(self):
+        registry = HandlerRegistry()
+
+        @registry.register('Alexa.ToggleController', 'TurnOn')
+        @registry.register('Alexa.ToggleController', 'TurnOn', 'Spa.Jets')
+        class Handler:
+            pass
+
+        self.assertIs(registry.lookup('Alexa.ToggleController', 'TurnOn'), Handler)
+        self.assertIs(registry.lookup('Alexa.ToggleController', 'TurnOn', 'Spa.Lights'), Handler)
+        self.assertIsNone(registry.lookup('Alexa.ToggleController', 'TurnOff'))
+        with self.assertRaises(ValueError):
+            registry.add(Handler, 'Alexa.ToggleController', 'TurnOn')
+
+    def test_builtin_handlers(self):
+        self.assertIs(handlers.lookup('Alexa', 'ReportState'), ReportState)
+        self.assertIs(handlers.lookup('Alexa.ToggleController', 'TurnOff', 'Spa.Lights'), Toggle)
+        self.assertIsNone(handlers.lookup('Alexa', 'TurnOn'))
+
+    def test_plugin_handler(self):
+        class Ping(RequestHandler):
+            async def build_response_async(self):
+                return message.AlexaResponse(namespace='Test', name='Pong',
+                                             correlationToken=self.correlationToken)
+
+        handlers.add(Ping, 'Test', 'Ping')
+        try:
+            request = message.AlexaRequest().set_header(namespace='Test', name='Ping').get()
+            response = lambda_function.lambda_handler(request, None)
+            self.assertEqual(response['event']['header']['name'], 'Pong')
+        finally:
+            handlers.remove('Test', 'Ping')
+
+    def test_missing_directive(self):
+        response = lambda_function.lambda_handler({'header': {}}, None)
+        self.assertEqual(response['event']['payload']['type'], 'INVALID_DIRECTIVE')
+
+
+class TestAsync(unittest.TestCase):
+    def test_async_cloud(self):
+        server = AsyncDeviceCloud()
+        response = json.loads(run_sync(server.report_state('spa_test_3')))
+        self.assertEqual(response, {'lights': 'Off'})
+        with self.assertRaises(urllib.error.HTTPError):
+            run_sync(server.report_state('no-endpoint'))
+
+    def test_concurrent_directives(self):
+        requests = [message.AlexaStateRequest(endpointId='spa_test_3', token='0303').get()
+                    for _ in range(10)]
+        requests.append(message.AlexaDiscoveryRequest(token='0303').get())
+
+        async def handle_all():
+            return await asyncio.gather(
+                *(lambda_function.async_lambda_handler(request, None) for request in requests))
+        responses = run_sync(handle_all())
+
+        self.assertEqual(len(responses), len(requests))
+        for request, response in zip(requests, responses):
+            self.assertEqual(response['event']['header']['correlationToken'],
+                             request['directive']['header']['correlationToken'])
+        self.assertEqual(responses[0]['event']['header']['name'], 'StateReport')
+        self.assertEqual(responses[-1]['event']['header']['name'], 'Discover.Response')
+
+
+class TestBatch(unittest.TestCase):
+    def test_batch_order_and_errors(self):
+        requests = [
+            message.AlexaStateRequest(endpointId='spa_test_3', token='0303').get(),
+            message.AlexaDiscoveryRequest(token='0303').get(),
+            message.AlexaStateRequest(endpointId='no-endpoint', token='0000').get(),
+            message.AlexaRequest().set_header(
+                namespace="Alexa.NotImplementedInterface", name="Alexa").get(),
+            {'not-a-directive': {}},
+            message.AlexaStateRequest(endpointId='spa_test_3', token='0303').get(),
+        ]
+        response = lambda_function.lambda_handler({'directives': requests}, None)
+        responses = response['responses']
+
+        self.assertEqual(len(responses), len(requests))
+        self.assertEqual(responses[0]['event']['header']['name'], 'StateReport')
+        self.assertEqual(responses[0]['event']['header']['correlationToken'],
+                         requests[0]['directive']['header']['correlationToken'])
+        self.assertEqual(responses[1]['event']['header']['name'], 'Discover.Response')
+        self.assertEqual(responses[2]['event']['header']['name'], 'ErrorResponse')
+        self.assertEqual(responses[2]['event']['payload']['type'], 'NO_SUCH_ENDPOINT')
+        self.assertEqual(responses[2]['event']['header']['correlationToken'],
+                         requests[2]['directive']['header']['correlationToken'])
+        self.assertEqual(responses[2]['event']['endpoint']['endpointId'], 'no-endpoint')
+        self.assertEqual(responses[3]['event']['payload']['type'], 'INVALID_DIRECTIVE')
+        self.assertEqual(responses[4]['event']['header']['name'], 'ErrorResponse')
+        self.assertEqual(responses[5]['event']['header']['correlationToken'],
+                         requests[5]['directive']['header']['correlationToken'])
+
+    def test_batch_cloud_errors(self):
+        # 4xx from the cloud name the problem, other failures the cloud.
+        for code, typ in ((404, 'NO_SUCH_ENDPOINT'), (400, 'INVALID_VALUE'),
+                          (401, 'INVALID_AUTHORIZATION_CREDENTIAL'), (503, 'ENDPOINT_UNREACHABLE')):
+            class FailingFactory(RequestFactory):
+                async def create_request_response_async(self, request, **kwargs):
+                    raise urllib.error.HTTPError('url', code, 'Error', {}, None)
+
+            request = message.AlexaToggleRequest('spa_test_1', '0101', 'TurnOn').get()
+            response = run_sync(FailingFactory().create_batch_response_async([request]))[0]
+            self.assertEqual(response['event']['payload']['type'], typ)
+            self.assertEqual(response['event']['header']['correlationToken'],
+                             request['directive']['header']['correlationToken'])
+            self.assertEqual(response['event']['endpoint']['endpointId'], 'spa_test_1')
+
+    def test_batch_groups(self):
+        requests = [
+            message.AlexaToggleRequest('spa_test_3', '0303', 'TurnOn').get(),
+            message.AlexaStateRequest(endpointId='spa_test_3', token='0303').get(),
+            message.AlexaDiscoveryRequest(token='0303').get(),
+        ]
+        keys = [batch_group_key(request, index) for index, request in enumerate(requests)]
+        self.assertEqual(keys[0], keys[1])
+        self.assertEqual(keys[2], ('token', '0303'))
+        self.assertEqual(batch_group_key({}, 7), ('item', 7))
+
+        responses = RequestFactory().create_batch_response(requests[1:])
+        self.assertEqual([r['event']['header']['name'] for r in responses],
+                         ['StateReport', 'Discover.Response'])
+
+
+class TestModels(unittest.TestCase):
+    def test_slots(self):
+        prop = Property('Alexa.ToggleController', 'toggleState', 'ON', 'Spa.Lights', time_of_sample=0)
+        with self.assertRaises(AttributeError):
+            prop.extra = 1
+        self.assertEqual(prop.as_dict()['timeOfSample'], '1970-01-01T00:00:00+00:00')
+        self.assertEqual(Header('Alexa', 'ReportState', correlation_token='abc').as_dict()['correlationToken'], 'abc')
+        self.assertEqual(Capability(interface='Alexa.ToggleController', instance='Spa.Lights',
+                                    supported=[{'name': 'toggleState'}]).as_dict(),
+                         message.AlexaResponse.create_payload_endpoint_capability(
+                             interface='Alexa.ToggleController', instance='Spa.Lights',
+                             supported=[{'name': 'toggleState'}]))
+
+    def test_reused_instances(self):
+        lights = Property('Alexa.ToggleController', 'toggleState', 'ON', 'Spa.Lights')
+        endpoint = DiscoveryEndpoint('spa', capabilities=capabilities.capability_set('Alexa', 'Spa.Lights'),
+                                     display_categories=('OTHER',), additional_attributes={}, cookie={'a': 1})
+        for _ in range(2):
+            response = message.StateResponse(endpointId='spa', correlationToken='abc')
+            response.add_property(lights)
+            properties = response.get()['context']['properties']
+            self.assertEqual(properties[0]['value'], 'ON')
+            self.assertIs(response.context_properties[1], ENDPOINT_HEALTH)
+            # Properties without a sample time share the message time.
+            self.assertEqual(properties[0]['timeOfSample'], properties[1]['timeOfSample'])
+
+            discovery = message.DiscoveryResponse(namespace='Alexa.Discovery', name='Discover.Response')
+            discovery.add_endpoint(endpoint)
+            discovery.add_endpoint(endpoint)
+            self.assertEqual(discovery.serialize(), json.dumps(discovery.get()).encode('utf-8'))
+
+
+class TestSerializer(unittest.TestCase):
+    def test_discovery_stream(self):
+        response = message.DiscoveryResponse(
+            namespace='Alexa.Discovery', name='Discover.Response', correlationToken='abc')
+        for index in range(50):
+            response.add_payload_endpoint(
+                f'spa_{index}', capabilities=capabilities.capability_set('Alexa', 'Spa.Lights'))
+        serialized = response.serialize()
+        self.assertEqual(serialized, json.dumps(response.get()).encode('utf-8'))
+
+    def test_state_and_error_stream(self):
+        response = message.StateResponse(endpointId='spa_test_2', correlationToken='abc')
+        response.add_context_property(namespace='Alexa.ToggleController', instance='Spa.Lights',
+                                      name='toggleState', value='On')
+        serialized = response.serialize()
+        self.assertEqual(json.loads(serialized), json.loads(json.dumps(response.get())))
+
+        response = message.ErrorResponse(typ='INVALID_DIRECTIVE', message='bad')
+        serialized = response.serialize()
+        self.assertEqual(serialized, json.dumps(response.get()).encode('utf-8'))
+
+    def test_header_and_endpoint_models(self):
+        # Kept as models until rendered, and written without their dicts.
+        responses = [message.AlexaResponse(endpointId='spa_test_2', token='0202', correlationToken='abc',
+                                           cookie={'model': 'ACC-100'}),
+                     message.AlexaResponse(endpointId='spa_test_2', token='0202', cookie=None),
+                     message.ChangeReport(endpointId='spa_test_2', token='Atza|access')]
+        for response in responses:
+            self.assertIsInstance(response.event['header'], Header)
+            self.assertEqual(response.serialize(), json.dumps(response.get()).encode('utf-8'))
+        self.assertIn('cookie', responses[1].get()['event']['endpoint'])
+        self.assertNotIn('correlationToken', responses[2].get()['event']['header'])
+
+    def test_serialized_directive(self):
+        request = message.AlexaDiscoveryRequest(token='0101').get()
+        response = json.loads(RequestFactory().create_serialized_response(request))
+        self.assertEqual(response['event']['header']['name'], 'Discover.Response')
+        self.assertEqual(response['event']['payload']['endpoints'][0]['endpointId'], 'spa_test_1')
+
+
+class TestPayloadLog(unittest.TestCase):
+    def test_redact_and_truncate(self):
+        request = message.AlexaToggleRequest('spa_test_1', 'secret-token-0101', 'TurnOn').get()
+        redacted = redact(request)
+        self.assertEqual(redacted['directive']['endpoint']['scope']['token'], '***0101')
+        self.assertEqual(request['directive']['endpoint']['scope']['token'], 'secret-token-0101')
+
+        record = json.loads(str(LazyPayload('request', 'TurnOn', request, max_bytes=0)))
+        self.assertEqual(record['payload']['directive']['endpoint']['scope']['token'], '***0101')
+        record = json.loads(str(LazyPayload('request', 'TurnOn', request, max_bytes=20)))
+        self.assertEqual(len(record['payload']), 20)
+        self.assertGreater(record['truncated'], 20)
+
+    def test_sampling(self):
+        self.assertEqual(parse_sample_rates('ReportState=0.5, *=0'),
+                         {'ReportState': 0.5, '*': 0.0})
+        payload_log = PayloadLogger(logging.getLogger('test.payload'), enabled=True,
+                                    rates={'ReportState': 0.5, '*': 0.0},
+                                    random=lambda: 0.4)
+        self.assertTrue(payload_log.sampled('ReportState'))
+        self.assertFalse(payload_log.sampled('Discover'))
+        payload_log.random = lambda: 0.6
+        self.assertFalse(payload_log.sampled('ReportState'))
+
+    def test_disabled_is_lazy(self):
+        class Unserializable:
+            def __repr__(self):
+                raise AssertionError('payload formatted while logging is off')
+
+        payload_log = PayloadLogger(logging.getLogger('test.payload'), enabled=False)
+        self.assertFalse(payload_log.log('request', 'Discover', {'x': Unserializable()}))
+
+        payload_log = PayloadLogger(logging.getLogger('test.payload'), enabled=True)
+        with self.assertLogs('test.payload', level='INFO') as logs:
+            self.assertTrue(payload_log.log('request', 'Discover', {'token': 'abcdefgh'}))
+        self.assertIn('***efgh', logs.output[0])
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.records = []
+        metrics.add_hook(self.records.append)
+
+    def tearDown(self):
+        metrics.remove_hook(self.records.append)
+
+    def test_phases(self):
+        discovery_cache.clear()
+        request = message.AlexaDiscoveryRequest(token='0202').get()
+        lambda_function.lambda_handler(request, None)
+        self.assertEqual(len(self.records), 1)
+        record = self.records[0]
+        self.assertEqual(record['directive'], 'Discover')
+        for phase in ('validate', 'dispatch', 'build', 'cloud', 'serialize', 'total'):
+            self.assertIn(f'{phase}_ms', record)
+        # The endpoint list, then the endpoint metadata.
+        self.assertEqual(record['cloud_calls'], 2)
+        self.assertEqual(record['cloud_status'], [200, 200])
+        self.assertGreater(record['cloud_bytes'], 0)
+        # The runtime serializes Lambda responses, they are not measured twice.
+        self.assertNotIn('response_bytes', record)
+
+    def test_serialized_size(self):
+        request = message.AlexaStateRequest(endpointId='spa_test_2', token='0202').get()
+        record, token = metrics.start(directive='ReportState')
+        data = RequestFactory().create_serialized_response(request)
+        metrics.finish(record, token)
+        self.assertEqual(self.records[0]['response_bytes'], len(data))
+
+    def test_serialized_handler(self):
+        # The HTTP server asks lambda_function for the bytes it sends.
+        request = message.AlexaStateRequest(endpointId='spa_test_2', token='0202').get()
+        data = run_sync(lambda_function.async_lambda_handler(request, None, serialize=True))
+        self.assertEqual(json.loads(data)['event']['header']['name'], 'StateReport')
+        self.assertEqual(self.records[0]['response_bytes'], len(data))
+        self.assertIn('StateReport', str(LazyPayload('response', 'ReportState', data)))
+
+    def test_cloud_error_status(self):
+        state_cache.clear()
+        request = message.AlexaStateRequest(endpointId='no-endpoint', token='0000').get()
+        lambda_function.lambda_handler({'directives': [request]}, None)
+        self.assertEqual(self.records[0]['cloud_status'], [404])
+
+    def test_disabled(self):
+        metrics.remove_hook(self.records.append)
+        self.assertFalse(metrics.enabled())
+        self.assertEqual(metrics.start(directive='Discover'), (None, None))
+        with metrics.phase('build'):
+            pass
+        self.assertIsNone(metrics.current())
+
+    def test_emf(self):
+        stream = io.StringIO()
+        metrics.EMFEmitter(stream=stream, namespace='Test')(
+            {'directive': 'Discover', 'total_ms': 1.5, 'cloud_ms': 1.0,
+             'cloud_calls': 1, 'cloud_bytes': 10})
+        document = json.loads(stream.getvalue())
+        definition = document['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual(definition['Namespace'], 'Test')
+        self.assertEqual(definition['Dimensions'], [['directive']])
+        self.assertIn({'Name': 'total_ms', 'Unit': 'Milliseconds'}, definition['Metrics'])
+        self.assertEqual(document['total_ms'], 1.5)
+
+
+class TestColdStart(unittest.TestCase):
+    def test_lazy_imports(self):
+        code = ('import sys, source.lambda_function; '
+                'print(",".join(m for m in ("lib.handlers.toggle", "lib.handlers.authorization", '
+                '"urllib.request", "http.client") if m in sys.modules))')
+        loaded = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                                text=True, check=True).stdout.strip()
+        self.assertEqual(loaded, '')
+
+    def test_lazy_handler_lookup(self):
+        registry = HandlerRegistry()
+        registry.add_lazy('lib.handlers.toggle:Toggle', 'Alexa.ToggleController', 'TurnOn')
+        self.assertIs(registry.lookup('Alexa.ToggleController', 'TurnOn'), Toggle)
+        # The class registering itself replaces its own placeholder only.
+        registry.add_lazy('lib.handlers.state:ReportState', 'Alexa', 'ReportState')
+        registry.add(ReportState, 'Alexa', 'ReportState')
+        with self.assertRaises(ValueError):
+            registry.add(Toggle, 'Alexa', 'ReportState')
+
+    def test_cloud_config_shared(self):
+        self.assertIs(DeviceCloud().url, DeviceCloud().url)
+        self.assertEqual(DeviceCloud().url, 'http://localhost:3434')
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"lights": "Off"}'
+        self.send_response(200 if self.path != '/missing' else 404)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestTransport(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.httpd = ThreadingHTTPServer(('localhost', 0), KeepAliveHandler)
+        cls.url = f'http://localhost:{cls.httpd.server_address[1]}'
+        Thread(target=cls.httpd.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+
+    def test_connection_reused(self):
+        transport = PooledTransport(maxsize=2, timeout=2)
+        for _ in range(3):
+            status, body = transport.request('GET', self.url + '/state')
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body), {'lights': 'Off'})
+        stats = transport.get_stats()
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['reused'], 2)
+        self.assertEqual(stats['idle'], 1)
+        transport.close()
+
+    def test_stale_retry_closes(self):
+        # A failed retry on a fresh connection closes it too.
+        class DeadConnection:
+            sock = None
+            closed = False
+
+            def request(self, *args, **kwargs):
+                raise http.client.RemoteDisconnected('gone')
+
+            def close(self):
+                self.closed = True
+
+        transport = PooledTransport()
+        pool = transport.get_pool('http', 'localhost', 80)
+        stale, fresh = DeadConnection(), DeadConnection()
+        pool.put(stale)
+        pool.new_connection = lambda timeout=None: fresh
+        with self.assertRaises(http.client.RemoteDisconnected):
+            transport.request('GET', 'http://localhost/state')
+        self.assertTrue(stale.closed)
+        self.assertTrue(fresh.closed)
+
+    def test_idle_eviction(self):
+        transport = PooledTransport(idle_timeout=0)
+        transport.request('GET', self.url + '/state')
+        time.sleep(.01)
+        transport.request('GET', self.url + '/state')
+        stats = transport.get_stats()
+        self.assertEqual(stats['opened'], 2)
+        self.assertEqual(stats['evicted'], 1)
+        self.assertEqual(stats['reused'], 0)
+        transport.close()
+
+    def test_http_error(self):
+        transport = PooledTransport()
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            transport.request('GET', self.url + '/missing')
+        self.assertEqual(error.exception.code, 404)
+        self.assertEqual(error.exception.read(), b'{"lights": "Off"}')
+        transport.close()
+
+    def test_async_connection_reused(self):
+        transport = AsyncPooledTransport(timeout=2)
+
+        async def fetch():
+            for _ in range(3):
+                status, body = await transport.request('GET', self.url + '/state')
+                self.assertEqual(status, 200)
+                self.assertEqual(json.loads(body), {'lights': 'Off'})
+            with self.assertRaises(urllib.error.HTTPError):
+                await transport.request('GET', self.url + '/missing')
+            transport.close()
+        run_sync(fetch())
+        stats = transport.get_stats()
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['reused'], 3)
+
+    def test_device_cloud_transport(self):
+        server = DeviceCloud(transport=UrllibTransport(timeout=2))
+        response = json.loads(server.report_state('spa_test_3'))
+        self.assertEqual(response, {'lights': 'Off'})
+        self.assertEqual(server.transport.stats.snapshot()['opened'], 1)
+
+
+class FlakyTransport:
+    # Plays back outcomes: an exception is raised, anything else returned.
+    timeout = 5.0
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.timeouts = []
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        self.timeouts.append(timeout)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class AsyncFlakyTransport(FlakyTransport):
+    async def request(self, method, url, body=None, headers=None, timeout=None):
+        return super().request(method, url, body, headers, timeout)
+
+
+def http_error(code):
+    return HTTPError('http://flaky', code, 'error', {}, io.BytesIO(b''))
+
+
+class TestResilience(unittest.TestCase):
+    def setUp(self):
+        resilience.breakers.clear()
+        self.retry = RetryPolicy(attempts=3, random=lambda low, high: 0)
+
+    def cloud(self, transport, cls=DeviceCloud):
+        config = CloudConfig(schema='http', host='flaky', port='1')
+        return cls(transport=transport, config=config, retry=self.retry)
+
+    def test_breaker_states(self):
+        now = [0.0]
+        breaker = CircuitBreaker('host', failures=2, reset_timeout=10, clock=lambda: now[0])
+        breaker.record_failure()
+        breaker.allow()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpenError, breaker.allow)
+        now[0] = 10.0
+        breaker.allow()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # Only one trial call at a time.
+        self.assertRaises(CircuitOpenError, breaker.allow)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        now[0] = 20.0
+        breaker.allow()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_idempotent_reads_are_retried(self):
+        transport = FlakyTransport(http_error(503), ConnectionResetError(), (200, b'{}'))
+        self.assertEqual(self.cloud(transport).report_state('spa'), b'{}')
+        self.assertEqual(len(transport.timeouts), 3)
+
+        transport = AsyncFlakyTransport(TimeoutError(), (200, b'{}'))
+        cloud = self.cloud(transport, AsyncDeviceCloud)
+        self.assertEqual(run_sync(cloud.device_discovery(token='0')), b'{}')
+
+    def test_no_retry_for_updates_and_client_errors(self):
+        transport = FlakyTransport(ConnectionResetError(), (200, b'{}'))
+        with self.assertRaises(CloudUnavailable):
+            self.cloud(transport).update_device_state('spa', 'Spa.Lights', 'TurnOn', '0')
+        transport = FlakyTransport(http_error(404), (200, b'{}'))
+        with self.assertRaises(HTTPError):
+            self.cloud(transport).report_state('spa')
+        self.assertEqual(len(transport.outcomes), 1)
+
+    def test_open_circuit_fails_fast(self):
+        transport = FlakyTransport(*[ConnectionRefusedError()] * 5)
+        cloud = self.cloud(transport)
+        cloud.retry = RetryPolicy(attempts=1)
+        for _ in range(5):
+            self.assertRaises(CloudUnavailable, cloud.report_state, 'spa')
+        self.assertRaises(CircuitOpenError, cloud.report_state, 'spa')
+        self.assertEqual(transport.outcomes, [])
+
+        request = message.AlexaStateRequest(endpointId='spa_down', token='0202').get()
+        server = self.cloud(AsyncFlakyTransport(), AsyncDeviceCloud)
+        state_cache.clear()
+        response = run_sync(RequestFactory().create_request_response_async(request, server=server))
+        self.assertEqual(response['event']['header']['name'], 'ErrorResponse')
+        self.assertEqual(response['event']['payload']['type'], 'ENDPOINT_UNREACHABLE')
+        self.assertEqual(response['event']['header']['correlationToken'],
+                         request['directive']['header']['correlationToken'])
+        self.assertEqual(response['event']['endpoint']['endpointId'], 'spa_down')
+
+    def test_deadline_caps_timeout(self):
+        transport = FlakyTransport((200, b'{}'))
+        token = resilience.set_deadline(Deadline(1.0))
+        try:
+            self.cloud(transport).report_state('spa')
+            self.assertLessEqual(transport.timeouts[0], 1.0)
+            resilience.set_deadline(Deadline(0))
+            self.assertRaises(resilience.DeadlineExceeded, self.cloud(transport).report_state, 'spa')
+        finally:
+            resilience.reset_deadline(token)
+
+    def test_deadline_from_lambda_context(self):
+        class Context:
+            def get_remaining_time_in_millis(self):
+                return 3000
+
+        deadline = resilience.deadline_from_context(Context(), reserve=0.5)
+        self.assertAlmostEqual(deadline.remaining(), 2.5, places=1)
+        self.assertIsNone(resilience.deadline_from_context(None))
+
+
+class GatedTransport:
+    # Holds every request until released, counting the requests made.
+    timeout = 5.0
+
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        self.calls += 1
+        self.release.wait(5)
+        return 200, json.dumps({'url': url}).encode()
+
+
+class AsyncGatedTransport(GatedTransport):
+    async def request(self, method, url, body=None, headers=None, timeout=None):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        return 200, json.dumps({'url': url}).encode()
+
+
+class TestCoalescing(unittest.TestCase):
+    def setUp(self):
+        resilience.breakers.clear()
+        flight_stats.reset()
+        self.config = CloudConfig(schema='http', host='shared', port='1')
+
+    def test_threads_share_one_read(self):
+        transport = GatedTransport()
+        cloud = DeviceCloud(transport=transport, config=self.config)
+        results = []
+        threads = [Thread(target=lambda: results.append(cloud.report_state('spa')))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while flight_stats.snapshot()['collapsed'] < 4:
+            time.sleep(0.01)
+        transport.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(transport.calls, 1)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(flight_stats.snapshot(), {'calls': 1, 'collapsed': 4})
+
+    def test_asyncio_shares_one_read_per_url(self):
+        transport = AsyncGatedTransport()
+        cloud = AsyncDeviceCloud(transport=transport, config=self.config)
+
+        async def read_all():
+            return await asyncio.gather(*(cloud.report_state(endpoint)
+                                          for endpoint in ('a', 'a', 'b', 'a')))
+
+        records = []
+        hook = metrics.add_hook(records.append)
+        try:
+            record, token = metrics.start()
+            results = run_sync(read_all())
+            metrics.finish(record, token)
+        finally:
+            metrics.remove_hook(hook)
+        self.assertEqual(records[0]['cloud_collapsed'], 2)
+        self.assertEqual(transport.calls, 2)
+        self.assertEqual(results[0], results[1])
+        self.assertNotEqual(results[0], results[2])
+        self.assertEqual(flight_stats.snapshot(), {'calls': 2, 'collapsed': 2})
+
+    def test_updates_and_errors(self):
+        # Writes are never shared, errors reach every waiter.
+        transport = AsyncGatedTransport()
+        cloud = AsyncDeviceCloud(transport=transport, config=self.config)
+
+        async def toggle_twice():
+            return await asyncio.gather(
+                cloud.update_device_state('spa', 'Spa.Lights', 'TurnOn', '0'),
+                cloud.update_device_state('spa', 'Spa.Lights', 'TurnOn', '0'))
+
+        run_sync(toggle_twice())
+        self.assertEqual(transport.calls, 2)
+
+        flight = SingleFlight()
+        self.assertRaises(ValueError, flight.do, 'key', lambda: int('x'))
+        self.assertEqual(len(flight), 0)
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'the directive server forks its workers')
+class TestDirectiveServer(unittest.TestCase):
+    def setUp(self):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+        self.server = subprocess.Popen(
+            [sys.executable, '-m', 'source.server', '--port', str(self.port), '--workers', '2'],
+            stderr=subprocess.DEVNULL)
+        self.addCleanup(self.stop)
+        for _ in range(200):
+            try:
+                self.get('/health')
+                break
+            except OSError:
+                time.sleep(0.05)
+
+    def stop(self):
+        if self.server.poll() is None:
+            self.server.kill()
+            self.server.wait()
+
+    def get(self, path):
+        return json.loads(urllib.request.urlopen(f'http://127.0.0.1:{self.port}{path}', timeout=5).read())
+
+    def post(self, body):
+        request = urllib.request.Request(f'http://127.0.0.1:{self.port}/', body)
+        return json.loads(urllib.request.urlopen(request, timeout=5).read())
+
+    def test_directives_and_metrics(self):
+        request = message.AlexaStateRequest(endpointId='spa_test_2', token='0202').get()
+        response = self.post(json.dumps(request).encode('utf-8'))
+        self.assertEqual(response['event']['header']['name'], 'StateReport')
+        self.assertEqual(response['event']['header']['correlationToken'],
+                         request['directive']['header']['correlationToken'])
+
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            self.post(b'not json')
+        self.assertEqual(error.exception.code, 400)
+        for length in ('abc', '-1'):
+            connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+            connection.putrequest('POST', '/')
+            connection.putheader('Content-Length', length)
+            connection.endheaders()
+            self.assertEqual(connection.getresponse().status, 400)
+            connection.close()
+
+        metrics = self.get('/metrics')
+        self.assertEqual(len(metrics['workers']), 2)
+        self.assertEqual(metrics['requests'], 1)
+        self.assertEqual(metrics['errors'], 0)
+        self.assertEqual(set(metrics['process']), {'pid', 'transport', 'breakers', 'flights'})
+        self.assertIn('idle', metrics['process']['transport'])
+        self.assertEqual(set(metrics['process']['flights']), {'calls', 'collapsed'})
+
+    def test_reload_and_stop(self):
+        self.assertEqual(self.get('/health')['generation'], 0)
+        self.server.send_signal(signal.SIGHUP)
+        for _ in range(200):
+            workers = self.get('/metrics')['workers']
+            if [worker['generation'] for worker in workers] == [1, 1]:
+                break
+            time.sleep(0.05)
+        self.assertEqual([worker['generation'] for worker in workers], [1, 1])
+        self.assertEqual(self.get('/health')['generation'], 1)
+
+        self.server.send_signal(signal.SIGTERM)
+        self.assertEqual(self.server.wait(20), 0)
+
+
+class TestSimulator(unittest.TestCase):
+    # The Bottle stand-in as a simulated cloud, see test/bottle_test_server.py.
+    def tearDown(self):
+        ms.configure(spas=0, faults=None)
+        discovery_cache.clear()
+        state_cache.clear()
+
+    def fetch(self, path):
+        try:
+            with urllib.request.urlopen('http://localhost:3434' + path, timeout=5) as reply:
+                return reply.status, json.loads(reply.read())
+        except urllib.error.HTTPError as error:
+            return error.code, None
+
+    def test_generated_spas(self):
+        ms.configure(spas=40, seed=7)
+        first = copy.deepcopy({spa: (ms.spa_state[spa], ms.device_info[spa]) for _, spa in ms.generated})
+        ms.configure(spas=40, seed=7)
+        self.assertEqual({spa: (ms.spa_state[spa], ms.device_info[spa]) for _, spa in ms.generated}, first)
+        for spa, (state, info) in first.items():
+            self.assertEqual(set(state) - {'temperature'}, set(ms.model_parts[info['model']]))
+
+        # The four test spas stay, the previous generation goes.
+        ms.configure(spas=3, seed=7)
+        self.assertIn('spa_test_4', ms.spa_state)
+        self.assertNotIn('sim_spa_00010', ms.spa_state)
+        self.assertEqual(ms.accounts[ms.fleet_token], ['sim_spa_00000', 'sim_spa_00001', 'sim_spa_00002'])
+
+    def test_fleet_discovery(self):
+        ms.configure(spas=150, seed=3)
+        discovery_cache.clear()
+        request = message.AlexaDiscoveryRequest(token=ms.fleet_token).get()
+        endpoints = lambda_function.lambda_handler(request, None)['event']['payload']['endpoints']
+        self.assertEqual(len(endpoints), 150)
+        models = {e['endpointId']: e['additionalAttributes']['model'] for e in endpoints}
+        self.assertEqual(models, {spa: ms.device_info[spa]['model'] for spa in ms.accounts[ms.fleet_token]})
+
+    def test_generated_spa_directives(self):
+        ms.configure(spas=20, seed=3)
+        token, spa = next((token, spa) for token, spa in ms.generated
+                          if ms.device_info[spa]['model'] == 'ACC-400')
+        request = message.AlexaRequest().set_header('Alexa.ModeController', 'SetMode', instance='Spa.Pump2') \
+            .set_endpoint(spa, {'type': 'BearerToken', 'token': token}) \
+            .set_payload({'mode': 'Speed.High'}).get()
+        response = lambda_function.lambda_handler(request, None)
+        self.assertEqual(response['event']['header']['name'], 'Response')
+        self.assertEqual(ms.spa_state[spa]['pump2'], 'High')
+
+    def test_faults_deterministic(self):
+        faults = {'reportstate': {'latency': ['lognormal', 0.002, 0.5], 'tail_rate': 0.1, 'tail': 0.01,
+                                  'error_rate': 0.3}}
+        draws = []
+        for _ in range(2):
+            ms.configure(seed=11, faults=faults)
+            draws.append([self.fetch('/spa/reportstate/spa_test_3')[0] for _ in range(20)])
+        self.assertEqual(draws[0], draws[1])
+        self.assertEqual(set(draws[0]), {200, 503})
+        stats = ms.simulator.get_stats()['reportstate']
+        self.assertEqual(stats['requests'], 20)
+        self.assertEqual(stats['errors'], draws[1].count(503))
+        self.assertGreater(stats['delay'], 0)
+
+    def test_faults_per_route(self):
+        ms.configure(faults={'devices': {'error_rate': 1, 'error_status': 500}})
+        self.assertEqual(self.fetch('/spa/devices/spa_test_1'), (500, None))
+        self.assertEqual(self.fetch('/spa/reportstate/spa_test_1')[0], 200)
+        stats = ms.simulator.get_stats()
+        self.assertEqual((stats['devices']['errors'], stats['reportstate']['errors']), (1, 0))
+
+    def test_latency_distributions(self):
+        rng = random.Random(1)
+        self.assertEqual(ms.Latency(0.5).draw(rng), 0.5)
+        self.assertTrue(0.1 <= ms.Latency(['uniform', 0.1, 0.2]).draw(rng) <= 0.2)
+        self.assertGreaterEqual(ms.Latency(['normal', 0, 1]).draw(random.Random(2)), 0)
+        with self.assertRaises(ValueError):
+            ms.Latency(['pareto', 1])
+
+    def test_threaded_server(self):
+        # Slow requests are served side by side.
+        ms.configure(faults={'reportstate': {'latency': 0.3}})
+        results = []
+        threads = [Thread(target=lambda: results.append(self.fetch('/spa/reportstate/spa_test_2')[0]))
+                   for _ in range(5)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [200] * 5)
+        self.assertLess(time.perf_counter() - started, 1.2)
+
+
 mock_server = Thread(target=ms.run_server)
 mock_server.daemon = True
 mock_server.start()